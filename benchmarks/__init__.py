@@ -0,0 +1 @@
+"""Synthetic-data benchmarks for the analysis scripts; see run_benchmarks.py for usage."""
@@ -0,0 +1,440 @@
+"""Time and memory-profile every analysis stage on synthetic data and keep a JSON history.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks                      # quick preset, appended to the history
+    python -m benchmarks.run_benchmarks --preset full --label before-change
+    python -m benchmarks.run_benchmarks --stage code7 --stage segment_image
+    python -m benchmarks.run_benchmarks --compare            # latest run vs the run before it
+    python -m benchmarks.run_benchmarks --compare before-change --threshold 0.1
+
+Each stage is timed `repeat` times without instrumentation (wall and CPU time, median reported),
+then run once more under tracemalloc while a sampler thread records the resident set size, so the
+memory figures include allocations made by OpenCV and other native code.
+A stage that raises is recorded in the history with its error, and the run exits with status 1.
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')  # The scripts call plt.show(); never open windows while benchmarking
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import cv2
+
+from benchmarks import synthetic
+from benchmarks.script_loader import load_script
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY_PATH = os.path.join(REPO_ROOT, 'benchmarks', 'history.json')
+
+PRESETS = {
+    'quick': {'proteins': [1000], 'conditions': [3], 'megapixels': [1], 'images': 3, 'repeat': 3},
+    'standard': {'proteins': [1000, 10000], 'conditions': [3, 10], 'megapixels': [1, 10], 'images': 3, 'repeat': 3},
+    'full': {'proteins': [1000, 10000, 100000], 'conditions': [3, 10, 50], 'megapixels': [1, 10, 50, 200],
+             'images': 3, 'repeat': 1},
+}
+
+def current_rss_mb():
+    """Resident set size of this process in MB (Linux /proc, psutil elsewhere, None if unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 ** 2
+    except ImportError:
+        return None
+
+class RssSampler(threading.Thread):
+    """Background thread tracking the peak RSS above the level at start."""
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.baseline = current_rss_mb()
+        self.peak = self.baseline
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set() and self.baseline is not None:
+            self.peak = max(self.peak, current_rss_mb())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        if self.baseline is None:
+            return None
+        self.peak = max(self.peak, current_rss_mb())
+        return self.peak - self.baseline
+
+def measure(func, repeat=1, profile_memory=True):
+    """Run `func` and return wall/CPU timings and memory figures; errors are recorded, not raised."""
+    result = {'status': 'ok'}
+    walls, cpus = [], []
+    try:
+        for _ in range(repeat):
+            gc.collect()
+            wall, cpu = time.perf_counter(), time.process_time()
+            func()
+            walls.append(time.perf_counter() - wall)
+            cpus.append(time.process_time() - cpu)
+            plt.close('all')
+
+        if profile_memory:
+            gc.collect()
+            sampler = RssSampler()
+            sampler.start()
+            tracemalloc.start()
+            try:
+                func()
+                result['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            finally:
+                tracemalloc.stop()
+                result['rss_peak_increase_mb'] = sampler.stop()
+                plt.close('all')
+    except Exception as e:  # MemoryError at the largest sizes is a result worth keeping
+        result['status'] = f'error: {type(e).__name__}: {e}'
+        plt.close('all')
+
+    if walls:
+        result.update({'wall_s': statistics.median(walls), 'wall_min_s': min(walls),
+                       'cpu_s': statistics.median(cpus), 'repeats': len(walls)})
+    result['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+def proteomics_stages(workdir, n_proteins, n_conditions):
+    """(stage, params, callable) for code1 to code5 and the Perseus cache at one data size."""
+    params = {'proteins': n_proteins, 'conditions': n_conditions}
+    matrix_path = synthetic.intensity_matrix_csv(os.path.join(workdir, f'matrix_{n_proteins}_{n_conditions}.csv'),
+                                                 n_proteins, n_conditions)
+    id_path = synthetic.intensity_matrix_csv(os.path.join(workdir, f'ids_{n_proteins}_{n_conditions}.csv'),
+                                             n_proteins, n_conditions, identifiers=True)
+    n_comparisons = min(n_conditions, 6)  # Effect sizes scale with the number of pairs; cap the pair count
+    comparison_paths = [synthetic.perseus_comparison_csv(os.path.join(workdir, f'cmp{k}_{n_proteins}.csv'),
+                                                         n_proteins, seed=k) for k in range(n_comparisons)]
+
+    import perseus_cache
+    cache_dir = os.path.join(workdir, 'perseus_cache')
+
+    def cold_load():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        perseus_cache.load_perseus_csv(matrix_path, index_col=0, cache_dir=cache_dir)
+
+    yield 'pandas.read_csv', params, lambda: pd.read_csv(matrix_path, index_col=0)
+    yield 'perseus_cache.load_perseus_csv (cold)', params, cold_load
+    yield 'perseus_cache.load_perseus_csv (warm)', params, \
+        lambda: perseus_cache.load_perseus_csv(matrix_path, index_col=0, cache_dir=cache_dir)
+
+    # code1 and code2
+    code1 = load_script(os.path.join(REPO_ROOT, 'code1_volcano_plot.py'))
+    comparison = pd.read_csv(comparison_paths[0])
+    yield 'code1.create_volcano_plot', params, lambda: code1['create_volcano_plot'](comparison, 'bench')
+    code2 = load_script(os.path.join(REPO_ROOT, 'code2_scatter_plot.py'))
+    yield 'code2.preprocess_data', params, lambda: code2['preprocess_data'](id_path)
+
+    # code3: out-of-core normalization, intersection counting and plotting
+    code3 = load_script(os.path.join(REPO_ROOT, 'code3_upset_plot.py'))
+    log_matrix, _, columns = code3['write_log10_memmap'](matrix_path, os.path.join(workdir, 'log10.npy'))
+    block_columns = code3['column_block_size'](log_matrix.shape[0], 256)
+    references, quantiles = code3['fit_quantiles_chunked'](log_matrix, 1000, block_columns)
+    normalized = np.empty(log_matrix.shape, order='F')
+    yield 'code3.write_log10_memmap', params, \
+        lambda: code3['write_log10_memmap'](matrix_path, os.path.join(workdir, 'log10.npy'))
+    yield 'code3.fit_quantiles_chunked', params, \
+        lambda: code3['fit_quantiles_chunked'](log_matrix, 1000, block_columns)
+    yield 'code3.transform_quantiles_chunked', params, \
+        lambda: code3['transform_quantiles_chunked'](log_matrix, references, quantiles, normalized, block_columns)
+    condition_means = np.nanmean(np.asarray(log_matrix).reshape(n_proteins, n_conditions, -1), axis=2)
+    z_scores = (condition_means[:, 1:] - condition_means[:, :1]) / np.nanstd(condition_means[:, :1])
+    intersections = code3['count_intersections'](z_scores > 1, z_scores < -1, top_k=40)
+    conditions = synthetic.condition_names(n_conditions)[1:]
+    yield 'code3.count_intersections', params, \
+        lambda: code3['count_intersections'](z_scores > 1, z_scores < -1, top_k=40)
+    yield 'code3.plot_upset', params, lambda: code3['plot_upset'](
+        code3['intersections_to_series'](*intersections['up'], conditions), 'Bench', 'darkred',
+        os.path.join(workdir, 'upset.svg'))
+
+    # code4: diversity engine and rank-abundance plotting
+    code4 = load_script(os.path.join(REPO_ROOT, 'code4_rankabundance_plot.py'))
+    df, column_groups = code4['process_data'](matrix_path)
+    datasets = {'bench.csv': (df, column_groups)}
+    yield 'code4.calculate_diversity_table', params, \
+        lambda: code4['calculate_diversity_table'](datasets, n_bootstrap=200)
+    shannon = {name: 1.0 for name in column_groups}
+    yield 'code4.plot_combined_with_heatmap', params, \
+        lambda: code4['plot_combined_with_heatmap'](df, column_groups, shannon, 'bench.csv', max_points=1000)
+
+    # code5: pairwise tests, effect sizes and plots
+    code5 = load_script(os.path.join(REPO_ROOT, 'code5_violin_plot.py'))
+    dfs = [pd.read_csv(path) for path in comparison_paths]
+    names = [f'C{k}' for k in range(n_comparisons)]
+    stats_df = code5['perform_statistical_analysis'](dfs, names)
+    yield 'code5.perform_statistical_analysis', params, lambda: code5['perform_statistical_analysis'](dfs, names)
+    yield 'code5.compute_effect_sizes', params, \
+        lambda: code5['compute_effect_sizes'](dfs, names, n_resamples=1000)
+    yield 'code5.create_combined_violin_plot', params, lambda: code5['create_combined_violin_plot'](dfs, names)
+    yield 'code5.create_statistical_dot_plot', params, lambda: code5['create_statistical_dot_plot'](stats_df)
+
+def image_stages(workdir, megapixels, n_images):
+    """(stage, params, callable) for the histology (code6) and fluorescence (code7) pipelines."""
+    params = {'megapixels': megapixels}
+    image_dir = os.path.join(workdir, f'images_{megapixels}')
+
+    # code6 Step 2: sample detection and color segmentation; Step 3: tissue masks
+    code6 = load_script(os.path.join(REPO_ROOT, 'code6_histology_analysis.py'), step=2)
+    code6_step3 = load_script(os.path.join(REPO_ROOT, 'code6_histology_analysis.py'), step=3)
+    histology = synthetic.write_image_set(image_dir, 'histology', megapixels, 1, 'HE')
+    img_rgb = cv2.cvtColor(cv2.imread(histology.at[0, 'FilePath']), cv2.COLOR_BGR2RGB)
+    color_groups = code6['get_color_group']('HE')
+    sample_mask = code6['detect_sample_region'](img_rgb)
+    masked = cv2.bitwise_and(img_rgb, img_rgb, mask=sample_mask)
+    yield 'code6.detect_sample_region', params, lambda: code6['detect_sample_region'](img_rgb)
+    yield 'code6.segment_image', params, lambda: code6['segment_image'](masked, color_groups)
+    yield 'code6.deconvolve_segment_image', params, \
+        lambda: code6['deconvolve_segment_image'](masked, 'HE', color_groups)
+    effective_mask = (sample_mask > 0) & ~np.all(img_rgb > 240, axis=2)
+    yield 'code6.color_histogram', params, lambda: code6['color_histogram'](img_rgb, effective_mask)
+    yield 'code6.process_and_display_image', params, \
+        lambda: code6['process_and_display_image'](histology, 0, 'HE', color_groups)
+    yield 'code6.requantify_from_histograms', params, lambda: code6['requantify_from_histograms'](histology)
+    for factor in (4, 8):
+        yield 'code6.preview_image', dict(params, factor=factor), \
+            lambda factor=factor: code6['preview_image'](histology.at[0, 'FilePath'], 'HE', color_groups, factor)
+    yield 'code6.create_original_mask', params, \
+        lambda: code6_step3['create_original_mask'](histology.at[0, 'FilePath'])
+
+    # Step 1 stitching: registration of overlapping snapshots and lazy composition of the mosaic
+    import mosaic_stitching
+    snapshots = synthetic.write_overlapping_snapshots(os.path.join(image_dir, 'snapshots'), megapixels, 'HE')
+    mosaic_dir = os.path.join(image_dir, 'mosaics')
+    mosaic = mosaic_stitching.stitch_metadata(snapshots, mosaic_dir)
+    yield 'mosaic_stitching.stitch_metadata', dict(params, snapshots=len(snapshots)), \
+        lambda: mosaic_stitching.stitch_metadata(snapshots, mosaic_dir)
+    yield 'mosaic_stitching.read_image', params, lambda: mosaic_stitching.read_image(mosaic.at[0, 'FilePath'])
+
+    # Regression check: independent samples with the same outline must never be stitched together
+    lookalikes = synthetic.write_lookalike_samples(os.path.join(image_dir, 'lookalikes'), megapixels, 'HE')
+
+    def register_lookalikes():
+        pairs = mosaic_stitching.register_snapshots(lookalikes['FilePath'].tolist())
+        if pairs:
+            raise AssertionError(f"independent samples registered as overlapping: {pairs}")
+    yield 'mosaic_stitching.register_lookalikes', dict(params, snapshots=len(lookalikes)), register_lookalikes
+
+    # Step 1 duplicate detection: reduced-decode hashing and the multi-index lookup over a large batch
+    import snapshot_hashing
+    yield 'snapshot_hashing.file_phash', params, lambda: snapshot_hashing.file_phash(histology.at[0, 'FilePath'])
+    hashes = np.random.default_rng(0).integers(0, 2 ** 63, size=10000)
+    batch = pd.DataFrame({'Filename': [f'snapshot_{i}' for i in range(len(hashes))],
+                          'PHash': [f'{value:016x}' for value in hashes]})
+    yield 'snapshot_hashing.flag_near_duplicates', {'images': len(batch)}, \
+        lambda: snapshot_hashing.flag_near_duplicates(batch)
+
+    # Regression check: the look-alike samples above are separate replicates, not copies of each other
+    def hash_lookalikes():
+        hashed = lookalikes.assign(PHash=[f'{snapshot_hashing.file_phash(path):016x}' for path in lookalikes['FilePath']])
+        flagged = snapshot_hashing.flag_near_duplicates(hashed)
+        if (flagged['Duplicate_Of'] != '').any():
+            raise AssertionError(f"independent samples flagged as copies: {flagged['Duplicate_Of'].tolist()}")
+    yield 'snapshot_hashing.hash_lookalikes', dict(params, snapshots=len(lookalikes)), hash_lookalikes
+
+    # Step 2 quality gate: focus, clipping, coverage and illumination metrics on a reduced decode
+    import image_qc
+    yield 'image_qc.qc_metrics', params, lambda: image_qc.qc_metrics(histology.at[0, 'FilePath'])
+
+    # code7 Step 2: normalization, sample detection, global range and per-image analysis
+    code7 = load_script(os.path.join(REPO_ROOT, 'code7_ihc_analysis.py'), step=2)
+    fluorescence = synthetic.write_image_set(image_dir, 'fluorescence', megapixels, n_images, 'Desmin')
+    image = code7['load_image'](fluorescence.at[0, 'FilePath'])
+    normalized = code7['normalize_image'](image)
+    fluorescence_mask = code7['detect_sample_region'](normalized)
+    intensity_range = code7['get_global_intensity_range'](fluorescence, 'Desmin')
+    yield 'code7.normalize_image', params, lambda: code7['normalize_image'](image)
+    yield 'code7.detect_sample_region', params, lambda: code7['detect_sample_region'](normalized)
+    yield 'code7.get_global_intensity_range', dict(params, images=n_images), \
+        lambda: code7['get_global_intensity_range'](fluorescence, 'Desmin')
+    yield 'code7.detect_stained_regions_global', params, \
+        lambda: code7['detect_stained_regions_global'](normalized, fluorescence_mask, intensity_range)
+    high_mask = code7['detect_stained_regions_global'](normalized, fluorescence_mask, intensity_range)[0]
+    yield 'code7.measure_objects', params, lambda: code7['measure_objects'](high_mask)
+
+    import spatial_analysis
+    high_labels = spatial_analysis.labels_from_masks([high_mask])
+    yield 'spatial_analysis.depth_profile', params, \
+        lambda: spatial_analysis.depth_profile(high_labels, ['High_Intensity'],
+                                               spatial_analysis.depth_map(fluorescence_mask))
+    high_integral, sample_integral = spatial_analysis.integral_image(high_mask), \
+        spatial_analysis.integral_image(fluorescence_mask)
+    yield 'spatial_analysis.heterogeneity', dict(params, grids=3), \
+        lambda: spatial_analysis.heterogeneity({'High_Intensity': high_integral}, sample_integral, [64, 128, 256])
+    yield 'code7.process_image', params, lambda: code7['process_image'](fluorescence, 0, 'Desmin', intensity_range)
+    for factor in (4, 8):
+        yield 'code7.preview_image', dict(params, factor=factor), \
+            lambda factor=factor: code7['preview_image'](fluorescence.at[0, 'FilePath'], 'Desmin', intensity_range,
+                                                         factor)
+
+def statistics_stages(workdir):
+    """(stage, params, callable) for the code7 Step 3 plots and ANOVA/Tukey analysis."""
+    code7_step3 = load_script(os.path.join(REPO_ROOT, 'code7_ihc_analysis.py'), step=3)
+    output_dir = os.path.join(workdir, 'Statistical-Analysis')
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, '.figure_manifest.json')
+
+    def uncached(func):
+        # Forget previous exports so every repeat renders, instead of skipping unchanged figures
+        def run_uncached():
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            func()
+        return run_uncached
+
+    for n_per_condition in (3, 30):
+        results = synthetic.fluorescence_results(n_per_condition)
+        params = {'images_per_condition': n_per_condition}
+        create_plots = lambda: code7_step3['create_analysis_plots'](results, 'Desmin', output_dir)
+        analyse = lambda: code7_step3['perform_statistical_analysis'](results, 'Desmin', output_dir)
+        yield 'code7.create_analysis_plots', params, uncached(create_plots)
+        yield 'code7.perform_statistical_analysis', params, uncached(analyse)
+        yield 'code7.perform_statistical_analysis (figures current)', params, analyse
+
+def all_stages(workdir, preset):
+    for n_proteins in preset['proteins']:
+        for n_conditions in preset['conditions']:
+            yield from proteomics_stages(workdir, n_proteins, n_conditions)
+    for megapixels in preset['megapixels']:
+        yield from image_stages(workdir, megapixels, preset['images'])
+    yield from statistics_stages(workdir)
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+def save_history(history, path):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(history, f, indent=2)
+    os.replace(tmp, path)
+
+def run(preset_name, stage_filters=(), label=None, profile_memory=True, history_path=HISTORY_PATH):
+    """Run the selected stages and append one run record to the history file."""
+    preset = PRESETS[preset_name]
+    sys.path.insert(0, REPO_ROOT)  # The scripts import shared helpers such as perseus_cache
+    record = {
+        'label': label,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'preset': preset_name,
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'opencv': cv2.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'results': [],
+    }
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    cwd = os.getcwd()
+    os.chdir(workdir)  # Stages write their figures and tables to the working directory
+    try:
+        for stage, params, func in all_stages(workdir, preset):
+            if stage_filters and not any(f in stage for f in stage_filters):
+                continue
+            result = measure(func, preset['repeat'], profile_memory)
+            record['results'].append({'stage': stage, 'params': params, **result})
+            timing = f"{result['wall_s']:.3f} s" if 'wall_s' in result else result['status']
+            print(f"{stage:<45} {json.dumps(params):<40} {timing}", flush=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    history = load_history(history_path)
+    history.append(record)
+    save_history(history, history_path)
+    print(f"Appended run {len(history) - 1} to {history_path}")
+    failed = [result['stage'] for result in record['results'] if result['status'] != 'ok']
+    if failed:
+        print(f"{len(failed)} stage(s) failed: {', '.join(failed)}", file=sys.stderr)
+    return record
+
+def find_run(history, reference):
+    """A run by label, or by index into the history (negative indices count from the end)."""
+    for record in reversed(history):
+        if record.get('label') == reference:
+            return record
+    return history[int(reference)]
+
+def compare(history, baseline='-2', candidate='-1', threshold=0.1, min_seconds=0.05):
+    """Print wall-time ratios of matching stages between two runs; return the regressed stages.
+
+    Stages faster than `min_seconds` in both runs are listed but never flagged, since timer noise
+    dominates at millisecond scale.
+    """
+    base, new = find_run(history, baseline), find_run(history, candidate)
+    key = lambda result: (result['stage'], json.dumps(result['params'], sort_keys=True))
+    base_results = {key(result): result for result in base['results']}
+    regressions = []
+    print(f"Baseline {base.get('label') or base['timestamp']} ({base.get('git_revision')}) vs "
+          f"{new.get('label') or new['timestamp']} ({new.get('git_revision')})")
+    for result in new['results']:
+        previous = base_results.get(key(result))
+        if previous is None or 'wall_s' not in previous or 'wall_s' not in result:
+            continue
+        ratio = result['wall_s'] / previous['wall_s'] if previous['wall_s'] > 0 else float('inf')
+        flag = ''
+        if max(result['wall_s'], previous['wall_s']) < min_seconds:
+            pass
+        elif ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(result['stage'])
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        memory = ''
+        if result.get('rss_peak_increase_mb') is not None and previous.get('rss_peak_increase_mb') is not None:
+            memory = f"{previous['rss_peak_increase_mb']:8.1f} -> {result['rss_peak_increase_mb']:8.1f} MB"
+        print(f"{result['stage']:<45} {json.dumps(result['params']):<40} {previous['wall_s']:9.3f} -> "
+              f"{result['wall_s']:9.3f} s  x{ratio:5.2f}  {memory}  {flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick')
+    parser.add_argument('--stage', action='append', default=[], help='Only run stages whose name contains this')
+    parser.add_argument('--label', help='Name for this run, usable with --compare')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc/RSS profiling pass')
+    parser.add_argument('--history', default=HISTORY_PATH)
+    parser.add_argument('--compare', nargs='?', const='-2', metavar='BASELINE',
+                        help='Compare the latest run with BASELINE (label or index, default: the previous run)')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as a regression')
+    parser.add_argument('--min-seconds', type=float, default=0.05, help='Never flag stages faster than this')
+    args = parser.parse_args()
+
+    if args.compare is None:
+        record = run(args.preset, args.stage, args.label, not args.no_memory, args.history)
+        sys.exit(1 if any(result['status'] != 'ok' for result in record['results']) else 0)
+    regressions = compare(load_history(args.history), args.compare, '-1', args.threshold, args.min_seconds)
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
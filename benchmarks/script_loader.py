@@ -0,0 +1,69 @@
+"""Load the functions of a Colab analysis script without running its cells.
+
+The scripts execute their workflow at module level (uploads, prompts, main()), so they cannot be
+imported. The loader parses a script with `ast` and executes only its imports, function and class
+definitions and literal-valued settings, which is everything a benchmark needs to call a stage.
+"""
+import ast
+import os
+import re
+
+# Notebook-only modules that are unavailable (or interactive) outside Colab
+SKIPPED_MODULES = ('google.colab', 'IPython')
+
+def split_steps(source):
+    """Split a multi-cell script on its '# Step N:' headers into {N: source of that cell}."""
+    steps = {}
+    current, lines = 0, []
+    for line in source.splitlines():
+        match = re.match(r'#\s*Step\s+(\d+)', line)
+        if match:
+            steps[current] = '\n'.join(lines)
+            current, lines = int(match.group(1)), []
+        lines.append(line)
+    steps[current] = '\n'.join(lines)
+    return {step: cell for step, cell in steps.items() if cell.strip()}
+
+def is_skipped_import(node):
+    names = [alias.name for alias in node.names] if isinstance(node, ast.Import) else [node.module or '']
+    return any(name == module or name.startswith(module + '.') for name in names for module in SKIPPED_MODULES)
+
+def is_literal_assignment(node):
+    """Module-level settings such as `n_quantiles = 1000` or `control_conditions = ['3D,HC']`."""
+    if not isinstance(node, (ast.Assign, ast.AnnAssign)) or node.value is None:
+        return False
+    try:
+        ast.literal_eval(node.value)
+    except ValueError:
+        return False
+    return True
+
+def definitions_only(tree):
+    """Keep imports, definitions and literal settings; drop every statement that runs the workflow."""
+    body = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            if not is_skipped_import(node):
+                body.append(node)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) or is_literal_assignment(node):
+            body.append(node)
+    tree.body = body
+    return tree
+
+def load_script(path, step=None, namespace=None):
+    """Execute the definitions of a script (or of one of its Step cells) and return the namespace.
+
+    Shell magics such as `!pip install upsetplot` are dropped before parsing. For the multi-cell
+    scripts (code6, code7), `step` selects one cell, because later cells redefine helpers such as
+    `main` and `load_metadata` with different behaviour.
+    """
+    with open(path) as f:
+        source = '\n'.join(line for line in f.read().splitlines() if not line.lstrip().startswith('!'))
+    if step is not None:
+        source = split_steps(source)[step]
+    tree = definitions_only(ast.parse(source, filename=path))
+    namespace = {} if namespace is None else namespace
+    namespace.setdefault('__name__', os.path.splitext(os.path.basename(path))[0])
+    namespace.setdefault('__file__', path)
+    exec(compile(tree, path, 'exec'), namespace)
+    return namespace
@@ -0,0 +1,169 @@
+"""Deterministic synthetic inputs shaped like the data the analysis scripts expect.
+
+Every generator takes a seed, so the same arguments always produce the same data.
+"""
+import os
+import numpy as np
+import pandas as pd
+import cv2
+
+CONDITION_PREFIXES = ['HC', 'DD', 'MD']
+
+def condition_names(n_conditions):
+    """Condition labels in the repo's naming style: 3D,HC, 3D,DD, 3D,MD, then numbered treatments."""
+    names = [f'3D,{prefix}' for prefix in CONDITION_PREFIXES[:n_conditions]]
+    names += [f'3D,T{i}' for i in range(1, n_conditions - len(names) + 1)]
+    return names
+
+def accession_numbers(n_proteins):
+    return [f'P{i:06d}' for i in range(n_proteins)]
+
+def perseus_comparison_csv(path, n_proteins, seed=0):
+    """Perseus two-group test export: Accession_Number, LogPvalue and Difference per protein."""
+    rng = np.random.default_rng(seed)
+    difference = rng.standard_t(5, size=n_proteins) * 4
+    log_pvalue = np.abs(difference) / 4 + rng.exponential(0.5, size=n_proteins)
+    df = pd.DataFrame({
+        'Accession_Number': accession_numbers(n_proteins),
+        'LogPvalue': log_pvalue,
+        'Difference': difference,
+    })
+    df.to_csv(path, index=False)
+    return path
+
+def intensity_matrix(n_proteins, n_conditions, n_replicates=3, seed=0):
+    """Normalized total precursor intensities (proteins x condition replicates), log-normal with shifts."""
+    rng = np.random.default_rng(seed)
+    baseline = rng.normal(6, 1.2, size=(n_proteins, 1))
+    shifts = rng.normal(0, 0.4, size=(n_proteins, n_conditions)) * (rng.random((n_proteins, 1)) < 0.3)
+    noise = rng.normal(0, 0.15, size=(n_proteins, n_conditions, n_replicates))
+    values = 10 ** (baseline[:, :, np.newaxis] + shifts[:, :, np.newaxis] + noise)
+    values[rng.random(values.shape) < 0.02] = 0  # Proteins missing in some replicates
+    columns = [f'{name}-{replicate}' for name in condition_names(n_conditions)
+               for replicate in range(1, n_replicates + 1)]
+    return pd.DataFrame(values.reshape(n_proteins, -1), index=pd.Index(accession_numbers(n_proteins),
+                                                                        name='Accession_Number'), columns=columns)
+
+def intensity_matrix_csv(path, n_proteins, n_conditions, n_replicates=3, seed=0, identifiers=False):
+    """Write an intensity matrix; `identifiers` adds the Alternate_ID/Identified_Proteins columns of code2."""
+    df = intensity_matrix(n_proteins, n_conditions, n_replicates, seed)
+    if identifiers:
+        df.insert(0, 'Alternate_ID', [f'ALT{i}' for i in range(len(df))])
+        df.insert(1, 'Identified_Proteins', 'Protein')
+    df.to_csv(path)
+    return path
+
+def image_shape(megapixels, aspect=4 / 3):
+    """(height, width) of an image with roughly the requested number of megapixels."""
+    height = int(round(np.sqrt(megapixels * 1e6 / aspect)))
+    return height, int(round(height * aspect))
+
+def smooth_field(shape, rng, scale=64):
+    """Low-frequency noise in [0, 1], generated at low resolution and upsampled."""
+    small = rng.random((max(2, shape[0] // scale), max(2, shape[1] // scale))).astype(np.float32)
+    return cv2.resize(small, (shape[1], shape[0]), interpolation=cv2.INTER_CUBIC).clip(0, 1)
+
+def tissue_mask(shape, rng):
+    """A single irregular tissue section covering roughly the central half of the frame."""
+    height, width = shape
+    y = np.arange(height, dtype=np.float32)[:, np.newaxis]
+    x = np.arange(width, dtype=np.float32)[np.newaxis, :]
+    radius = ((y - height / 2) / (0.38 * height)) ** 2 + ((x - width / 2) / (0.38 * width)) ** 2
+    return radius + 0.35 * (smooth_field(shape, rng, scale=256) - 0.5) < 1
+
+def histology_image(megapixels, palette=None, seed=0):
+    """RGB brightfield slide: white background and a tissue section mixing the given stain colors."""
+    rng = np.random.default_rng(seed)
+    shape = image_shape(megapixels)
+    palette = np.array(palette if palette is not None else
+                       [(93, 51, 105), (163, 107, 158), (239, 221, 236)], dtype=np.float32)
+    image = np.full(shape + (3,), 245, dtype=np.uint8)
+    tissue = tissue_mask(shape, rng)
+    component = np.minimum((smooth_field(shape, rng, scale=32) * len(palette)).astype(np.intp), len(palette) - 1)
+    for row in range(0, shape[0], 1024):  # Row blocks keep the float temporaries small for 200 MP slides
+        block = palette[component[row:row + 1024]]
+        block += rng.normal(0, 8, size=block.shape).astype(np.float32)
+        np.copyto(image[row:row + 1024], block.clip(0, 255).astype(np.uint8),
+                  where=tissue[row:row + 1024, :, np.newaxis])
+    return image
+
+def fluorescence_image(megapixels, seed=0):
+    """Grayscale fluorescence snapshot: dark background and a tissue section with uneven staining."""
+    rng = np.random.default_rng(seed)
+    shape = image_shape(megapixels)
+    image = rng.integers(0, 12, size=shape, dtype=np.uint8)
+    tissue = tissue_mask(shape, rng)
+    signal = (40 + 200 * smooth_field(shape, rng, scale=24) ** 2).astype(np.uint8)
+    np.copyto(image, signal, where=tissue)
+    return image
+
+def write_image_set(directory, kind, megapixels, n_images, staining, seed=0):
+    """Write snapshots named like the real ones (HC-Desmin-1.png) and return metadata rows for them."""
+    os.makedirs(directory, exist_ok=True)
+    rows = []
+    for i in range(n_images):
+        condition = CONDITION_PREFIXES[i % len(CONDITION_PREFIXES)]
+        replicate = i // len(CONDITION_PREFIXES) + 1
+        filename = f'{condition}-{staining}-{replicate}.png'
+        path = os.path.join(directory, filename)
+        if kind == 'histology':
+            cv2.imwrite(path, cv2.cvtColor(histology_image(megapixels, seed=seed + i), cv2.COLOR_RGB2BGR))
+        else:
+            cv2.imwrite(path, fluorescence_image(megapixels, seed=seed + i))
+        rows.append({'Filename': filename, 'FilePath': path, 'Condition': condition,
+                     'Staining': staining, 'Replicate': str(replicate)})
+    return pd.DataFrame(rows)
+
+def write_overlapping_snapshots(directory, megapixels, staining, n_snapshots=2, overlap=0.3, seed=0):
+    """Histology snapshots of one sample (DD-HE-1.png, ...) tiled left to right with a shared margin."""
+    os.makedirs(directory, exist_ok=True)
+    height, width = image_shape(megapixels)
+    step = int(width * (1 - overlap))
+    rng = np.random.default_rng(seed)
+    # One 4:3 slide wide enough for all fields, which are cut with a small vertical jitter
+    slide_width = step * (n_snapshots - 1) + width
+    slide = histology_image(slide_width ** 2 * 0.75 / 1e6, seed=seed)
+    rows = []
+    for i in range(n_snapshots):
+        x, y = i * step, int(rng.integers(0, 64))
+        filename = f'DD-{staining}-{i + 1}.png'
+        path = os.path.join(directory, filename)
+        cv2.imwrite(path, cv2.cvtColor(slide[y:y + height, x:x + width], cv2.COLOR_RGB2BGR))
+        rows.append({'Filename': filename, 'FilePath': path, 'Condition': 'DD', 'Staining': staining,
+                     'Replicate': str(i + 1)})
+    return pd.DataFrame(rows)
+
+def write_lookalike_samples(directory, megapixels, staining, n_samples=4, seed=0):
+    """Independent samples of one condition (DD-HE-1.png, ...) with the same elliptical outline.
+
+    Every sample has its own tissue texture, so none of them overlaps another; stitching must keep
+    them as separate replicates even though their outlines and colors match.
+    """
+    os.makedirs(directory, exist_ok=True)
+    height, width = image_shape(megapixels)
+    y = np.arange(height, dtype=np.float32)[:, np.newaxis]
+    x = np.arange(width, dtype=np.float32)[np.newaxis, :]
+    outside = ((y - height / 2) / (0.3 * height)) ** 2 + ((x - width / 2) / (0.3 * width)) ** 2 >= 1
+    rows = []
+    for i in range(n_samples):
+        image = histology_image(megapixels, seed=seed + i)
+        image[outside] = 245
+        filename = f'DD-{staining}-{i + 1}.png'
+        path = os.path.join(directory, filename)
+        cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+        rows.append({'Filename': filename, 'FilePath': path, 'Condition': 'DD', 'Staining': staining,
+                     'Replicate': str(i + 1)})
+    return pd.DataFrame(rows)
+
+def fluorescence_results(n_per_condition, staining='Desmin', seed=0):
+    """Per-image staining percentages in the layout code7 Step 2 writes to metadata.csv."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for shift, condition in enumerate(CONDITION_PREFIXES):
+        for replicate in range(1, n_per_condition + 1):
+            high, low = rng.uniform(5, 30) + 5 * shift, rng.uniform(10, 40)
+            rows.append({'Filename': f'{condition}-{staining}-{replicate}.png', 'Condition': condition,
+                         'Staining': staining, 'Replicate': str(replicate),
+                         'High_Intensity_Percentage': high, 'Low_Intensity_Percentage': low,
+                         'Unstained_Percentage': 100 - high - low, 'Total_Stained_Percentage': high + low})
+    return pd.DataFrame(rows)
@@ -4,6 +4,7 @@ import numpy as np
 from google.colab import files
 import zipfile
 import os
+from perseus_cache import load_perseus_csv
 
 
 def upload_files():
@@ -71,7 +72,7 @@ def process_files(uploaded_files, title_fontsize=16, label_fontsize=14, tick_fon
     for filename, content in uploaded_files.items():
         with open(filename, 'wb') as f:
             f.write(content)
-        df = pd.read_csv(filename)
+        df = load_perseus_csv(filename, usecols=['Accession_Number', 'LogPvalue', 'Difference'])
         base_name = os.path.splitext(filename)[0]
         plot_path = create_volcano_plot(df, base_name, title_fontsize, label_fontsize, tick_fontsize)
         sig_csv_name = save_significant_proteins(df, base_name)
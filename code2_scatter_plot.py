@@ -2,6 +2,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import zipfile
 from google.colab import files
+from perseus_cache import load_perseus_csv
 
 def upload_file():
     print("Please upload your CSV file:")
@@ -10,8 +11,7 @@ def upload_file():
     return filename
 
 def preprocess_data(filename):
-    df = pd.read_csv(filename)
-    df = df.drop(columns=['Alternate_ID', 'Identified_Proteins'])  # Drop unused identifier columns
+    df = load_perseus_csv(filename, drop=['Alternate_ID', 'Identified_Proteins'])  # Skip unused identifier columns
 
     # Extract condition names and group by mean of replicates
     condition_names = df.columns[1:]  # assuming 'Accession_Number' is the first column
@@ -5,22 +5,96 @@ import numpy as np
 from google.colab import files
 import re
 from sklearn.preprocessing import QuantileTransformer
-from upsetplot import UpSet, from_contents
+from scipy.stats import norm
+from upsetplot import UpSet
 import matplotlib.pyplot as plt
+from perseus_cache import load_perseus_csv, open_perseus_matrix
 
 # Step 1: Upload the CSV file
 uploaded = files.upload()
-
-# Step 2: Read the CSV file into a DataFrame
 filename = list(uploaded.keys())[0]
-df = pd.read_csv(filename, index_col=0)
 
-# Step 3: Log10 transformation to stabilize variance
-df = np.log10(df + 1)  # Adding 1 to avoid log(0) issues
+# Out-of-core settings for very wide studies (e.g. 10k proteins x 400 samples)
+use_chunked_normalization = False  # Stream column blocks from memory-mapped matrices instead of fitting in memory
+memory_ceiling_mb = 256  # Upper bound for the column block held in memory by the chunked path
+csv_chunk_rows = 2000  # Rows parsed per CSV chunk when building the memory-mapped matrix
+n_quantiles = 1000
+BOUNDS_THRESHOLD = 1e-7  # Same clipping constant as sklearn's QuantileTransformer
+
+def write_log10_memmap(filename, path, chunk_rows=2000, memory_ceiling_mb=256):
+    """Write log10(x + 1) of the cached intensity matrix into a column-major memory-mapped .npy matrix.
+
+    The CSV is parsed in row chunks into the shared Perseus cache on first use; later runs
+    stream column blocks straight from the cached memory map.
+    """
+    intensities, index, columns = open_perseus_matrix(filename, index_col=0, chunk_rows=chunk_rows)
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                       shape=intensities.shape, fortran_order=True)
+    block_columns = column_block_size(intensities.shape[0], memory_ceiling_mb)
+    for start in range(0, intensities.shape[1], block_columns):
+        matrix[:, start:start + block_columns] = np.log10(intensities[:, start:start + block_columns] + 1)
+    matrix.flush()
+    return matrix, index, columns
+
+def column_block_size(n_rows, memory_ceiling_mb, buffers=4):
+    """Number of float64 columns that fit under the memory ceiling (block, output and temporaries)."""
+    return max(1, int(memory_ceiling_mb * 1024 ** 2) // (n_rows * 8 * buffers))
+
+def fit_quantiles_chunked(matrix, n_quantiles=1000, block_columns=64):
+    """Build the per-column quantile reference incrementally, one column block at a time."""
+    n_quantiles = min(n_quantiles, matrix.shape[0])
+    references = np.linspace(0, 1, n_quantiles)
+    quantiles = np.empty((n_quantiles, matrix.shape[1]))
+    for start in range(0, matrix.shape[1], block_columns):
+        block = np.asarray(matrix[:, start:start + block_columns])
+        quantiles[:, start:start + block_columns] = np.nanpercentile(block, references * 100, axis=0)
+    # Ensure monotonic quantiles, as sklearn does, so interpolation is well defined
+    return references, np.maximum.accumulate(quantiles, axis=0)
+
+def transform_quantiles_chunked(matrix, references, quantiles, out, block_columns=64):
+    """Map each column block onto a normal distribution, mirroring QuantileTransformer.transform."""
+    clip_min = norm.ppf(BOUNDS_THRESHOLD - np.spacing(1))
+    clip_max = norm.ppf(1 - (BOUNDS_THRESHOLD - np.spacing(1)))
+    for start in range(0, matrix.shape[1], block_columns):
+        block = np.array(matrix[:, start:start + block_columns], dtype=np.float64)
+        for j in range(block.shape[1]):
+            column = block[:, j]
+            column_quantiles = quantiles[:, start + j]
+            with np.errstate(invalid='ignore'):
+                lower = column - BOUNDS_THRESHOLD < column_quantiles[0]
+                upper = column + BOUNDS_THRESHOLD > column_quantiles[-1]
+            finite = ~np.isnan(column)
+            # Average of forward and backward interpolation handles repeated quantiles (ties)
+            column[finite] = 0.5 * (np.interp(column[finite], column_quantiles, references)
+                                    - np.interp(-column[finite], -column_quantiles[::-1], -references[::-1]))
+            column[upper] = 1
+            column[lower] = 0
+        with np.errstate(invalid='ignore'):
+            out[:, start:start + block_columns] = np.clip(norm.ppf(block), clip_min, clip_max)
+    return out
+
+if use_chunked_normalization:
+    # Step 2-3: Stream the CSV into a memory-mapped log10 matrix
+    log_matrix, protein_index, sample_columns = write_log10_memmap(filename, 'log10_matrix.npy', csv_chunk_rows,
+                                                                   memory_ceiling_mb)
 
-# Step 4: Quantile normalization to make distributions comparable
-scaler = QuantileTransformer(output_distribution='normal', random_state=0)
-df_normalized = pd.DataFrame(scaler.fit_transform(df), index=df.index, columns=df.columns)
+    # Step 4: Chunked quantile normalization with a bounded column block
+    block_columns = column_block_size(log_matrix.shape[0], memory_ceiling_mb)
+    references, quantiles = fit_quantiles_chunked(log_matrix, n_quantiles, block_columns)
+    normalized_matrix = np.lib.format.open_memmap('normalized_matrix.npy', mode='w+', dtype=np.float64,
+                                                  shape=log_matrix.shape, fortran_order=True)
+    transform_quantiles_chunked(log_matrix, references, quantiles, normalized_matrix, block_columns)
+    df_normalized = pd.DataFrame(normalized_matrix, index=protein_index, columns=sample_columns, copy=False)
+else:
+    # Step 2: Read the CSV file into a DataFrame
+    df = load_perseus_csv(filename, index_col=0)
+
+    # Step 3: Log10 transformation to stabilize variance
+    df = np.log10(df + 1)  # Adding 1 to avoid log(0) issues
+
+    # Step 4: Quantile normalization to make distributions comparable
+    scaler = QuantileTransformer(n_quantiles=n_quantiles, output_distribution='normal', random_state=0)
+    df_normalized = pd.DataFrame(scaler.fit_transform(df), index=df.index, columns=df.columns)
 
 # Step 5: Calculate the mean values for columns with the same prefix (handling replicates)
 column_groups = {}
@@ -36,29 +110,70 @@ mean_df = pd.DataFrame()
 for prefix, columns in column_groups.items():
     mean_df[prefix] = df_normalized[columns].mean(axis=1)
 
-# Step 6: Define control condition and calculate Z-scores for other conditions
-control_condition = '3D,HC'
-control_mean = mean_df[control_condition].mean()
-control_std = mean_df[control_condition].std()
+# Step 6: Define control conditions and calculate Z-scores for all of them in one broadcast
+control_conditions = ['3D,HC']  # Add more (e.g. a 2D culture or the untreated disease group) to compare against each
+mean_matrix = mean_df.to_numpy()
+control_columns = mean_matrix[:, [mean_df.columns.get_loc(control) for control in control_conditions]]
+control_means = np.nanmean(control_columns, axis=0)
+control_stds = np.nanstd(control_columns, axis=0, ddof=1)
+# (controls x proteins x conditions), sharing the single normalized matrix and QuantileTransformer fit
+z_score_matrices = (mean_matrix[np.newaxis, :, :] - control_means[:, np.newaxis, np.newaxis]) / control_stds[:, np.newaxis, np.newaxis]
 
-# Step 7: Categorize proteins based on Z-scores and prepare data for UpSet plot
-upregulated_data = {}
-downregulated_data = {}
+# Step 7: Encode each protein's up/down calls as uint64 bitmasks and count intersections in one pass
 significant_threshold = 1  # Z-score threshold for significance
+min_subset_size = 1  # Drop intersections with fewer proteins than this before plotting
+max_subsets = None  # Keep only the K largest intersections per direction (None keeps all)
+
+def encode_memberships(calls):
+    """Pack a boolean (proteins x conditions) call matrix into one uint64 bitmask per protein."""
+    n_conditions = calls.shape[-1]
+    if n_conditions > 63:
+        raise ValueError(f"At most 63 conditions can be bit-encoded, got {n_conditions}.")
+    bits = np.left_shift(np.uint64(1), np.arange(n_conditions, dtype=np.uint64))
+    return np.bitwise_or.reduce(np.where(calls, bits, np.uint64(0)), axis=-1)
+
+def count_intersections(up_calls, down_calls, min_size=1, top_k=None):
+    """Count exact intersection cardinalities for the up and down calls with a single np.unique.
+
+    The highest bit of each code marks the direction so both analyses share one pass.
+    Returns {'up': (codes, counts), 'down': (codes, counts)} sorted by decreasing cardinality.
+    """
+    direction_bit = np.uint64(1) << np.uint64(63)
+    codes = np.concatenate([encode_memberships(up_calls), encode_memberships(down_calls) | direction_bit])
+    codes = codes[(codes & ~direction_bit) != 0]  # Proteins without any call belong to no set
+    unique_codes, counts = np.unique(codes, return_counts=True)
+
+    intersections = {}
+    for direction, is_down in (('up', False), ('down', True)):
+        selected = ((unique_codes & direction_bit) != 0) == is_down
+        selected &= counts >= min_size
+        direction_codes = unique_codes[selected] & ~direction_bit
+        direction_counts = counts[selected]
+        order = np.argsort(-direction_counts, kind='stable')[:top_k]
+        intersections[direction] = (direction_codes[order], direction_counts[order])
+    return intersections
+
+def intersections_to_series(codes, counts, conditions):
+    """Convert bitmask codes and counts into the boolean-MultiIndex Series expected by UpSet."""
+    bits = np.left_shift(np.uint64(1), np.arange(len(conditions), dtype=np.uint64))
+    memberships = (codes[:, np.newaxis] & bits) != 0
+    index = pd.MultiIndex.from_arrays([memberships[:, i] for i in range(len(conditions))], names=conditions)
+    return pd.Series(counts, index=index, dtype=np.int64)
 
-for column in mean_df.columns:
-    if column != control_condition:
-        z_scores = (mean_df[column] - control_mean) / control_std
-        upregulated_data[column] = set(mean_df.index[z_scores > significant_threshold])
-        downregulated_data[column] = set(mean_df.index[z_scores < -significant_threshold])
+conditions_by_control = {}
+intersections_by_control = {}
+for control, z_score_matrix in zip(control_conditions, z_score_matrices):
+    conditions = sorted(column for column in mean_df.columns if column != control)
+    z_scores = z_score_matrix[:, [mean_df.columns.get_loc(condition) for condition in conditions]]
+    conditions_by_control[control] = conditions
+    intersections_by_control[control] = count_intersections(z_scores > significant_threshold,
+                                                            z_scores < -significant_threshold,
+                                                            min_size=min_subset_size, top_k=max_subsets)
 
 # Step 8: Plot UpSet plots for proteins with increased and decreased expressions compared to control
 def plot_upset(data, title, bar_color, filename):
-    if any(len(d) > 0 for d in data.values()):
-        keys_sorted = sorted(data.keys())
-        sorted_data = {key: data[key] for key in keys_sorted}
-        upset_data = from_contents(sorted_data)
-        upset_plot = UpSet(upset_data, show_counts='%d', element_size=50, sort_categories_by=None, sort_by='cardinality')
+    if not data.empty:
+        upset_plot = UpSet(data, show_counts='%d', element_size=50, sort_categories_by=None, sort_by='cardinality')
         axes = upset_plot.plot()
         for bar in axes['intersections'].patches:
             bar.set_facecolor(bar_color)  # Color the vertical bars
@@ -69,18 +184,126 @@ def plot_upset(data, title, bar_color, filename):
         plt.ylabel('Number of Proteins', fontsize=label_fontsize)
         plt.savefig(filename, format='svg')
         plt.show()
+        return True
     else:
         print(f"No significant {title.lower()} found.")
+        return False
 
 # Font size settings
 title_fontsize = 20
 label_fontsize = 18
 tick_fontsize = 16
 
-# Plot and save the UpSet plots as SVG files
-plot_upset(upregulated_data, 'General Increase in Expression Relative to Control', 'darkred', 'upregulated.svg')
-plot_upset(downregulated_data, 'General Decrease in Expression Relative to Control', 'darkblue', 'downregulated.svg')
+def control_suffix(control):
+    """File name suffix per control; a single control keeps the original file names."""
+    if len(control_conditions) == 1:
+        return ''
+    return '_' + re.sub(r'[^\w\-]', '_', control)
+
+# Plot and save one pair of UpSet plots per control as SVG files
+output_files = []
+for control in control_conditions:
+    conditions = conditions_by_control[control]
+    intersections = intersections_by_control[control]
+    control_label = 'Control' if len(control_conditions) == 1 else control
+    suffix = control_suffix(control)
+    if plot_upset(intersections_to_series(*intersections['up'], conditions),
+                  f'General Increase in Expression Relative to {control_label}', 'darkred', f'upregulated{suffix}.svg'):
+        output_files.append(f'upregulated{suffix}.svg')
+    if plot_upset(intersections_to_series(*intersections['down'], conditions),
+                  f'General Decrease in Expression Relative to {control_label}', 'darkblue', f'downregulated{suffix}.svg'):
+        output_files.append(f'downregulated{suffix}.svg')
+
+# Step 9: Optional replicate-resampling stability of the membership calls
+run_stability_analysis = False  # Set to True to redraw replicate columns and report call stability
+n_resamples = 1000
+resample_seed = 0
+resample_batch_size = 100  # Resamples evaluated per vectorized batch (bounds memory)
+confidence_level = 95
+
+def resample_condition_means(values, n_draws, rng):
+    """Redraw replicate columns with replacement and return the (proteins x draws) condition means.
+
+    Each draw is expressed as replicate weights so all draws reduce to one matrix product.
+    """
+    n_replicates = values.shape[1]
+    draws = rng.integers(0, n_replicates, size=(n_draws, n_replicates))
+    weights = (draws[:, :, np.newaxis] == np.arange(n_replicates)).sum(axis=1) / n_replicates
+    return values @ weights.T
+
+def intersection_labels(codes, conditions):
+    bits = np.left_shift(np.uint64(1), np.arange(len(conditions), dtype=np.uint64))
+    return [' & '.join(c for c, bit in zip(conditions, bits) if code & bit) for code in codes]
+
+def resample_membership_stability(normalized_df, column_groups, conditions, control, threshold, intersections,
+                                  n_resamples=1000, batch_size=100, seed=0, confidence=95):
+    """Estimate how stable the up/down calls and their intersections are under replicate resampling.
+
+    Replicate columns are redrawn within every condition (including the control) using one seeded
+    generator; the control mean/SD and the z-score calls are recomputed for each resample.
+    Returns a per-protein call frequency table and per-intersection confidence intervals.
+    """
+    rng = np.random.default_rng(seed)
+    groups = conditions + [control]
+    values = {group: normalized_df[column_groups[group]].to_numpy(dtype=np.float64) for group in groups}
+    n_proteins = len(normalized_df)
+
+    call_counts = {'up': np.zeros((n_proteins, len(conditions))), 'down': np.zeros((n_proteins, len(conditions)))}
+    observed_keys = {direction: np.sort(codes) for direction, (codes, _) in intersections.items()}
+    resampled_sizes = {direction: [] for direction in intersections}
+
+    for start in range(0, n_resamples, batch_size):
+        n_draws = min(batch_size, n_resamples - start)
+        means = {group: resample_condition_means(values[group], n_draws, rng) for group in groups}
+        control_means = means[control]
+        resampled_mean = control_means.mean(axis=0)
+        resampled_std = control_means.std(axis=0, ddof=1)
+        # (proteins x draws x conditions)
+        z = (np.stack([means[c] for c in conditions], axis=-1) - resampled_mean[:, np.newaxis]) / resampled_std[:, np.newaxis]
+
+        for direction, calls in (('up', z > threshold), ('down', z < -threshold)):
+            call_counts[direction] += calls.sum(axis=1)
+            keys = observed_keys[direction]
+            if len(keys) == 0:
+                continue
+            codes = encode_memberships(calls)
+            positions = np.minimum(np.searchsorted(keys, codes), len(keys) - 1)
+            matched = keys[positions] == codes
+            draw_index = np.broadcast_to(np.arange(n_draws), codes.shape)
+            flat = (draw_index * len(keys) + positions)[matched]
+            resampled_sizes[direction].append(np.bincount(flat, minlength=n_draws * len(keys)).reshape(n_draws, len(keys)))
+
+    frequency_df = pd.DataFrame(
+        np.hstack([call_counts['up'], call_counts['down']]) / n_resamples,
+        index=normalized_df.index,
+        columns=[f'{c} Up Frequency' for c in conditions] + [f'{c} Down Frequency' for c in conditions]
+    )
+
+    tail = (100 - confidence) / 2
+    rows = []
+    for direction, (codes, counts) in intersections.items():
+        if len(codes) == 0:
+            continue
+        sizes = np.vstack(resampled_sizes[direction])[:, np.searchsorted(observed_keys[direction], codes)]
+        lower, upper = np.percentile(sizes, [tail, 100 - tail], axis=0)
+        for label, observed, mean, lo, hi in zip(intersection_labels(codes, conditions), counts,
+                                                 sizes.mean(axis=0), lower, upper):
+            rows.append({'Direction': direction, 'Intersection': label, 'Observed Size': observed,
+                         'Resampled Mean Size': mean, 'CI Lower': lo, 'CI Upper': hi})
+    return frequency_df, pd.DataFrame(rows)
+
+if run_stability_analysis:
+    for control in control_conditions:
+        suffix = control_suffix(control)
+        call_frequency_df, intersection_ci_df = resample_membership_stability(
+            df_normalized, column_groups, conditions_by_control[control], control, significant_threshold,
+            intersections_by_control[control], n_resamples=n_resamples, batch_size=resample_batch_size,
+            seed=resample_seed, confidence=confidence_level
+        )
+        call_frequency_df.to_csv(f'protein_call_frequency{suffix}.csv')
+        intersection_ci_df.to_csv(f'intersection_stability{suffix}.csv', index=False)
+        output_files += [f'protein_call_frequency{suffix}.csv', f'intersection_stability{suffix}.csv']
 
-# Download the SVG files
-files.download('upregulated.svg')
-files.download('downregulated.svg')
+# Download the output files
+for output_file in output_files:
+    files.download(output_file)
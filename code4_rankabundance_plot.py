@@ -4,7 +4,7 @@ import re
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-from scipy.stats import entropy
+from perseus_cache import load_perseus_csv
 
 def upload_files():
     """Prompt user to upload CSV files and return the list of filenames."""
@@ -14,7 +14,7 @@ def upload_files():
 
 def process_data(filename):
     """Read the CSV file, extract condition groups based on column names."""
-    df = pd.read_csv(filename, index_col=0)
+    df = load_perseus_csv(filename, index_col=0)
     # Extract unique prefixes and group columns accordingly
     column_groups = {}
     for col in df.columns:
@@ -25,18 +25,117 @@ def process_data(filename):
             column_groups[prefix] = [col]
     return df, column_groups
 
-def calculate_shannon_diversity(df, column_groups):
-    """Calculate Shannon Diversity Index for each condition."""
-    shannon_diversity = {}
-    for prefix, columns in column_groups.items():
-        condition_data = df[columns].mean(axis=1)
-        condition_data = condition_data[condition_data > 0]  # Remove zero values to avoid log(0)
-        if len(condition_data) > 0:
-            proportions = condition_data / condition_data.sum()
-            shannon_diversity[prefix] = entropy(proportions)
-        else:
-            shannon_diversity[prefix] = 0  # If all values are zero, set Shannon diversity to 0
-    return shannon_diversity
+DIVERSITY_METRICS = ['Shannon Diversity Index', 'Simpson Diversity Index', 'Pielou Evenness',
+                     'Hill Number q0 (Richness)', 'Hill Number q1', 'Hill Number q2']
+
+def replicate_mean(values, weights):
+    """Weighted replicate mean that skips NaNs like DataFrame.mean; weights is (draws x replicates)."""
+    finite = np.isfinite(values)
+    total = np.where(finite, values, 0) @ weights.T
+    count = finite.astype(float) @ weights.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+def diversity_metrics(abundances, multiplicity=None):
+    """Compute all diversity metrics along the last axis (proteins) of an abundance array.
+
+    multiplicity optionally gives how often each protein was drawn (protein bootstrap), so resampled
+    communities are evaluated without materializing duplicated rows. Non-positive and missing
+    abundances are ignored, matching the original Shannon calculation.
+    """
+    abundances = np.where(np.nan_to_num(abundances) > 0, np.nan_to_num(abundances), 0)
+    if multiplicity is None:
+        multiplicity = np.ones_like(abundances)
+    weighted = multiplicity * abundances
+    total = weighted.sum(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        proportions = np.where(total > 0, abundances / total, 0)
+        log_proportions = np.where(proportions > 0, np.log(proportions), 0)
+    shannon = -(multiplicity * proportions * log_proportions).sum(axis=-1)
+    sum_squares = (multiplicity * proportions ** 2).sum(axis=-1)
+    richness = (multiplicity * (abundances > 0)).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pielou = np.where(richness > 1, shannon / np.log(richness), np.nan)
+        hill_2 = np.where(sum_squares > 0, 1 / sum_squares, 0)
+    return dict(zip(DIVERSITY_METRICS, [
+        shannon,
+        np.where(sum_squares > 0, 1 - sum_squares, 0),
+        pielou,
+        richness,
+        np.where(richness > 0, np.exp(shannon), 0),
+        hill_2
+    ]))
+
+def build_abundance_matrix(datasets):
+    """Stack the replicate-mean abundances of every condition of every file into one zero-padded matrix.
+
+    Returns the (file, condition) labels and a (columns x proteins) matrix; padding with zeros leaves
+    every metric unchanged because zero abundances are ignored.
+    """
+    labels = []
+    columns = []
+    for filename, (df, column_groups) in datasets.items():
+        for prefix, group_columns in column_groups.items():
+            labels.append((filename, prefix))
+            columns.append(df[group_columns].mean(axis=1).to_numpy(dtype=np.float64))
+    matrix = np.zeros((len(columns), max(len(column) for column in columns)))
+    for i, column in enumerate(columns):
+        matrix[i, :len(column)] = column
+    return labels, matrix
+
+def bootstrap_diversity(df, column_groups, n_bootstrap=1000, batch_size=100, rng=None):
+    """Bootstrap every metric over proteins and replicates for all conditions of one file.
+
+    Each batch draws protein multiplicities and replicate weights as arrays, so a batch of resamples is
+    evaluated with matrix products instead of per-resample loops. Returns {metric: (conditions x draws)}.
+    """
+    rng = np.random.default_rng(0) if rng is None else rng
+    n_proteins = len(df)
+    values = [df[columns].to_numpy(dtype=np.float64) for columns in column_groups.values()]
+    draws = {metric: [] for metric in DIVERSITY_METRICS}
+
+    for start in range(0, n_bootstrap, batch_size):
+        n_draws = min(batch_size, n_bootstrap - start)
+        protein_draws = rng.integers(0, n_proteins, size=(n_draws, n_proteins))
+        offsets = (np.arange(n_draws) * n_proteins)[:, np.newaxis]
+        multiplicity = np.bincount((protein_draws + offsets).ravel(),
+                                   minlength=n_draws * n_proteins).reshape(n_draws, n_proteins)
+
+        condition_means = []
+        for condition_values in values:
+            n_replicates = condition_values.shape[1]
+            replicate_draws = rng.integers(0, n_replicates, size=(n_draws, n_replicates))
+            weights = (replicate_draws[:, :, np.newaxis] == np.arange(n_replicates)).sum(axis=1)
+            condition_means.append(replicate_mean(condition_values, weights).T)
+
+        # (conditions x draws x proteins) evaluated in one call
+        metrics = diversity_metrics(np.stack(condition_means), multiplicity[np.newaxis])
+        for metric, value in metrics.items():
+            draws[metric].append(value)
+
+    return {metric: np.concatenate(values, axis=1) for metric, values in draws.items()}
+
+def calculate_diversity_table(datasets, n_bootstrap=1000, confidence=95, seed=0):
+    """Compute every diversity metric with bootstrap confidence intervals for all files and conditions."""
+    labels, matrix = build_abundance_matrix(datasets)
+    point_estimates = diversity_metrics(matrix)
+    table = pd.DataFrame(labels, columns=['File', 'Condition'])
+    for metric, values in point_estimates.items():
+        table[metric] = values
+
+    if n_bootstrap:
+        rng = np.random.default_rng(seed)
+        tail = (100 - confidence) / 2
+        intervals = {metric: [] for metric in DIVERSITY_METRICS}
+        for df, column_groups in datasets.values():
+            draws = bootstrap_diversity(df, column_groups, n_bootstrap, rng=rng)
+            for metric, values in draws.items():
+                intervals[metric].append(np.nanpercentile(values, [tail, 100 - tail], axis=1).T)
+        for metric in DIVERSITY_METRICS:
+            lower, upper = np.vstack(intervals[metric]).T
+            table[f'{metric} CI Lower'] = lower
+            table[f'{metric} CI Upper'] = upper
+    return table
 
 def plot_log_transformed_histogram(df, column_groups, filename):
     """Plot log-transformed abundance histograms for each condition."""
@@ -61,17 +160,78 @@ def plot_log_transformed_histogram(df, column_groups, filename):
 
     return hist_path
 
-def plot_combined_with_heatmap(df, column_groups, shannon_diversity, filename):
-    """Plot rank-abundance plot combined with Shannon Diversity Index heatmap."""
+def largest_triangle_three_buckets(x, y, n_out):
+    """Return the indices kept by largest-triangle-three-buckets downsampling of a curve.
+
+    Interior points are split into n_out - 2 buckets and each bucket keeps the point forming the largest
+    triangle with the neighbouring bucket averages; the first and last points are always kept. Using the
+    previous bucket's average instead of its selected point makes all buckets independent, so the
+    selection is computed in one vectorized pass.
+    """
+    n = len(x)
+    if n_out < 3 or n <= n_out:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    sizes = np.diff(edges)
+    bucket = np.repeat(np.arange(n_out - 2), sizes)
+    mean_x = np.add.reduceat(x[1:-1], edges[:-1] - 1) / sizes
+    mean_y = np.add.reduceat(y[1:-1], edges[:-1] - 1) / sizes
+
+    prev_x = np.concatenate([x[:1], mean_x[:-1]])[bucket]
+    prev_y = np.concatenate([y[:1], mean_y[:-1]])[bucket]
+    next_x = np.concatenate([mean_x[1:], x[-1:]])[bucket]
+    next_y = np.concatenate([mean_y[1:], y[-1:]])[bucket]
+    area = np.abs((prev_x - next_x) * (y[1:-1] - prev_y) - (prev_x - x[1:-1]) * (next_y - prev_y))
+
+    # Buckets are contiguous, so after sorting by (bucket, -area) each bucket starts at its edge offset
+    order = np.lexsort((-area, bucket))
+    selected = 1 + order[edges[:-1] - 1]
+    return np.concatenate([[0], selected, [n - 1]])
+
+def rank_abundance_curves(df, column_groups):
+    """Sorted (descending) positive replicate-mean abundances for each condition."""
+    curves = {}
+    for prefix, columns in column_groups.items():
+        condition_data = df[columns].mean(axis=1).sort_values(ascending=False)
+        curves[prefix] = condition_data[condition_data > 0]  # Remove zero values to avoid log(0)
+    return curves
+
+def save_rank_abundance_table(df, column_groups, filename):
+    """Save the full-resolution rank-abundance curves as a sidecar table for the (downsampled) figure."""
+    tables = []
+    for prefix, condition_data in rank_abundance_curves(df, column_groups).items():
+        tables.append(pd.DataFrame({
+            'Condition': prefix,
+            'Rank': np.arange(1, len(condition_data) + 1),
+            'Protein': condition_data.index,
+            'Mean Abundance': condition_data.to_numpy(),
+            'log10(Mean Abundance)': np.log10(condition_data.to_numpy())
+        }))
+    table_path = f'Rank_Abundance_{filename}.csv'
+    pd.concat(tables, ignore_index=True).to_csv(table_path, index=False)
+    return table_path
+
+def plot_combined_with_heatmap(df, column_groups, shannon_diversity, filename, max_points=None):
+    """Plot rank-abundance plot combined with Shannon Diversity Index heatmap.
+
+    When max_points is set, each condition's curve is simplified to at most that many points with
+    largest-triangle-three-buckets; the full-resolution curves belong in the sidecar table.
+    """
     fig, ax1 = plt.subplots(figsize=(10, 8))  # Combined plot format
 
     # Rank-Abundance Plot
     custom_colors = ['#1f77b4', '#ffdf01', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
     colors = custom_colors[:len(column_groups)]  # Adjust number of colors based on number of conditions
-    for (prefix, columns), color in zip(column_groups.items(), colors):
-        condition_data = df[columns].mean(axis=1).sort_values(ascending=False)
-        condition_data = condition_data[condition_data > 0]  # Remove zero values to avoid log(0)
-        ax1.scatter(range(1, len(condition_data) + 1), np.log10(condition_data), label=prefix, color=color, alpha=0.6, edgecolors='none')
+    for (prefix, condition_data), color in zip(rank_abundance_curves(df, column_groups).items(), colors):
+        ranks = np.arange(1, len(condition_data) + 1)
+        log_abundance = np.log10(condition_data.to_numpy())
+        if max_points:
+            kept = largest_triangle_three_buckets(ranks, log_abundance, max_points)
+            ranks, log_abundance = ranks[kept], log_abundance[kept]
+        ax1.scatter(ranks, log_abundance, label=prefix, color=color, alpha=0.6, edgecolors='none')
     ax1.set_title(f'Rank-Abundance Plot for {filename}', fontsize=12)
     ax1.set_xlabel('Rank', fontsize=10)
     ax1.set_ylabel('log10(Mean Protein Abundance)', fontsize=10)
@@ -99,32 +259,39 @@ def plot_combined_with_heatmap(df, column_groups, shannon_diversity, filename):
 
     return combined_plot_path
 
-def save_shannon_diversity(shannon_diversity, filename):
-    """Save Shannon Diversity Index to a CSV file."""
-    diversity_df = pd.DataFrame(list(shannon_diversity.items()), columns=['Condition', 'Shannon Diversity Index'])
-    diversity_path = f'Shannon_Diversity_{filename}.csv'
-    diversity_df.to_csv(diversity_path, index=False)
+def save_diversity_table(diversity_table):
+    """Save the diversity metrics of all files to a single CSV file."""
+    diversity_path = 'Diversity_Metrics.csv'
+    diversity_table.to_csv(diversity_path, index=False)
     return diversity_path
 
 def main():
     """Main function to handle file upload, processing, and plotting."""
     filenames = upload_files()
-    for filename in filenames:
-        df, column_groups = process_data(filename)
+    datasets = {filename: process_data(filename) for filename in filenames}
+
+    # Calculate all diversity metrics for every file and condition at once
+    diversity_table = calculate_diversity_table(datasets, n_bootstrap=1000, confidence=95, seed=0)
 
+    for filename, (df, column_groups) in datasets.items():
         # Plot log-transformed histograms to check log-normal distribution assumption
         hist_path = plot_log_transformed_histogram(df, column_groups, filename)
         files.download(hist_path)
 
-        # Calculate Shannon Diversity
-        shannon_diversity = calculate_shannon_diversity(df, column_groups)
+        file_diversity = diversity_table[diversity_table['File'] == filename]
+        shannon_diversity = dict(zip(file_diversity['Condition'], file_diversity['Shannon Diversity Index']))
 
-        # Plot combined figure with heatmap
-        combined_plot_path = plot_combined_with_heatmap(df, column_groups, shannon_diversity, filename)
+        # Plot combined figure with heatmap, simplifying each curve to a bounded number of points
+        combined_plot_path = plot_combined_with_heatmap(df, column_groups, shannon_diversity, filename,
+                                                        max_points=1000)
         files.download(combined_plot_path)
 
-        # Save Shannon Diversity Index
-        diversity_path = save_shannon_diversity(shannon_diversity, filename)
-        files.download(diversity_path)
+        # Save the full-resolution rank-abundance data alongside the figure
+        rank_table_path = save_rank_abundance_table(df, column_groups, filename)
+        files.download(rank_table_path)
+
+    # Save diversity metrics of all files to one table
+    diversity_path = save_diversity_table(diversity_table)
+    files.download(diversity_path)
 
 main()
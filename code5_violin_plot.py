@@ -4,32 +4,92 @@ import seaborn as sns
 import numpy as np
 from google.colab import files
 import os
-from scipy.stats import ttest_ind, mannwhitneyu, shapiro, levene
+from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+from scipy.stats import mannwhitneyu, shapiro, norm, rankdata
+from scipy.stats import f as f_dist, t as t_dist
+from scipy.signal import fftconvolve
 from statsmodels.stats.multitest import multipletests
 from matplotlib.ticker import FixedFormatter
+from perseus_cache import load_perseus_csv
+
+# Bootstrap CIs and permutation p-values for Cliff's delta, Cohen's d and the median shift of every pair
+# (effect_size_results.csv). Off by default: on one core each pair costs about 1.6 s per 1000 resamples at
+# 10k proteins per file, so 10000 resamples over 15 pairs add several minutes to the plotting run.
+compute_effect_sizes_enabled = False
+effect_size_resamples = 10000
+effect_size_seed = 0
 
 def upload_files():
     print("Uploading files...")
     return files.upload()
 
-def create_combined_violin_plot(dfs, names, figsize=(12, 5)):
-    plt.figure(figsize=figsize)
-    all_differences = []
-    all_comparisons = []
+def binned_kde(samples, grid_size=1024, cut=2):
+    """Gaussian KDEs of several samples on one shared grid using linear binning and FFT convolution.
+
+    Bandwidths follow Scott's rule, as seaborn's violins do. All samples are binned with a single
+    bincount and convolved with their own kernels in one FFT call, so the cost is O(n + grid log grid)
+    per sample instead of O(n * grid). Densities outside each sample's [min, max] +/- cut * bandwidth
+    are set to zero. Returns the grid and a (samples x grid) density array.
+    """
+    samples = [np.asarray(sample, dtype=np.float64) for sample in samples]
+    samples = [sample[np.isfinite(sample)] for sample in samples]
+    sizes = np.array([len(sample) for sample in samples])
+    bandwidths = np.array([sample.std(ddof=1) * len(sample) ** (-1 / 5) if len(sample) > 1 else 0.0
+                           for sample in samples])
+    minima = np.array([sample.min() for sample in samples])
+    maxima = np.array([sample.max() for sample in samples])
+
+    lower = np.min(minima - cut * bandwidths)
+    upper = np.max(maxima + cut * bandwidths)
+    grid = np.linspace(lower, upper, grid_size)
+    delta = grid[1] - grid[0]
+    bandwidths = np.maximum(bandwidths, delta)  # Degenerate samples collapse onto a one-bin kernel
+
+    # Linear binning of every sample in one pass
+    values = np.concatenate(samples)
+    sample_ids = np.repeat(np.arange(len(samples)), sizes)
+    position = (values - lower) / delta
+    left = np.clip(np.floor(position).astype(int), 0, grid_size - 2)
+    fraction = position - left
+    keys = sample_ids * grid_size + left
+    binned = (np.bincount(keys, weights=1 - fraction, minlength=len(samples) * grid_size)
+              + np.bincount(keys + 1, weights=fraction, minlength=len(samples) * grid_size))
+    binned = binned.reshape(len(samples), grid_size)
 
-    for df, name in zip(dfs, names):
-        log2_fold_changes = df['Difference']
-        all_differences.extend(log2_fold_changes)
-        all_comparisons.extend([name] * len(df))
+    # One Gaussian kernel per sample, padded to a common odd length
+    half_width = min(grid_size - 1, int(np.ceil(4 * bandwidths.max() / delta)))
+    offsets = np.arange(-half_width, half_width + 1) * delta
+    kernels = np.exp(-0.5 * (offsets / bandwidths[:, np.newaxis]) ** 2) / (np.sqrt(2 * np.pi) * bandwidths[:, np.newaxis])
+    densities = fftconvolve(binned, kernels, mode='same', axes=1) / sizes[:, np.newaxis]
 
-    formatted_comparisons = [name.replace(' vs ', '\nvs\n').replace(' ', '\n') for name in all_comparisons]
+    support = ((grid >= (minima - cut * bandwidths)[:, np.newaxis]) &
+               (grid <= (maxima + cut * bandwidths)[:, np.newaxis]))
+    return grid, np.where(support, np.maximum(densities, 0), 0)
+
+def create_combined_violin_plot(dfs, names, figsize=(12, 5), grid_size=1024):
+    formatted_names = [name.replace(' vs ', '\nvs\n').replace(' ', '\n') for name in names]
+    differences = [df['Difference'].to_numpy(dtype=np.float64) for df in dfs]
 
     combined_df = pd.DataFrame({
-        'Comparison': formatted_comparisons,
-        'Log2 Fold Change': all_differences
+        'Comparison': np.repeat(formatted_names, [len(values) for values in differences]),
+        'Log2 Fold Change': np.concatenate(differences)
     })
 
-    sns.violinplot(x='Comparison', y='Log2 Fold Change', data=combined_df, palette='Set2', inner=None)
+    # Precompute densities and draw each violin from them (equal area, like seaborn's default)
+    grid, densities = binned_kde(differences, grid_size=grid_size)
+    half_widths = 0.4 * densities / densities.max()
+    colors = sns.color_palette('Set2', len(dfs))
+
+    plt.figure(figsize=figsize)
+    ax = plt.gca()
+    for position, (half_width, color) in enumerate(zip(half_widths, colors)):
+        inside = half_width > 0
+        ax.fill_betweenx(grid[inside], position - half_width[inside], position + half_width[inside],
+                         facecolor=color, edgecolor='0.25', linewidth=1, zorder=2)
+    ax.set_xticks(range(len(dfs)))
+    ax.set_xticklabels(formatted_names)
+    ax.set_xlim(-0.5, len(dfs) - 0.5)
     plt.xticks(rotation=0, ha='center', fontsize=12)
     plt.yticks([-40, -20, 0, 20, 40], fontsize=12)
     plt.ylabel('Log2 Fold Change', fontsize=14)
@@ -42,53 +102,260 @@ def create_combined_violin_plot(dfs, names, figsize=(12, 5)):
     plt.savefig(plot_path)
     plt.show()
 
-    return combined_df, plot_path
-
-def perform_statistical_analysis(dfs, names):
-    results = []
-    for i in range(len(dfs)):
-        for j in range(i + 1, len(dfs)):
-            differences_i = dfs[i]['Difference']
-            differences_j = dfs[j]['Difference']
-
-            # Normality tests
-            stat_i, p_value_i = shapiro(differences_i)
-            stat_j, p_value_j = shapiro(differences_j)
-            normal_i = p_value_i > 0.05
-            normal_j = p_value_j > 0.05
-
-            # Variance homogeneity test
-            stat, p_value_levene = levene(differences_i, differences_j)
-            equal_var = p_value_levene > 0.05
-
-            # Decide which test to use
-            if normal_i and normal_j and equal_var:
-                t_stat, p_value = ttest_ind(differences_i, differences_j, equal_var=True)
-                test_used = 't-test'
-            elif normal_i and normal_j:
-                t_stat, p_value = ttest_ind(differences_i, differences_j, equal_var=False)
-                test_used = 'Welch\'s t-test'
-            else:
-                u_stat, p_value = mannwhitneyu(differences_i, differences_j)
-                test_used = 'Mann-Whitney U'
-
-            results.append({
-                'Comparison 1': names[i],
-                'Comparison 2': names[j],
-                'Test Used': test_used,
-                't Statistic': t_stat if test_used != 'Mann-Whitney U' else 'N/A',
-                'U Statistic': u_stat if test_used == 'Mann-Whitney U' else 'N/A',
-                'p-value': p_value
-            })
+    # Export the densities the violins were drawn from
+    inside = densities > 0
+    density_df = pd.DataFrame({
+        'Comparison': np.repeat(names, inside.sum(axis=1)),
+        'Log2 Fold Change': np.broadcast_to(grid, densities.shape)[inside],
+        'Density': densities[inside]
+    })
+    density_path = 'Combined_Violin_Densities.csv'
+    density_df.to_csv(density_path, index=False)
+
+    return combined_df, plot_path, density_path
+
+def compute_comparison_diagnostics(differences):
+    """Compute once the pieces of one comparison that every pairwise test reuses.
+
+    Includes the Shapiro-Wilk normality test, moments, the absolute deviations from the median
+    (Brown-Forsythe/Levene), the sorted values and the tie counts (Mann-Whitney ranks).
+    """
+    values = np.asarray(differences, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    sorted_values = np.sort(values)
+    unique_values, tie_counts = np.unique(sorted_values, return_counts=True)
+    deviations = np.abs(values - np.median(values))
+    _, shapiro_p = shapiro(values)
+    return {
+        'n': len(values),
+        'mean': values.mean(),
+        'var': values.var(ddof=1),
+        'shapiro_p': shapiro_p,
+        'normal': shapiro_p > 0.05,
+        'deviation_mean': deviations.mean(),
+        'deviation_var': deviations.var(ddof=1),
+        'sorted': sorted_values,
+        'unique': unique_values,
+        'tie_counts': tie_counts
+    }
+
+def levene_from_diagnostics(d1, d2):
+    """Levene's test (median-centred, as scipy's default) from cached deviation moments."""
+    n1, n2 = d1['n'], d2['n']
+    total = n1 + n2
+    grand_mean = (n1 * d1['deviation_mean'] + n2 * d2['deviation_mean']) / total
+    between = n1 * (d1['deviation_mean'] - grand_mean) ** 2 + n2 * (d2['deviation_mean'] - grand_mean) ** 2
+    within = (n1 - 1) * d1['deviation_var'] + (n2 - 1) * d2['deviation_var']
+    w_stat = (total - 2) * between / within
+    return w_stat, f_dist.sf(w_stat, 1, total - 2)
+
+def ttest_from_diagnostics(d1, d2, equal_var):
+    """Student's or Welch's two-sided t-test from cached means and variances."""
+    n1, n2 = d1['n'], d2['n']
+    if equal_var:
+        dof = n1 + n2 - 2
+        pooled_var = ((n1 - 1) * d1['var'] + (n2 - 1) * d2['var']) / dof
+        standard_error = np.sqrt(pooled_var * (1 / n1 + 1 / n2))
+    else:
+        var1, var2 = d1['var'] / n1, d2['var'] / n2
+        dof = (var1 + var2) ** 2 / (var1 ** 2 / (n1 - 1) + var2 ** 2 / (n2 - 1))
+        standard_error = np.sqrt(var1 + var2)
+    t_stat = (d1['mean'] - d2['mean']) / standard_error
+    return t_stat, 2 * t_dist.sf(np.abs(t_stat), dof)
+
+def mannwhitney_from_diagnostics(d1, d2):
+    """Two-sided Mann-Whitney U test from cached sorted values and tie counts.
+
+    Uses the tie-corrected normal approximation with continuity correction, as scipy does for
+    samples this size; tie-free pairs with a small sample fall back to scipy's exact test.
+    """
+    n1, n2 = d1['n'], d2['n']
+    has_ties = len(d1['unique']) < n1 or len(d2['unique']) < n2 or np.intersect1d(d1['unique'], d2['unique']).size > 0
+    if (n1 <= 8 or n2 <= 8) and not has_ties:
+        return mannwhitneyu(d1['sorted'], d2['sorted'])
+
+    below = np.searchsorted(d2['sorted'], d1['sorted'], side='left')
+    below_or_equal = np.searchsorted(d2['sorted'], d1['sorted'], side='right')
+    u_stat = np.sum(below + 0.5 * (below_or_equal - below))
+
+    merged_values, inverse = np.unique(np.concatenate([d1['unique'], d2['unique']]), return_inverse=True)
+    merged_ties = np.bincount(inverse, weights=np.concatenate([d1['tie_counts'], d2['tie_counts']]))
+    n = n1 + n2
+    tie_term = np.sum(merged_ties ** 3 - merged_ties)
+    sigma = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    z = (max(u_stat, n1 * n2 - u_stat) - n1 * n2 / 2 - 0.5) / sigma
+    return u_stat, min(1.0, 2 * norm.sf(z))
+
+def compare_pair(name_i, name_j, d1, d2):
+    """Select and run the appropriate test for one pair using cached diagnostics."""
+    _, p_value_levene = levene_from_diagnostics(d1, d2)
+    equal_var = p_value_levene > 0.05
+
+    # Decide which test to use
+    if d1['normal'] and d2['normal']:
+        t_stat, p_value = ttest_from_diagnostics(d1, d2, equal_var)
+        test_used = 't-test' if equal_var else 'Welch\'s t-test'
+        u_stat = 'N/A'
+    else:
+        u_stat, p_value = mannwhitney_from_diagnostics(d1, d2)
+        test_used = 'Mann-Whitney U'
+        t_stat = 'N/A'
+
+    return {
+        'Comparison 1': name_i,
+        'Comparison 2': name_j,
+        'Test Used': test_used,
+        't Statistic': t_stat,
+        'U Statistic': u_stat,
+        'Shapiro p-value 1': d1['shapiro_p'],
+        'Shapiro p-value 2': d2['shapiro_p'],
+        'Levene p-value': p_value_levene,
+        'p-value': p_value
+    }
+
+def perform_statistical_analysis(dfs, names, max_workers=None):
+    """Run all k(k-1)/2 pairwise tests from per-comparison diagnostics computed once, in parallel."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        diagnostics = list(executor.map(compute_comparison_diagnostics, [df['Difference'] for df in dfs]))
+        pairs = list(combinations(range(len(dfs)), 2))
+        results = list(executor.map(lambda pair: compare_pair(names[pair[0]], names[pair[1]],
+                                                               diagnostics[pair[0]], diagnostics[pair[1]]), pairs))
 
     results_df = pd.DataFrame(results)
+    if results_df.empty:
+        return results_df
 
     # Multiple testing correction
-    corrected_pvals = multipletests(results_df['p-value'], method='fdr_bh')[1]
-    results_df['Adjusted p-value'] = corrected_pvals
+    results_df['Adjusted p-value'] = multipletests(results_df['p-value'], method='fdr_bh')[1]
 
     return results_df
 
+EFFECT_SIZES = ["Cliff's Delta", "Cohen's d", 'Median Shift']
+
+def draw_bootstrap_counts(n, n_draws, rng, offsets):
+    """Draw resampling multiplicities (draws x n) from the shared RNG stream with one bincount."""
+    indices = rng.integers(0, n, size=(n_draws, n), dtype=np.int64)
+    indices += offsets[:n_draws]
+    return np.bincount(indices.ravel(), minlength=n_draws * n).reshape(n_draws, n).astype(np.float64)
+
+def sorted_median(sorted_values, flat_cumulative, n):
+    """Medians of weighted samples over sorted values, one sample per row.
+
+    flat_cumulative is the running multiplicity over all rows flattened; every row holds exactly n
+    items, so row r spans r * n + 1 ... (r + 1) * n and the middle items are found with one
+    searchsorted instead of scanning each row.
+    """
+    row_length = len(sorted_values)
+    n_rows = len(flat_cumulative) // row_length
+    row_offsets = np.arange(n_rows) * n
+    row_starts = np.arange(n_rows) * row_length
+    lower = np.searchsorted(flat_cumulative, row_offsets + (n + 1) // 2) - row_starts
+    upper = np.searchsorted(flat_cumulative, row_offsets + n // 2 + 1) - row_starts
+    return 0.5 * (sorted_values[lower] + sorted_values[upper])
+
+def effect_sizes_from_sums(n1, n2, sum1, sum2, sum_sq1, sum_sq2, u_stat, median1, median2):
+    """Cliff's delta, Cohen's d (pooled SD) and median shift from per-group sums; works on arrays."""
+    mean1, mean2 = sum1 / n1, sum2 / n2
+    pooled_var = ((sum_sq1 - n1 * mean1 ** 2) + (sum_sq2 - n2 * mean2 ** 2)) / (n1 + n2 - 2)
+    cliffs_delta = 2 * u_stat / (n1 * n2) - 1
+    cohens_d = (mean1 - mean2) / np.sqrt(pooled_var)
+    return cliffs_delta, cohens_d, median1 - median2
+
+def resample_effect_sizes(x, y, n_resamples, rng, batch_size=256):
+    """Observed effect sizes, bootstrap distributions and permutation distributions for one pair.
+
+    Bootstrap draws are multiplicity matrices over the sorted samples, so Cliff's delta reduces to a
+    cumulative sum and a gather at precomputed searchsorted positions. Permutations shuffle a
+    preallocated label matrix in place and use midranks of the pooled sorted sample.
+    """
+    x = np.sort(np.asarray(x, dtype=np.float64)[~np.isnan(x)])
+    y = np.sort(np.asarray(y, dtype=np.float64)[~np.isnan(y)])
+    n1, n2 = len(x), len(y)
+    left = np.searchsorted(y, x, side='left')
+    right = np.searchsorted(y, x, side='right')
+    tied = np.nonzero(right > left)[0]
+    observed = effect_sizes_from_sums(n1, n2, x.sum(), y.sum(), (x ** 2).sum(), (y ** 2).sum(),
+                                      np.sum(left + 0.5 * (right - left)), np.median(x), np.median(y))
+
+    # Bootstrap: resample each group with replacement
+    moments_x, moments_y = np.column_stack([x, x ** 2]), np.column_stack([y, y ** 2])
+    offsets_x = (np.arange(batch_size) * n1)[:, np.newaxis]
+    offsets_y = (np.arange(batch_size) * n2)[:, np.newaxis]
+    below_y = np.zeros((batch_size, n2 + 1))  # Running count of resampled y values below each position
+    bootstrap = np.empty((3, n_resamples))
+    for start in range(0, n_resamples, batch_size):
+        n_draws = min(batch_size, n_resamples - start)
+        counts_x = draw_bootstrap_counts(n1, n_draws, rng, offsets_x)
+        counts_y = draw_bootstrap_counts(n2, n_draws, rng, offsets_y)
+        cumulative_y = below_y[:n_draws]
+        np.cumsum(counts_y, axis=1, out=cumulative_y[:, 1:])
+        u_stat = np.einsum('ij,ij->i', counts_x, cumulative_y[:, left])
+        if len(tied):
+            ties = cumulative_y[:, right[tied]] - cumulative_y[:, left[tied]]
+            u_stat += 0.5 * np.einsum('ij,ij->i', counts_x[:, tied], ties)
+        sums_x, sums_y = counts_x @ moments_x, counts_y @ moments_y
+        bootstrap[:, start:start + n_draws] = effect_sizes_from_sums(
+            n1, n2, sums_x[:, 0], sums_y[:, 0], sums_x[:, 1], sums_y[:, 1], u_stat,
+            sorted_median(x, np.cumsum(counts_x.ravel()), n1), sorted_median(y, np.cumsum(counts_y.ravel()), n2)
+        )
+
+    # Permutation: reassign group labels over the pooled, sorted sample
+    pooled = np.sort(np.concatenate([x, y]))
+    pooled_values = np.column_stack([pooled, pooled ** 2, rankdata(pooled)])
+    totals = pooled_values.sum(axis=0)
+    labels = np.zeros((batch_size, n1 + n2), dtype=bool)
+    labels[:, :n1] = True
+    positions = np.arange(1, batch_size * (n1 + n2) + 1)
+    permutation = np.empty((3, n_resamples))
+    for start in range(0, n_resamples, batch_size):
+        n_draws = min(batch_size, n_resamples - start)
+        batch = labels[:n_draws]
+        rng.permuted(batch, axis=1, out=batch)
+        sums1 = np.matmul(batch, pooled_values, dtype=np.float64)
+        sums2 = totals - sums1
+        cumulative_1 = np.cumsum(batch.ravel(), dtype=np.int64)
+        cumulative_2 = positions[:len(cumulative_1)] - cumulative_1
+        permutation[:, start:start + n_draws] = effect_sizes_from_sums(
+            n1, n2, sums1[:, 0], sums2[:, 0], sums1[:, 1], sums2[:, 1], sums1[:, 2] - n1 * (n1 + 1) / 2,
+            sorted_median(pooled, cumulative_1, n1), sorted_median(pooled, cumulative_2, n2)
+        )
+
+    return np.array(observed), bootstrap, permutation
+
+def compute_effect_sizes(dfs, names, n_resamples=10000, confidence=95, seed=0, batch_size=256, max_workers=None):
+    """Effect sizes with bootstrap CIs and permutation p-values for all comparison pairs.
+
+    Reproducibility: all randomness comes from one SeedSequence(seed). The k-th pair in combinations
+    order draws from its k-th spawned child stream, so the pairs can run in parallel threads and the
+    results do not depend on the number of workers or on scheduling. They do depend on seed, n_resamples,
+    batch_size and the order of the files (adding or reordering a file changes the streams of later pairs).
+    """
+    pairs = list(combinations(range(len(dfs)), 2))
+    streams = [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(len(pairs))]
+    tail = (100 - confidence) / 2
+
+    def evaluate_pair(pair, rng):
+        i, j = pair
+        observed, bootstrap, permutation = resample_effect_sizes(
+            dfs[i]['Difference'].to_numpy(), dfs[j]['Difference'].to_numpy(), n_resamples, rng, batch_size
+        )
+        lower, upper = np.nanpercentile(bootstrap, [tail, 100 - tail], axis=1)
+        # Two-sided permutation p-values with the +1 correction
+        exceed = (np.abs(permutation) >= np.abs(observed)[:, np.newaxis] - 1e-12).sum(axis=1)
+        p_values = (exceed + 1) / (n_resamples + 1)
+
+        row = {'Comparison 1': names[i], 'Comparison 2': names[j]}
+        for k, effect_size in enumerate(EFFECT_SIZES):
+            row[effect_size] = observed[k]
+            row[f'{effect_size} CI Lower'] = lower[k]
+            row[f'{effect_size} CI Upper'] = upper[k]
+            row[f'{effect_size} Permutation p-value'] = p_values[k]
+        return row
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(evaluate_pair, pairs, streams))
+    return pd.DataFrame(results)
+
 def create_statistical_dot_plot(stats_df, figsize=(10, 8), dot_size=(20, 200), font_size=12):
     plt.figure(figsize=figsize)
     stats_df['-log10(p-value)'] = -np.log10(stats_df['Adjusted p-value'])
@@ -120,9 +387,7 @@ def process_files(uploaded_files, figsize=(12, 5), dot_size=(20, 200), font_size
         try:
             with open(filename, 'wb') as f:
                 f.write(content)
-            df = pd.read_csv(filename)
-            if 'Difference' not in df.columns:
-                raise ValueError(f"File {filename} does not contain 'Difference' column.")
+            df = load_perseus_csv(filename, usecols=['Difference'])  # Raises ValueError if the column is missing
             base_name = filename.split('.')[0]
             dfs.append(df)
             names.append(base_name)
@@ -139,10 +404,18 @@ def process_files(uploaded_files, figsize=(12, 5), dot_size=(20, 200), font_size
     stats_df.to_csv(stats_file_path, index=False)
     files.download(stats_file_path)
 
-    combined_df, plot_path = create_combined_violin_plot(dfs, names, figsize)
+    if compute_effect_sizes_enabled:
+        effect_df = compute_effect_sizes(dfs, names, n_resamples=effect_size_resamples, confidence=95,
+                                         seed=effect_size_seed)
+        effect_file_path = 'effect_size_results.csv'
+        effect_df.to_csv(effect_file_path, index=False)
+        files.download(effect_file_path)
+
+    combined_df, plot_path, density_path = create_combined_violin_plot(dfs, names, figsize)
     dot_plot_path = create_statistical_dot_plot(stats_df, figsize=(10, 8), dot_size=dot_size, font_size=font_size)
 
     files.download(plot_path)
+    files.download(density_path)
     files.download(dot_plot_path)
 
 def main():
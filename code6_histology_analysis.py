@@ -9,6 +9,19 @@ import matplotlib.pyplot as plt
 from IPython.display import display
 import io
 import numpy as np
+from mosaic_stitching import stitch_metadata
+from snapshot_hashing import file_phash, flag_near_duplicates
+
+# Overlapping snapshots of the same condition and staining are stitched into one mosaic per sample.
+# Off by default: only enable it when the snapshots of a replicate really are overlapping fields.
+stitch_snapshots = False
+mosaic_dir = '/content/Mosaics'
+mosaic_fill = 255  # Canvas value outside the snapshots (white slide background)
+min_stitch_correlation = 0.5  # Tissue-texture correlation below which snapshots are separate fields
+# Re-saved or re-cropped copies of a field are flagged by perceptual hash (Duplicate_Of in the metadata)
+flag_duplicate_snapshots = True
+duplicate_hash_distance = 8  # Differing bits of the 64-bit pHash still counted as the same field
+drop_duplicate_snapshots = False  # Also remove the flagged copies before stitching and analysis
 
 def upload_files():
     uploaded = files.upload()
@@ -48,7 +61,8 @@ def process_image(file_data, filename):
             'Staining': staining,
             'Replicate': replicate,
             'Format': image.format,
-            'OriginalSize': image.size
+            'OriginalSize': image.size,
+            'PHash': f'{file_phash(io.BytesIO(file_data)):016x}'
         }
     except IOError:
         print(f"Error opening image file: {filename}")
@@ -101,6 +115,12 @@ def process_and_display_files():
         display_representative_images(display_images, metadata_list)
 
     df = pd.DataFrame(metadata_list)
+    if flag_duplicate_snapshots and not df.empty:
+        df = flag_near_duplicates(df, duplicate_hash_distance)
+        if drop_duplicate_snapshots:
+            df = df[df['Duplicate_Of'] == ''].reset_index(drop=True)
+    if stitch_snapshots and not df.empty:
+        df = stitch_metadata(df, mosaic_dir, fill=mosaic_fill, min_correlation=min_stitch_correlation)
     display(df)
 
     metadata_path = '/content/metadata.csv'
@@ -121,6 +141,55 @@ import cv2
 from tqdm import tqdm
 import os
 import re
+import glob
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.cluster import MiniBatchKMeans
+from stage_timing import StageTimer
+from spatial_analysis import DepthProfiles, depth_map, depth_profile, integral_image, heterogeneity
+from mosaic_stitching import read_image
+from image_qc import quality_gate, reduced_factor, reduced_read
+from preview_analysis import run_previews, deviation_report
+
+# Set to True to also write a cProfile dump of the per-image stages to Staining-Seg/
+profile_stages = False
+# Quality gate before segmentation: focus, clipping, tissue coverage and illumination on a reduced decode
+run_quality_gate = True
+qc_rules = [  # (metric, comparison, threshold, 'flag' or 'skip'); focus is measured at ~512 px
+    ('QC_Tissue_Coverage', '<', 0.02, 'skip'),
+    ('QC_Tissue_Coverage', '<', 0.10, 'flag'),
+    ('QC_Focus', '<', 50.0, 'flag'),
+    ('QC_Saturated_Fraction', '>', 0.05, 'flag'),
+    ('QC_Illumination_Gradient', '>', 0.25, 'flag'),
+]
+# Segment percentages by depth from the tissue boundary (per image and averaged per condition)
+measure_depth_profiles = True
+depth_bin_width = 25  # Pixels per depth bin
+# Patchiness of the segments: tile percentage maps, CV across tiles and Moran's I per grid size
+measure_heterogeneity = True
+heterogeneity_tile_sizes = [64, 128, 256]  # Tile edge lengths in pixels, all derived from one integral image
+min_tile_coverage = 0.5  # Tiles less than half inside the (non-white) sample are left out
+# Per-image quantized color histograms of the non-white sample pixels, for palette what-if runs.
+# With requantify_only = True, main() skips the images and re-quantifies the saved histograms with
+# the current palettes (see requantify_from_histograms).
+save_color_histograms = True
+histogram_bins = 64  # Bins per RGB channel (64 -> 262,144 bins, stored sparsely)
+requantify_only = False
+# 'palette': nearest predefined color; 'deconvolution': optical-density stain unmixing (HE, Trichrome, Movat)
+segmentation_mode = 'palette'
+# Learned palettes: set learn_palettes = True to fit a new palette version per stain before segmenting.
+# get_color_group uses the latest version in palette_dir and falls back to the predefined colors.
+learn_palettes = False
+palette_dir = 'palettes'
+palette_sample_budget = 200000  # Pixels kept across all images of a stain
+palette_pixels_per_image = 50000  # Grid of the reduced decode scanned per image, whatever its resolution
+colors_per_segment = 3
+# Preview mode: sample detection, classification and segment percentages on a 4x or 8x reduced decode
+# with the saved palettes, plus a small overlay per image (Staining-Seg/Preview). No full analysis runs.
+preview_mode = False
+preview_factor = 4  # 4 or 8
+report_preview_deviation = False  # Also compare the preview with full resolution (Preview_Deviation.csv)
 
 # Keep all existing helper functions the same
 def sanitize_filename(name):
@@ -189,18 +258,225 @@ def detect_sample_region(image, white_threshold=220, blur_size=25, large_kernel_
 
     return mask
 
-def get_color_group(stain):
+def define_stain_vectors():
+    """Optical-density (R, G, B) vectors of each stain and the rules mapping stain amounts to segments.
+
+    Rules are (segment, stains summed, minimum amount) and are checked in order; pixels matching none
+    are 'Other' (weakly stained and transitional regions). HE and Masson's Trichrome use the Ruifrok &
+    Johnston vectors; Movat's black (Verhoeff) is modelled as a neutral absorber.
+    """
+    return {
+        'HE': {
+            'stains': {'Hematoxylin': (0.650, 0.704, 0.286), 'Eosin': (0.072, 0.990, 0.105)},
+            'segments': [('Nuclei', ['Hematoxylin'], 0.46),
+                         ('Cytoplasm/Fibrosis/Muscle', ['Hematoxylin', 'Eosin'], 0.30)]
+        },
+        'Trichrome': {
+            'stains': {'Methyl Blue': (0.800, 0.591, 0.105), 'Ponceau Fuchsin': (0.100, 0.737, 0.668)},
+            'segments': [('Nuclei/Cytoplasm/Muscle', ['Ponceau Fuchsin'], 0.30),
+                         ('Fibrosis', ['Methyl Blue'], 0.09)]
+        },
+        'Movat': {
+            'stains': {'Verhoeff': (0.577, 0.577, 0.577), 'Fuchsin': (0.100, 0.737, 0.668)},
+            'segments': [('Nuclei/Elastin', ['Verhoeff'], 1.00),
+                         ('Muscle/Cytoplasm/Fibrosis', ['Verhoeff', 'Fuchsin'], 0.18)]
+        }
+    }
+
+def deconvolution_matrix(stains):
+    """Inverse of the 3x3 stain matrix; with two stains the third row is their normalized cross product."""
+    vectors = [np.array(vector, dtype=np.float64) / np.linalg.norm(vector) for vector in stains.values()]
+    if len(vectors) == 2:
+        residual = np.cross(vectors[0], vectors[1])
+        vectors.append(residual / np.linalg.norm(residual))
+    return np.linalg.inv(np.array(vectors))
+
+def deconvolve_segment_image(image, stain, color_groups, tile_rows=512):
+    """Segment by stain unmixing; returns labels indexing `color_groups` like segment_image (-1 = white)."""
+    config = define_stain_vectors()[stain]
+    stain_names = list(config['stains'])
+    segment_names = list(color_groups)
+
+    # Fold unmixing and the per-rule stain sums into one 3 x n_rules matrix: scores = OD @ projection
+    rule_weights = np.zeros((3, len(config['segments'])))
+    for j, (_, stains, _) in enumerate(config['segments']):
+        rule_weights[[stain_names.index(name) for name in stains], j] = 1
+    projection = (deconvolution_matrix(config['stains']) @ rule_weights).astype(np.float32)
+    rule_labels = [segment_names.index(segment) for segment, _, _ in config['segments']]
+    thresholds = [threshold for _, _, threshold in config['segments']]
+    # Optical density of every 8-bit value (Beer-Lambert, with +1 so that 0 stays finite)
+    od_lut = -np.log10((np.arange(256, dtype=np.float32) + 1) / 256)
+
+    labels = np.empty(image.shape[:2], dtype=np.int8)
+    for row in range(0, image.shape[0], tile_rows):
+        tile = image[row:row + tile_rows]
+        scores = (od_lut[tile].reshape(-1, 3) @ projection).reshape(tile.shape[:2] + (len(thresholds),))
+        tile_labels = labels[row:row + tile_rows]
+        tile_labels.fill(segment_names.index('Other'))
+        # Assign in reverse so that the first matching rule wins
+        for j in reversed(range(len(thresholds))):
+            tile_labels[scores[..., j] >= thresholds[j]] = rule_labels[j]
+        tile_labels[np.all(tile > 240, axis=2)] = -1
+    return labels
+
+def decode_at_scale(image_path, factor):
+    """RGB decode at 1/1, 1/2, 1/4 or 1/8 scale (JPEGs are decoded directly at the reduced size)."""
+    flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+             8: cv2.IMREAD_REDUCED_COLOR_8}
+    return cv2.cvtColor(read_image(image_path, flags[factor]), cv2.COLOR_BGR2RGB)
+
+def reduced_decode(image_path, max_side=512):
+    """Decode at 1/2, 1/4 or 1/8 scale so that the long side stays near `max_side`; returns (RGB, factor).
+
+    Shares the quality gate's cache of reduced decodes, so after the gate no image is decoded again.
+    """
+    image = reduced_read(image_path, color=True, max_side=max_side)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), reduced_factor(image_path, max_side)
+
+def detect_sample_region_scaled(img_rgb, factor):
+    """detect_sample_region with its kernels scaled to an image decoded at 1/factor (factor 1: defaults)."""
+    odd = lambda size: max(3, size // factor) | 1
+    return detect_sample_region(img_rgb, blur_size=odd(25), large_kernel_size=odd(15), smooth_kernel_size=odd(7))
+
+def sample_region_pixels(image_path, max_pixels=palette_pixels_per_image):
+    """Non-white pixels inside the sample region of a strided grid of at most `max_pixels` of a reduced decode."""
+    img_rgb, factor = reduced_decode(image_path)
+    stride = max(1, int(np.ceil(np.sqrt(img_rgb.shape[0] * img_rgb.shape[1] / max_pixels))))
+    img_rgb = np.ascontiguousarray(img_rgb[::stride, ::stride])
+    sample_mask = detect_sample_region_scaled(img_rgb, factor * stride)
+    white = cv2.inRange(img_rgb, (241, 241, 241), (255, 255, 255))  # All channels above 240
+    return img_rgb[np.logical_and(sample_mask > 0, white == 0)]
+
+def sample_stain_pixels(image_paths, budget=palette_sample_budget, seed=0):
+    """Uniform sample of at most `budget` non-white sample-region pixels across all images.
+
+    Reservoir sampling with random keys: every pixel gets a uniform key and the `budget` smallest
+    keys seen so far are kept. Once the reservoir is full only keys below its largest key can enter,
+    so the entering pixels are drawn directly (a binomial count, then uniform keys below that bound).
+    The reservoir is trimmed back to `budget` only when it has doubled, which keeps the bound valid
+    and the number of partitions logarithmic. Images are decoded in worker threads (reduced decodes
+    are cached, see reduced_decode) and merged in order, so the sample depends only on `seed`.
+    """
+    rng = np.random.default_rng(seed)
+    reservoir, keys = [np.empty((0, 3), dtype=np.uint8)], [np.empty(0)]
+    size, bound = 0, 1.0  # Keys at or above bound can no longer enter the sample
+
+    def trim(keys, reservoir):
+        keys, reservoir = np.concatenate(keys), np.concatenate(reservoir)
+        if len(keys) > budget:
+            keep = np.argpartition(keys, budget)[:budget]
+            keys, reservoir = keys[keep], reservoir[keep]
+        return keys, reservoir
+
+    with ThreadPoolExecutor() as pool:
+        for pixels in pool.map(sample_region_pixels, image_paths):
+            if bound < 1.0:
+                entering = rng.choice(len(pixels), rng.binomial(len(pixels), bound), replace=False)
+                pixels, new_keys = pixels[entering], rng.random(len(entering)) * bound
+            else:
+                new_keys = rng.random(len(pixels))
+            keys.append(new_keys)
+            reservoir.append(pixels)
+            size += len(new_keys)
+            if size >= 2 * budget or (bound == 1.0 and size >= budget):
+                kept_keys, kept_pixels = trim(keys, reservoir)
+                keys, reservoir, size = [kept_keys], [kept_pixels], len(kept_keys)
+                bound = kept_keys.max()
+    return trim(keys, reservoir)[1]
+
+def assign_clusters_to_segments(centers, stain):
+    """Name the cluster centers: nearest predefined segment for known stains, darkness ranks otherwise."""
+    predefined = define_predefined_color_groups().get(stain)
+    if predefined is None:
+        # Unknown stain: equal-sized darkness bins, the lightest being the weakly stained 'Other'
+        order = np.argsort(centers.sum(axis=1))
+        bins = np.array_split(order, len(centers) // colors_per_segment)
+        names = [f'Segment_{i + 1}' for i in range(len(bins) - 1)] + ['Other']
+        return {name: [tuple(int(v) for v in centers[i]) for i in sorted(members)]
+                for name, members in zip(names, bins)}
+
+    names = list(predefined)
+    distances = np.stack([np.min(np.linalg.norm(centers[:, np.newaxis] - np.array(colors), axis=2), axis=1)
+                          for colors in predefined.values()], axis=1)
+    assignment = np.argmin(distances, axis=1)
+    # Every segment needs at least one color: give an empty one its closest center from a larger segment
+    for j in range(len(names)):
+        if not np.any(assignment == j):
+            donors = [i for i in range(len(centers)) if np.sum(assignment == assignment[i]) > 1]
+            assignment[min(donors, key=lambda i: distances[i, j])] = j
+    return {name: [tuple(int(v) for v in center) for center in centers[assignment == j]]
+            for j, name in enumerate(names)}
+
+def palette_versions(stain, directory=palette_dir):
+    """Palette files of a stain sorted by version number."""
+    pattern = os.path.join(directory, f'{sanitize_filename(stain)}_v*.json')
+    return sorted(glob.glob(pattern), key=lambda path: int(re.search(r'_v(\d+)\.json$', path).group(1)))
+
+def learn_palette(metadata_df, stain, directory=palette_dir, budget=palette_sample_budget, seed=0):
+    """Fit a palette for one stain from all of its images and save it as the next palette version.
+
+    Nothing is written when the fitted colors equal those of the latest version, or when the images
+    give fewer sample pixels than palette colors (the latest or predefined palette is then kept).
+    """
+    start = time.perf_counter()
+    image_paths = [path for path in metadata_df.loc[metadata_df['Staining'] == stain, 'FilePath']
+                   if os.path.exists(path)]
+    samples = sample_stain_pixels(image_paths, budget, seed) if image_paths else np.empty((0, 3), np.uint8)
+    n_segments = len(define_predefined_color_groups().get(stain, {})) or 3
+    n_clusters = n_segments * colors_per_segment
+    if len(samples) < n_clusters:
+        print(f"Only {len(samples)} sample pixels in {len(image_paths)} {stain} images, fewer than the "
+              f"{n_clusters} palette colors; keeping the current palette")
+        return None
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=4096, n_init=3, random_state=seed)
+    kmeans.fit(samples.astype(np.float32))
+    groups = assign_clusters_to_segments(np.clip(np.rint(kmeans.cluster_centers_), 0, 255), stain)
+
+    versions = palette_versions(stain, directory)
+    if versions and get_color_group(stain, directory) == groups:
+        print(f"{stain} palette unchanged from {versions[-1]} ({time.perf_counter() - start:.1f}s); "
+              f"no new version written")
+        return groups
+    version = int(re.search(r'_v(\d+)\.json$', versions[-1]).group(1)) + 1 if versions else 1
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{sanitize_filename(stain)}_v{version:03d}.json')
+    with open(path, 'w') as f:
+        json.dump({'stain': stain, 'version': version, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'n_images': len(image_paths), 'n_samples': int(len(samples)), 'budget': budget,
+                   'seed': seed, 'inertia': float(kmeans.inertia_),
+                   'groups': {name: [list(color) for color in colors] for name, colors in groups.items()}},
+                  f, indent=2)
+    print(f"Learned {stain} palette v{version} from {len(samples)} pixels of {len(image_paths)} images "
+          f"in {time.perf_counter() - start:.1f}s: {path}")
+    return groups
+
+def get_color_group(stain, directory=palette_dir):
+    """Latest learned palette of the stain if there is one, otherwise the predefined colors."""
+    versions = palette_versions(stain, directory)
+    if versions:
+        with open(versions[-1]) as f:
+            return {name: [tuple(color) for color in colors] for name, colors in json.load(f)['groups'].items()}
     predefined_groups = define_predefined_color_groups()
     return predefined_groups.get(stain, None)
 
-def segment_image(image, color_groups):
-    pixels = image.reshape(-1, 3).astype(np.float64)
+def color_group_distances(pixels, color_groups):
+    """Distance from each pixel (N x 3) to the nearest color of every color group (N x groups)."""
     distances = np.zeros((len(pixels), len(color_groups)))
+    # |p - c|^2 = |p|^2 - 2 p.c + |c|^2 avoids the (pixels x colors x 3) difference array; every term is
+    # an exact float64 integer (or quarter) for 8-bit colors, so the nearest colors are unchanged
+    pixels = np.asarray(pixels, dtype=np.float64)
+    squared_norms = np.einsum('ij,ij->i', pixels, pixels)
 
     # Calculate distances to each color group
     for i, colors in enumerate(color_groups.values()):
-        colors_array = np.array(colors)
-        distances[:, i] = np.min(np.linalg.norm(pixels[:, np.newaxis] - colors_array, axis=2), axis=1)
+        colors_array = np.array(colors, dtype=np.float64)
+        squared = pixels @ (-2 * colors_array.T) + np.einsum('ij,ij->i', colors_array, colors_array)
+        distances[:, i] = np.sqrt(np.maximum(squared.min(axis=1) + squared_norms, 0))
+    return distances
+
+def segment_image(image, color_groups):
+    pixels = image.reshape(-1, 3).astype(np.float64)
+    distances = color_group_distances(pixels, color_groups)
 
     # Create mask for white/background pixels
     white_pixels = np.all(pixels > 240, axis=1)
@@ -215,6 +491,67 @@ def segment_image(image, color_groups):
 
     return labels.reshape(image.shape[:2])
 
+def color_histogram(img_rgb, mask, bins=histogram_bins):
+    """Sparse 3D color histogram of the masked pixels: (flat bin indices, counts) of the non-empty bins."""
+    shift = 8 - int(np.log2(bins))
+    pixels = img_rgb[mask] >> shift
+    codes = (pixels[:, 0].astype(np.int32) * bins + pixels[:, 1]) * bins + pixels[:, 2]
+    counts = np.bincount(codes, minlength=bins ** 3)
+    occupied = np.flatnonzero(counts)
+    return occupied.astype(np.int32), counts[occupied].astype(np.uint32)
+
+def save_color_histogram(path, occupied, counts, bins=histogram_bins):
+    np.savez_compressed(path, bins=occupied, counts=counts, levels=bins)
+
+def requantify_from_histograms(metadata_df, color_groups_by_stain=None, output_dir='Staining-Seg'):
+    """Segment percentages of every image from its saved color histogram, without reading images.
+
+    Each occupied bin is classified once per stain at its center color with the same nearest-color
+    rule as segment_image; percentages are of the non-white sample pixels, as in the row figures.
+    `color_groups_by_stain` overrides the palettes (default: get_color_group for each stain).
+    """
+    rows = []
+    for stain in metadata_df['Staining'].unique():
+        color_groups = (color_groups_by_stain or {}).get(stain) or get_color_group(stain)
+        stain_df = metadata_df[metadata_df['Staining'] == stain]
+        if color_groups is None or 'Color_Histogram_Path' not in stain_df:
+            continue
+        histograms = {}
+        for index, path in stain_df['Color_Histogram_Path'].items():
+            if isinstance(path, str) and os.path.exists(path):
+                with np.load(path) as data:
+                    histograms[index] = (data['bins'], data['counts'], int(data['levels']))
+        if not histograms:
+            continue
+
+        # Classify the union of occupied bins once for the whole stain
+        for levels in {levels for _, _, levels in histograms.values()}:
+            indices = [index for index, (_, _, l) in histograms.items() if l == levels]
+            unique_bins, inverse = np.unique(np.concatenate([histograms[i][0] for i in indices]),
+                                             return_inverse=True)
+            width = 256 // levels
+            centers = np.stack(np.unravel_index(unique_bins, (levels,) * 3), axis=1) * width + (width - 1) / 2
+            bin_labels = np.argmin(color_group_distances(centers, color_groups), axis=1)[inverse]
+
+            start = 0
+            for index in indices:
+                counts = histograms[index][1]
+                segment_pixels = np.bincount(bin_labels[start:start + len(counts)], weights=counts,
+                                             minlength=len(color_groups))
+                start += len(counts)
+                row = {'Filename': os.path.basename(metadata_df.at[index, 'FilePath']), 'Staining': stain,
+                       'Condition': metadata_df.at[index, 'Condition'], 'Pixels': int(counts.sum())}
+                for i, name in enumerate(color_groups):
+                    row[f'{sanitize_filename(name)}_Percentage'] = segment_pixels[i] / max(counts.sum(), 1) * 100
+                rows.append(row)
+
+    results = pd.DataFrame(rows)
+    os.makedirs(output_dir, exist_ok=True)
+    results_path = os.path.join(output_dir, 'Requantified_Percentages.csv')
+    results.to_csv(results_path, index=False)
+    print(f"Re-quantified {len(results)} images from color histograms: {results_path}")
+    return results
+
 def display_color_palette(color_groups, stain, title):
     fig, ax = plt.subplots(figsize=(10, 2))
     for i, (name, colors) in enumerate(color_groups.items()):
@@ -228,23 +565,31 @@ def display_color_palette(color_groups, stain, title):
     plt.tight_layout()
     plt.show()
 
-def process_and_display_image(metadata_df, index, stain, color_groups):
+def process_and_display_image(metadata_df, index, stain, color_groups, timer=None, profiles=None):
     image_path = metadata_df.at[index, 'FilePath']
     if not os.path.exists(image_path):
         print(f"Image not found: {image_path}")
         return
+    timer = StageTimer() if timer is None else timer
+    image_name = os.path.basename(image_path)
 
     # Load image
-    img = cv2.imread(image_path)
-    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    with timer.span(image_name, 'Decode'):
+        img = read_image(image_path)
+        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
     # Detect sample region and get contours
-    sample_mask = detect_sample_region(img_rgb)
-    contours, _ = cv2.findContours(sample_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    with timer.span(image_name, 'Masking'):
+        sample_mask = detect_sample_region(img_rgb)
+        contours, _ = cv2.findContours(sample_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
     # Segment the image within sample region
-    masked_img = cv2.bitwise_and(img_rgb, img_rgb, mask=sample_mask)
-    segmented = segment_image(masked_img, color_groups)
+    with timer.span(image_name, 'Classification'):
+        masked_img = cv2.bitwise_and(img_rgb, img_rgb, mask=sample_mask)
+        if segmentation_mode == 'deconvolution' and stain in define_stain_vectors():
+            segmented = deconvolve_segment_image(masked_img, stain, color_groups)
+        else:
+            segmented = segment_image(masked_img, color_groups)
 
     output_dir = 'Staining-Seg'
     os.makedirs(output_dir, exist_ok=True)
@@ -253,32 +598,68 @@ def process_and_display_image(metadata_df, index, stain, color_groups):
     sanitized_stain = sanitize_filename(stain)
 
     # Save individual segments
-    white_mask = np.all(img_rgb > 240, axis=2)
-    effective_mask = np.logical_and(sample_mask > 0, ~white_mask)
-
-    for i, (name, colors) in enumerate(color_groups.items()):
-        segment = np.where(np.logical_and(segmented[..., np.newaxis] == i, effective_mask[..., np.newaxis]),
-                          img_rgb,
-                          [255, 255, 255])
-        segment = segment.astype(np.uint8)
-
-        sanitized_name = sanitize_filename(name)
-        seg_filename = f"{base_filename}-{sanitized_stain}-{sanitized_name}.png"
-        seg_path = os.path.join(output_dir, seg_filename)
-
-        # Add red contour to segment before saving
-        segment_with_contour = segment.copy()
-        cv2.drawContours(segment_with_contour, contours, -1, (255, 0, 0), 2)
-        cv2.imwrite(seg_path, cv2.cvtColor(segment_with_contour, cv2.COLOR_RGB2BGR))
-
-        metadata_df.at[index, f'Staining_Segment_{sanitized_name}_Path'] = seg_path
+    with timer.span(image_name, 'Encoding'):
+        white_mask = np.all(img_rgb > 240, axis=2)
+        effective_mask = np.logical_and(sample_mask > 0, ~white_mask)
+
+        for i, (name, colors) in enumerate(color_groups.items()):
+            segment = np.where(np.logical_and(segmented[..., np.newaxis] == i, effective_mask[..., np.newaxis]),
+                              img_rgb,
+                              [255, 255, 255])
+            segment = segment.astype(np.uint8)
+
+            sanitized_name = sanitize_filename(name)
+            seg_filename = f"{base_filename}-{sanitized_stain}-{sanitized_name}.png"
+            seg_path = os.path.join(output_dir, seg_filename)
+
+            # Add red contour to segment before saving
+            segment_with_contour = segment.copy()
+            cv2.drawContours(segment_with_contour, contours, -1, (255, 0, 0), 2)
+            cv2.imwrite(seg_path, cv2.cvtColor(segment_with_contour, cv2.COLOR_RGB2BGR))
+
+            metadata_df.at[index, f'Staining_Segment_{sanitized_name}_Path'] = seg_path
+
+    # Quantized colors of the pixels the percentages refer to, for re-quantification with other palettes
+    if save_color_histograms:
+        with timer.span(image_name, 'Color_Histogram'):
+            histogram_path = os.path.join(output_dir, f"{base_filename}-{sanitized_stain}-color-histogram.npz")
+            save_color_histogram(histogram_path, *color_histogram(img_rgb, effective_mask))
+            metadata_df.at[index, 'Color_Histogram_Path'] = histogram_path
+
+    # Edge-to-core profile of the segments (white pixels inside the sample are excluded, as above)
+    if measure_depth_profiles:
+        with timer.span(image_name, 'Depth_Profile'):
+            labels = np.where(effective_mask, segmented, -1)
+            profile = depth_profile(labels, list(color_groups), depth_map(sample_mask), depth_bin_width)
+            profile_path = os.path.join(output_dir, f"{base_filename}-{sanitized_stain}-depth-profile.csv")
+            profile.to_csv(profile_path, index=False)
+            metadata_df.at[index, 'Depth_Profile_Path'] = profile_path
+            if profiles is not None:
+                profiles.add(profile, image_name, stain, metadata_df.at[index, 'Condition'])
+
+    # Tile-grid heterogeneity of the segments, relative to the same non-white sample pixels
+    if measure_heterogeneity:
+        with timer.span(image_name, 'Heterogeneity'):
+            class_integrals = {sanitize_filename(name): integral_image(np.logical_and(segmented == i, effective_mask))
+                               for i, name in enumerate(color_groups)}
+            summary, tiles = heterogeneity(class_integrals, integral_image(effective_mask),
+                                           heterogeneity_tile_sizes, min_tile_coverage)
+            tiles_path = os.path.join(output_dir, f"{base_filename}-{sanitized_stain}-heterogeneity-tiles.csv")
+            tiles.to_csv(tiles_path, index=False)
+            metadata_df.at[index, 'Heterogeneity_Tiles_Path'] = tiles_path
+            for row in summary.itertuples():
+                metadata_df.at[index, f'{row.Class}_Tile_CV_{row.Tile_px}px'] = row.CV
+                metadata_df.at[index, f'{row.Class}_Morans_I_{row.Tile_px}px'] = row.Morans_I
 
     # Display and save results with contours
-    row_image = display_results(img_rgb, color_groups, segmented, image_path, stain, sample_mask, contours)
-    row_filename = f"{base_filename}-{sanitized_stain}-row.png"
-    row_path = os.path.join(output_dir, row_filename)
-    cv2.imwrite(row_path, cv2.cvtColor(row_image, cv2.COLOR_RGB2BGR))
+    with timer.span(image_name, 'Rendering'):
+        row_image = display_results(img_rgb, color_groups, segmented, image_path, stain, sample_mask, contours)
+    with timer.span(image_name, 'Row_Encoding'):
+        row_filename = f"{base_filename}-{sanitized_stain}-row.png"
+        row_path = os.path.join(output_dir, row_filename)
+        cv2.imwrite(row_path, cv2.cvtColor(row_image, cv2.COLOR_RGB2BGR))
     metadata_df.at[index, 'Staining_Row_Path'] = row_path
+    timer.update_metadata(metadata_df, index, image_name)
 
 def display_results(img_rgb, color_groups, segmented, image_path, stain, sample_mask, contours):
     n_colors = len(color_groups)
@@ -328,36 +709,102 @@ def display_results(img_rgb, color_groups, segmented, image_path, stain, sample_
     plt.tight_layout()
 
     fig.canvas.draw()
-    row_image = np.frombuffer(fig.canvas.tostring_rgb(), dtype=np.uint8)
-    row_image = row_image.reshape(fig.canvas.get_width_height()[::-1] + (3,))
+    row_image = np.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()  # tostring_rgb was removed in matplotlib 3.10
 
     plt.close()
     return row_image
 
-def process_stain_group(metadata_df, stain, color_groups):
+def preview_image(image_path, stain, color_groups=None, factor=preview_factor, overlay_side=512):
+    """Segment percentages and a small overlay from a 1/factor decode, for checks during acquisition.
+
+    Runs the Step 2 sample detection (kernels scaled to the decode) and classification, and returns the
+    percentage of every segment among the non-white sample pixels, as in requantify_from_histograms.
+    factor=1 runs the same steps at full resolution, which is the reference for the preview.
+    """
+    start = time.perf_counter()
+    color_groups = get_color_group(stain) if color_groups is None else color_groups
+    img_rgb = decode_at_scale(image_path, factor)
+    sample_mask = detect_sample_region_scaled(img_rgb, factor)
+    masked_img = cv2.bitwise_and(img_rgb, img_rgb, mask=sample_mask)
+    if segmentation_mode == 'deconvolution' and stain in define_stain_vectors():
+        segmented = deconvolve_segment_image(masked_img, stain, color_groups)
+    else:
+        segmented = segment_image(masked_img, color_groups)
+    effective_mask = np.logical_and(sample_mask > 0, ~np.all(img_rgb > 240, axis=2))
+    counts = np.bincount(segmented[effective_mask], minlength=len(color_groups))
+    total = int(effective_mask.sum())
+    percentages = {f'{sanitize_filename(name)}_Percentage': counts[i] / max(total, 1) * 100
+                   for i, name in enumerate(color_groups)}
+    seconds = time.perf_counter() - start
+
+    # Segments tinted over the image, sample outline in red, long side scaled to overlay_side
+    tints = (plt.cm.tab10(np.arange(len(color_groups)))[:, :3] * 255).astype(np.float32)
+    overlay = img_rgb.astype(np.float32)
+    overlay[effective_mask] = 0.5 * overlay[effective_mask] + 0.5 * tints[segmented[effective_mask]]
+    overlay = overlay.astype(np.uint8)
+    contours, _ = cv2.findContours(sample_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cv2.drawContours(overlay, contours, -1, (255, 0, 0), max(1, overlay.shape[1] // 400))
+    scale = min(1.0, overlay_side / max(overlay.shape[:2]))
+    overlay = cv2.resize(overlay, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return {'percentages': percentages, 'sample_pixels': total, 'seconds': seconds, 'factor': factor,
+            'overlay': overlay}
+
+def stain_preview(metadata_df, stain):
+    """Preview function of one stain for preview_analysis, with its saved palette loaded once."""
+    color_groups = get_color_group(stain)
+    if color_groups is None:
+        return None
+    return lambda image_path, factor: preview_image(image_path, stain, color_groups, factor)
+
+def process_stain_group(metadata_df, stain, color_groups, timer=None, profiles=None):
     print(f"\nProcessing {stain} stained images:")
     stain_indices = metadata_df.index[metadata_df['Staining'] == stain]
 
     display_color_palette(color_groups, stain, f"Color Palette for {stain} Stain")
 
     for index in tqdm(stain_indices, desc=f"Processing {stain} images"):
-        process_and_display_image(metadata_df, index, stain, color_groups)
+        process_and_display_image(metadata_df, index, stain, color_groups, timer, profiles)
 
 def main():
     metadata_df = load_metadata('metadata.csv')
     stain_types = detect_stain_types(metadata_df)
     print(f"Detected stain types: {stain_types}")
+    if requantify_only:
+        return requantify_from_histograms(metadata_df)
+    if preview_mode:
+        output_dir = os.path.join('Staining-Seg', 'Preview')
+        results = run_previews(metadata_df, stain_preview, preview_factor, output_dir)
+        if report_preview_deviation:
+            deviation_report(metadata_df, stain_preview, (4, 8), output_dir)
+        return results
+    timer = StageTimer(profile=profile_stages)
+    profiles = DepthProfiles()
+    if run_quality_gate:
+        passed = quality_gate(metadata_df, qc_rules, background='white', timer=timer)
+    else:
+        passed = pd.Series(True, index=metadata_df.index)
+    analysis_df = metadata_df[passed].copy()
 
     for stain in stain_types:
         print(f"\nAnalyzing colors for {stain} stain:")
+        if not (analysis_df['Staining'] == stain).any():
+            print(f"All {stain} images were skipped by the quality gate. Skipping.")
+            continue
+        if learn_palettes:
+            learn_palette(analysis_df, stain)
         color_group = get_color_group(stain)
         if color_group is None:
             print(f"No color groups defined for {stain}. Skipping.")
             continue
-        process_stain_group(metadata_df, stain, color_group)
+        process_stain_group(analysis_df, stain, color_group, timer, profiles)
 
+    # Images skipped by the quality gate keep their QC columns and get no results
+    metadata_df = pd.concat([analysis_df, metadata_df[~passed]]).sort_index()
     metadata_df.to_csv('metadata.csv', index=False)
     print("Updated metadata saved to metadata.csv")
+    timer.write_reports('Staining-Seg')
+    if measure_depth_profiles:
+        profiles.write('Staining-Seg')
 
 if __name__ == "__main__":
     main()
@@ -375,28 +822,38 @@ import seaborn as sns
 from PIL import Image
 from scipy import stats
 from statsmodels.stats.multicomp import pairwise_tukeyhsd
+from figure_export import FigureExporter, figure_data_hash
+from statistics_table import StatisticsTable
+from mosaic_stitching import is_mosaic, read_rgb
 import warnings
 warnings.filterwarnings('ignore')
 
+# All ANOVA/Tukey/descriptive results go to Statistical_Results.csv; these add the optional outputs
+write_statistics_json = False  # Also write Statistical_Results.json
+write_text_reports = False  # Also render the per-staining/segment *_statistical_results.txt reports
+
 def create_original_mask(image_path, white_threshold=240):
     """
     Creates two masks:
     1. Sample region mask (from edge detection)
     2. Non-white tissue mask (excluding white/near-white pixels)
     """
-    with Image.open(image_path) as img:
-        img_array = np.array(img)
+    if is_mosaic(image_path):
+        img_array = read_rgb(image_path)
+    else:
+        with Image.open(image_path) as img:
+            img_array = np.array(img)
 
-        # Create mask for the sample region (using the same logic as in first code)
-        sample_region = np.any(img_array < 250, axis=2)
+    # Create mask for the sample region (using the same logic as in first code)
+    sample_region = np.any(img_array < 250, axis=2)
 
-        # Create mask for non-white pixels (more stringent threshold)
-        tissue_mask = ~np.all(img_array > white_threshold, axis=2)
+    # Create mask for non-white pixels (more stringent threshold)
+    tissue_mask = ~np.all(img_array > white_threshold, axis=2)
 
-        # Combine masks: must be both within sample region AND not white
-        final_mask = np.logical_and(sample_region, tissue_mask)
+    # Combine masks: must be both within sample region AND not white
+    final_mask = np.logical_and(sample_region, tissue_mask)
 
-        return final_mask
+    return final_mask
 
 def calculate_non_white_percentage(segment_path, original_mask, white_threshold=240):
     """
@@ -445,8 +902,10 @@ def get_valid_segments_for_staining(metadata_df, staining):
 
     return valid_segments
 
-def create_stain_consolidated_plots(metadata_df, output_dir):
+def create_stain_consolidated_plots(metadata_df, output_dir, exporter=None):
     """Creates consolidated plots for each staining type, showing all segments with enhanced visibility"""
+    own_exporter = exporter is None
+    exporter = FigureExporter(output_dir) if own_exporter else exporter
 
     # Style parameters - adjust these values to modify the plot appearance
     FONT_SIZE = {
@@ -509,6 +968,14 @@ def create_stain_consolidated_plots(metadata_df, output_dir):
             print(f"No valid data for {staining}")
             continue
 
+        # Skip building the plot when its data and style are unchanged since the last export
+        figure_name = f'{staining}_consolidated_segments'
+        data_hash = figure_data_hash(plot_df, staining, FONT_SIZE, GRID_PARAMS, SEPARATOR_PARAMS,
+                                     create_stain_consolidated_plots)
+        if exporter.is_current(figure_name, data_hash):
+            print(f"{figure_name} is up to date")
+            continue
+
         # Set figure size based on number of segments
         num_segments = len(plot_data)
         plt.figure(figsize=(max(12, num_segments * 2), 8))
@@ -582,17 +1049,20 @@ def create_stain_consolidated_plots(metadata_df, output_dir):
 
         plt.tight_layout()
 
-        # Save plot
-        plt.savefig(os.path.join(output_dir, f'{staining}_consolidated_segments.svg'),
-                    format='svg', bbox_inches='tight')
-        plt.savefig(os.path.join(output_dir, f'{staining}_consolidated_segments.png'),
-                    format='png', dpi=300, bbox_inches='tight')
-        plt.show()
+        # Save plot as SVG and 300-dpi PNG from one layout
+        exporter.export(plt.gcf(), figure_name, data_hash)
+
+    if own_exporter:
+        exporter.close()
 
 
-def perform_statistical_analysis(metadata_df, output_dir):
+def perform_statistical_analysis(metadata_df, output_dir, exporter=None, table=None):
     """Performs ANOVA and Tukey's HSD test for each staining group and segment."""
     all_results = {}
+    own_exporter = exporter is None
+    exporter = FigureExporter(output_dir) if own_exporter else exporter
+    own_table = table is None
+    table = StatisticsTable('histology') if own_table else table
 
     for staining in metadata_df['Staining'].unique():
         staining_mask = metadata_df['Staining'] == staining
@@ -633,24 +1103,21 @@ def perform_statistical_analysis(metadata_df, output_dir):
                 p_value_matrix.loc[group1, group2] = p_value
                 p_value_matrix.loc[group2, group1] = p_value
 
-            # Create heatmap
-            plt.figure(figsize=(10, 8))
-            mask = np.triu(np.ones_like(p_value_matrix, dtype=bool), k=1)
-            sns.heatmap(p_value_matrix, mask=mask,
-                       annot=True, cmap='coolwarm_r',
-                       vmin=0, vmax=1,
-                       fmt='.5f', linewidths=0.5,
-                       square=True)
-            plt.title(f'P-value Heatmap for {staining} ({segment_name})')
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            plt.savefig(os.path.join(output_dir,
-                       f'{staining}_{segment_name}_pvalue_heatmap.svg'),
-                       format='svg')
-            plt.savefig(os.path.join(output_dir,
-                       f'{staining}_{segment_name}_pvalue_heatmap.png'),
-                       format='png', dpi=300)
-            plt.show()
+            # Create heatmap, unless the same p-values were already exported
+            figure_name = f'{staining}_{segment_name}_pvalue_heatmap'
+            data_hash = figure_data_hash(p_value_matrix, staining, segment_name, perform_statistical_analysis)
+            if not exporter.is_current(figure_name, data_hash):
+                plt.figure(figsize=(10, 8))
+                mask = np.triu(np.ones_like(p_value_matrix, dtype=bool), k=1)
+                sns.heatmap(p_value_matrix, mask=mask,
+                           annot=True, cmap='coolwarm_r',
+                           vmin=0, vmax=1,
+                           fmt='.5f', linewidths=0.5,
+                           square=True)
+                plt.title(f'P-value Heatmap for {staining} ({segment_name})')
+                plt.xticks(rotation=45, ha='right')
+                plt.tight_layout()
+                exporter.export(plt.gcf(), figure_name, data_hash, tight=False)
 
             # Calculate descriptive statistics
             desc_stats = analysis_data.groupby('Condition')[percentage_column].agg([
@@ -664,19 +1131,27 @@ def perform_statistical_analysis(metadata_df, output_dir):
                 'descriptive_stats': desc_stats,
                 'analysis_data': analysis_data
             }
+            table.add(staining, segment_name, f_val, p_val, tukey, desc_stats)
 
-            # Save results to file
-            with open(os.path.join(output_dir,
-                     f'{staining}_{segment_name}_statistical_results.txt'), 'w') as f:
-                f.write(f"Statistical Analysis Results for {staining} ({segment_name})\n\n")
-                f.write(f"{anova_result}\n\n")
-                f.write("Tukey's HSD Test Results:\n")
-                f.write(str(tukey.summary()))
-                f.write("\n\nDescriptive Statistics:\n")
-                f.write(str(desc_stats))
-
+    if own_exporter:
+        exporter.close()
+    if own_table:
+        save_statistics(table, output_dir)
     return all_results
 
+def save_statistics(table, output_dir):
+    """Write the consolidated statistics table and, if enabled, the JSON copy and text reports."""
+    paths = table.write(output_dir, write_json=write_statistics_json)
+    if write_text_reports:
+        df = table.to_dataframe()
+        for staining, segment_name in df[['Staining', 'Measure']].drop_duplicates().itertuples(index=False):
+            report_path = os.path.join(output_dir, f'{staining}_{segment_name}_statistical_results.txt')
+            with open(report_path, 'w') as f:
+                f.write(table.text_report(staining, [segment_name]))
+            paths.append(report_path)
+    print(f"Statistical results saved to {paths[0]}")
+    return paths
+
 def create_non_white_percentage_plots(metadata_df, output_dir):
     """Creates plots showing non-white percentages for each segment"""
     updated_df = metadata_df.copy()
@@ -718,15 +1193,24 @@ if __name__ == "__main__":
 
         print("Loading metadata...")
         metadata_df = pd.read_csv(metadata_path)
+        # Images skipped by the Step 2 quality gate have no segmentation results
+        if 'QC_Status' in metadata_df:
+            metadata_df = metadata_df[metadata_df['QC_Status'] != 'skip'].reset_index(drop=True)
 
         print("Creating non-white percentage plots...")
         updated_metadata_df = create_non_white_percentage_plots(metadata_df, output_dir)
 
+        # One exporter for all figures: PNG encoding overlaps with building the next figure
+        exporter = FigureExporter(output_dir, formats=('svg', 'png'), dpi=300)
+
         print("Creating stain-specific consolidated plots...")
-        create_stain_consolidated_plots(updated_metadata_df, output_dir)
+        create_stain_consolidated_plots(updated_metadata_df, output_dir, exporter)
 
         print("Performing statistical analysis...")
-        statistical_results = perform_statistical_analysis(updated_metadata_df, output_dir)
+        table = StatisticsTable('histology')
+        statistical_results = perform_statistical_analysis(updated_metadata_df, output_dir, exporter, table)
+        exporter.close()
+        save_statistics(table, output_dir)
 
         print("\nDetailed statistical results:")
         for (staining, segment_name), results in statistical_results.items():
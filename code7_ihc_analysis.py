@@ -9,6 +9,19 @@ import matplotlib.pyplot as plt
 from IPython.display import display
 import io
 import numpy as np
+from mosaic_stitching import stitch_metadata
+from snapshot_hashing import file_phash, flag_near_duplicates
+
+# Overlapping snapshots of the same condition and staining are stitched into one mosaic per sample.
+# Off by default: only enable it when the snapshots of a replicate really are overlapping fields.
+stitch_snapshots = False
+mosaic_dir = '/content/Mosaics'
+mosaic_fill = 0  # Canvas value outside the snapshots (dark fluorescence background)
+min_stitch_correlation = 0.5  # Tissue-texture correlation below which snapshots are separate fields
+# Re-saved or re-cropped copies of a field are flagged by perceptual hash (Duplicate_Of in the metadata)
+flag_duplicate_snapshots = True
+duplicate_hash_distance = 8  # Differing bits of the 64-bit pHash still counted as the same field
+drop_duplicate_snapshots = False  # Also remove the flagged copies before stitching and analysis
 
 def upload_files():
     uploaded = files.upload()
@@ -48,7 +61,8 @@ def process_image(file_data, filename):
             'Staining': staining,
             'Replicate': replicate,
             'Format': image.format,
-            'OriginalSize': image.size
+            'OriginalSize': image.size,
+            'PHash': f'{file_phash(io.BytesIO(file_data)):016x}'
         }
     except IOError:
         print(f"Error opening image file: {filename}")
@@ -101,6 +115,12 @@ def process_and_display_files():
         display_representative_images(display_images, metadata_list)
 
     df = pd.DataFrame(metadata_list)
+    if flag_duplicate_snapshots and not df.empty:
+        df = flag_near_duplicates(df, duplicate_hash_distance)
+        if drop_duplicate_snapshots:
+            df = df[df['Duplicate_Of'] == ''].reset_index(drop=True)
+    if stitch_snapshots and not df.empty:
+        df = stitch_metadata(df, mosaic_dir, fill=mosaic_fill, min_correlation=min_stitch_correlation)
     display(df)
 
     metadata_path = '/content/metadata.csv'
@@ -125,6 +145,44 @@ import cv2
 from tqdm import tqdm
 import os
 import re
+import time
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from stage_timing import StageTimer
+from spatial_analysis import DepthProfiles, depth_map, depth_profile, labels_from_masks, integral_image, heterogeneity
+from mosaic_stitching import read_image
+from image_qc import quality_gate
+from preview_analysis import run_previews, deviation_report
+
+# Set to True to also write a cProfile dump of the per-image stages to Fluorescence-Analysis/
+profile_stages = False
+# Quality gate before segmentation: focus, clipping, tissue coverage and illumination on a reduced decode
+run_quality_gate = True
+qc_rules = [  # (metric, comparison, threshold, 'flag' or 'skip'); focus is measured at ~512 px
+    ('QC_Tissue_Coverage', '<', 0.02, 'skip'),
+    ('QC_Tissue_Coverage', '<', 0.10, 'flag'),
+    ('QC_Focus', '<', 50.0, 'flag'),
+    ('QC_Saturated_Fraction', '>', 0.05, 'flag'),
+    ('QC_Illumination_Gradient', '>', 0.25, 'flag'),
+]
+# Intensity-class percentages by depth from the tissue boundary (per image and averaged per condition)
+measure_depth_profiles = True
+depth_bin_width = 25  # Pixels per depth bin
+# Patchiness of the intensity classes: tile percentage maps, CV across tiles and Moran's I per grid size
+measure_heterogeneity = True
+heterogeneity_tile_sizes = [64, 128, 256]  # Tile edge lengths in pixels, all derived from one integral image
+min_tile_coverage = 0.5  # Tiles less than half inside the sample are left out
+# 256-bin histogram of the normalized sample pixels per image, for the threshold sweep in Step 3
+save_intensity_histograms = True
+# Object-level readouts of the high- and low-intensity maps (per-object CSVs plus summary metadata)
+measure_morphometrics = True
+min_object_area = 5  # Pixels; smaller connected components are treated as noise
+morphometrics_tile_rows = 2048  # Rows labelled at a time; objects crossing tile seams are merged
+# Preview mode: sample detection, intensity classes and percentages on a 4x or 8x reduced decode with the
+# global ranges of the last full run, plus a small overlay per image (Fluorescence-Analysis/Preview)
+preview_mode = False
+preview_factor = 4  # 4 or 8
+report_preview_deviation = False  # Also compare the preview with full resolution (Preview_Deviation.csv)
 
 def sanitize_filename(name):
     return re.sub(r'[^\w\-_]', '_', name)
@@ -280,6 +338,110 @@ def calculate_statistics(sample_mask, high_intensity_mask, low_intensity_mask, u
         'total_stained_percentage': total_stained_percentage
     }
 
+def label_tiles(mask, tile_rows):
+    """Label 8-connected components of `mask` one row band at a time.
+
+    Returns per-component raw sums (area, x, y, x^2, y^2, xy) and bounding boxes, plus the pairs of
+    components that touch across a band seam. Centroids and boxes come from the stats array of
+    cv2.connectedComponentsWithStats; only the second moments need a pass over the pixels.
+    """
+    sums, boxes, seam_pairs = [], [], []
+    offset, previous_row = 0, None
+    for top in range(0, mask.shape[0], tile_rows):
+        band = mask[top:top + tile_rows]
+        n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(band, connectivity=8, ltype=cv2.CV_32S)
+        area = stats[1:, cv2.CC_STAT_AREA].astype(np.float64)
+        ys, xs = np.nonzero(labels)
+        pixel_labels = labels[ys, xs] - 1
+        xs, ys = xs.astype(np.float64), ys.astype(np.float64) + top
+        sums.append(np.column_stack([
+            area,
+            centroids[1:, 0] * area,
+            (centroids[1:, 1] + top) * area,
+            np.bincount(pixel_labels, weights=xs * xs, minlength=n_labels - 1),
+            np.bincount(pixel_labels, weights=ys * ys, minlength=n_labels - 1),
+            np.bincount(pixel_labels, weights=xs * ys, minlength=n_labels - 1)]))
+        left, band_top = stats[1:, cv2.CC_STAT_LEFT], stats[1:, cv2.CC_STAT_TOP] + top
+        boxes.append(np.column_stack([left, band_top, left + stats[1:, cv2.CC_STAT_WIDTH],
+                                      band_top + stats[1:, cv2.CC_STAT_HEIGHT]]))
+
+        if previous_row is not None:
+            # 8-connectivity across the seam: each pixel touches the three pixels below it
+            upper, lower = previous_row, labels[0]
+            for shift in (-1, 0, 1):
+                a = upper[max(0, -shift):len(upper) - max(0, shift)]
+                b = lower[max(0, shift):len(lower) - max(0, -shift)]
+                touching = (a > 0) & (b > 0)
+                seam_pairs.append(np.column_stack([a[touching] - 1 + previous_offset,
+                                                   b[touching] - 1 + offset]))
+        previous_row, previous_offset = labels[-1], offset
+        offset += n_labels - 1
+    return np.vstack(sums), np.vstack(boxes), np.vstack(seam_pairs) if seam_pairs else np.empty((0, 2), int)
+
+def measure_objects(mask, tile_rows=morphometrics_tile_rows, min_area=min_object_area):
+    """Per-object morphometrics of a binary mask, with objects spanning tile seams merged."""
+    sums, boxes, seam_pairs = label_tiles(mask, tile_rows)
+    n_components = len(sums)
+    if n_components == 0:
+        return pd.DataFrame(columns=['Object_ID', 'Area', 'Centroid_X', 'Centroid_Y', 'BBox_Left', 'BBox_Top',
+                                     'BBox_Width', 'BBox_Height', 'Major_Axis', 'Minor_Axis', 'Eccentricity',
+                                     'Extent', 'Equivalent_Diameter'])
+
+    # Components joined across seams form one object
+    graph = coo_matrix((np.ones(len(seam_pairs)), (seam_pairs[:, 0], seam_pairs[:, 1])),
+                       shape=(n_components, n_components))
+    n_objects, object_ids = connected_components(graph, directed=False)
+    totals = np.stack([np.bincount(object_ids, weights=sums[:, k], minlength=n_objects) for k in range(6)], axis=1)
+    lower = np.full((n_objects, 2), np.iinfo(np.int64).max)
+    upper = np.zeros((n_objects, 2), dtype=np.int64)
+    np.minimum.at(lower, object_ids, boxes[:, :2])
+    np.maximum.at(upper, object_ids, boxes[:, 2:])
+
+    # Central second moments -> principal axes of the equivalent ellipse
+    area = totals[:, 0]
+    mean_x, mean_y = totals[:, 1] / area, totals[:, 2] / area
+    var_x = np.maximum(totals[:, 3] / area - mean_x ** 2, 0)
+    var_y = np.maximum(totals[:, 4] / area - mean_y ** 2, 0)
+    cov_xy = totals[:, 5] / area - mean_x * mean_y
+    spread = np.sqrt(((var_x - var_y) / 2) ** 2 + cov_xy ** 2)
+    major_var = (var_x + var_y) / 2 + spread
+    minor_var = np.maximum((var_x + var_y) / 2 - spread, 0)
+    eccentricity = np.sqrt(1 - np.divide(minor_var, major_var, out=np.ones_like(major_var), where=major_var > 0))
+    width, height = upper[:, 0] - lower[:, 0], upper[:, 1] - lower[:, 1]
+
+    objects = pd.DataFrame({
+        'Area': area.astype(np.int64),
+        'Centroid_X': mean_x,
+        'Centroid_Y': mean_y,
+        'BBox_Left': lower[:, 0],
+        'BBox_Top': lower[:, 1],
+        'BBox_Width': width,
+        'BBox_Height': height,
+        'Major_Axis': 4 * np.sqrt(major_var),
+        'Minor_Axis': 4 * np.sqrt(minor_var),
+        'Eccentricity': eccentricity,
+        'Extent': area / (width * height),
+        'Equivalent_Diameter': np.sqrt(4 * area / np.pi),
+    })
+    objects = objects[objects['Area'] >= min_area].sort_values(['BBox_Top', 'BBox_Left']).reset_index(drop=True)
+    objects.insert(0, 'Object_ID', np.arange(1, len(objects) + 1))
+    return objects
+
+def summarize_objects(objects, sample_area, prefix):
+    """Per-sample count, size distribution and shape of the objects of one intensity class."""
+    areas = objects['Area'].to_numpy()
+    has_objects = len(areas) > 0
+    p10, median, p90 = np.percentile(areas, [10, 50, 90]) if has_objects else (np.nan,) * 3
+    return {
+        f'{prefix}_Object_Count': len(areas),
+        f'{prefix}_Objects_Per_MPx': len(areas) / (sample_area / 1e6) if sample_area > 0 else np.nan,
+        f'{prefix}_Object_Mean_Area': areas.mean() if has_objects else np.nan,
+        f'{prefix}_Object_Median_Area': median,
+        f'{prefix}_Object_Area_P10': p10,
+        f'{prefix}_Object_Area_P90': p90,
+        f'{prefix}_Object_Mean_Eccentricity': objects['Eccentricity'].mean() if has_objects else np.nan,
+    }
+
 def display_results(original, normalized, sample_mask, high_intensity_mask, low_intensity_mask,
                    unstained_mask, stats, image_path, stain_type, intensity_range):
     """Display analysis results with global threshold information"""
@@ -335,52 +497,109 @@ def display_results(original, normalized, sample_mask, high_intensity_mask, low_
     plt.tight_layout(rect=[0, 0.03, 1, 0.95])
     return fig
 
-def load_image(image_path):
-    """Load image in grayscale"""
-    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+def load_image(image_path, factor=1):
+    """Load image in grayscale, at 1/factor scale for factor 2, 4 or 8 (JPEGs are decoded directly reduced)"""
+    flags = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+             8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+    image = read_image(image_path, flags[factor])
     if image is None:
         raise ValueError(f"Failed to load image: {image_path}")
     return image
 
-def process_image(metadata_df, index, stain_type, intensity_range):
+def process_image(metadata_df, index, stain_type, intensity_range, timer=None, profiles=None):
     """Process a single image using global intensity thresholds"""
     image_path = metadata_df.at[index, 'FilePath']
     if not os.path.exists(image_path):
         print(f"Image not found: {image_path}")
         return
+    timer = StageTimer() if timer is None else timer
+    image_name = os.path.basename(image_path)
 
     try:
         # Load and preprocess image
-        image = load_image(image_path)
-        normalized = normalize_image(image)
-        sample_mask = detect_sample_region(normalized)
+        with timer.span(image_name, 'Decode'):
+            image = load_image(image_path)
+        with timer.span(image_name, 'CLAHE'):
+            normalized = normalize_image(image)
+        with timer.span(image_name, 'Masking'):
+            sample_mask = detect_sample_region(normalized)
 
         # Get all three masks
-        high_intensity_mask, low_intensity_mask, unstained_mask = detect_stained_regions_global(
-            normalized, sample_mask, intensity_range
-        )
+        with timer.span(image_name, 'Classification'):
+            high_intensity_mask, low_intensity_mask, unstained_mask = detect_stained_regions_global(
+                normalized, sample_mask, intensity_range
+            )
 
-        # Calculate statistics with all three masks
-        stats = calculate_statistics(sample_mask, high_intensity_mask, low_intensity_mask, unstained_mask)
+            # Calculate statistics with all three masks
+            stats = calculate_statistics(sample_mask, high_intensity_mask, low_intensity_mask, unstained_mask)
 
         # Create output directory if it doesn't exist
         output_dir = 'Fluorescence-Analysis'
         os.makedirs(output_dir, exist_ok=True)
 
+        # Every threshold pair can be re-applied later from the histogram and the global range
+        base_filename = os.path.splitext(os.path.basename(image_path))[0]
+        sanitized_stain = sanitize_filename(stain_type)
+        if save_intensity_histograms:
+            with timer.span(image_name, 'Intensity_Histogram'):
+                histogram_path = os.path.join(output_dir, f"{base_filename}-{sanitized_stain}-intensity-histogram.npy")
+                np.save(histogram_path, np.bincount(normalized[sample_mask > 0], minlength=256))
+                metadata_df.at[index, 'Intensity_Histogram_Path'] = histogram_path
+                metadata_df.at[index, 'Global_Intensity_Min'] = float(intensity_range['min'])
+                metadata_df.at[index, 'Global_Intensity_Max'] = float(intensity_range['max'])
+
+        # Object-level morphometrics of the high- and low-intensity maps
+        if measure_morphometrics:
+            with timer.span(image_name, 'Morphometrics'):
+                for prefix, class_mask in (('High', high_intensity_mask), ('Low', low_intensity_mask)):
+                    objects = measure_objects(class_mask)
+                    objects_path = os.path.join(output_dir, f"{base_filename}-{sanitized_stain}-{prefix}-objects.csv")
+                    objects.to_csv(objects_path, index=False)
+                    metadata_df.at[index, f'{prefix}_Objects_Path'] = objects_path
+                    for column, value in summarize_objects(objects, stats['total_sample_area'], prefix).items():
+                        metadata_df.at[index, column] = value
+
+        # Edge-to-core profile of the intensity classes
+        if measure_depth_profiles:
+            with timer.span(image_name, 'Depth_Profile'):
+                labels = labels_from_masks([unstained_mask, low_intensity_mask, high_intensity_mask])
+                profile = depth_profile(labels, ['Unstained', 'Low_Intensity', 'High_Intensity'],
+                                        depth_map(sample_mask), depth_bin_width)
+                profile_path = os.path.join(output_dir, f"{base_filename}-{sanitized_stain}-depth-profile.csv")
+                profile.to_csv(profile_path, index=False)
+                metadata_df.at[index, 'Depth_Profile_Path'] = profile_path
+                if profiles is not None:
+                    profiles.add(profile, image_name, stain_type, metadata_df.at[index, 'Condition'])
+
+        # Tile-grid heterogeneity of the intensity classes
+        if measure_heterogeneity:
+            with timer.span(image_name, 'Heterogeneity'):
+                high_integral, low_integral = integral_image(high_intensity_mask), integral_image(low_intensity_mask)
+                class_integrals = {'High_Intensity': high_integral, 'Low_Intensity': low_integral,
+                                   'Total_Stained': high_integral + low_integral}
+                summary, tiles = heterogeneity(class_integrals, integral_image(sample_mask),
+                                               heterogeneity_tile_sizes, min_tile_coverage)
+                tiles_path = os.path.join(output_dir, f"{base_filename}-{sanitized_stain}-heterogeneity-tiles.csv")
+                tiles.to_csv(tiles_path, index=False)
+                metadata_df.at[index, 'Heterogeneity_Tiles_Path'] = tiles_path
+                for row in summary.itertuples():
+                    metadata_df.at[index, f'{row.Class}_Tile_CV_{row.Tile_px}px'] = row.CV
+                    metadata_df.at[index, f'{row.Class}_Morans_I_{row.Tile_px}px'] = row.Morans_I
+
         # Display results with all three masks
-        fig = display_results(
-            image, normalized, sample_mask,
-            high_intensity_mask, low_intensity_mask, unstained_mask,
-            stats, image_path, stain_type, intensity_range
-        )
+        with timer.span(image_name, 'Rendering'):
+            fig = display_results(
+                image, normalized, sample_mask,
+                high_intensity_mask, low_intensity_mask, unstained_mask,
+                stats, image_path, stain_type, intensity_range
+            )
 
         # Save results
-        base_filename = os.path.splitext(os.path.basename(image_path))[0]
-        sanitized_stain = sanitize_filename(stain_type)
-        results_filename = f"{base_filename}-{sanitized_stain}-analysis.png"
-        results_path = os.path.join(output_dir, results_filename)
-        fig.savefig(results_path)
-        plt.close(fig)  # Close the figure to free memory
+        with timer.span(image_name, 'Encoding'):
+            results_filename = f"{base_filename}-{sanitized_stain}-analysis.png"
+            results_path = os.path.join(output_dir, results_filename)
+            fig.savefig(results_path)
+            plt.close(fig)  # Close the figure to free memory
 
         # Update metadata
         metadata_df.at[index, 'Analysis_Path'] = results_path
@@ -392,34 +611,124 @@ def process_image(metadata_df, index, stain_type, intensity_range):
         metadata_df.at[index, 'Low_Intensity_Percentage'] = stats['low_intensity_percentage']
         metadata_df.at[index, 'Unstained_Percentage'] = stats['unstained_percentage']
         metadata_df.at[index, 'Total_Stained_Percentage'] = stats['total_stained_percentage']
+        timer.update_metadata(metadata_df, index, image_name)
 
     except Exception as e:
         print(f"Error processing image {image_path}: {e}")
 
-def process_stain_group(metadata_df, stain_type, intensity_range):
+def detect_sample_region_scaled(image, factor):
+    """detect_sample_region with its kernels scaled to an image decoded at 1/factor (factor 1: defaults)"""
+    odd = lambda size: max(3, size // factor) | 1
+    return detect_sample_region(image, blur_size=odd(45), large_kernel_size=odd(35), smooth_kernel_size=odd(7))
+
+def preview_intensity_range(metadata_df, stain_type, factor=preview_factor):
+    """Global range of the last full run (Global_Intensity_Min/Max), else collected from reduced decodes"""
+    stain_rows = metadata_df[metadata_df['Staining'] == stain_type]
+    if {'Global_Intensity_Min', 'Global_Intensity_Max'} <= set(stain_rows.columns):
+        cached = stain_rows[['Global_Intensity_Min', 'Global_Intensity_Max']].dropna()
+        if not cached.empty:
+            return {'min': cached['Global_Intensity_Min'].iloc[0], 'max': cached['Global_Intensity_Max'].iloc[0]}
+    low, high = 255, 0
+    for image_path in stain_rows['FilePath']:
+        if not os.path.exists(image_path):
+            continue
+        normalized = normalize_image(load_image(image_path, factor))
+        sample_pixels = normalized[detect_sample_region_scaled(normalized, factor) > 0]
+        if len(sample_pixels) > 0:
+            low, high = min(low, int(sample_pixels.min())), max(high, int(sample_pixels.max()))
+    if low > high:
+        raise ValueError(f"No valid pixels found for stain type: {stain_type}")
+    return {'min': low, 'max': high}
+
+def preview_image(image_path, stain_type, intensity_range, factor=preview_factor, overlay_side=512):
+    """Intensity-class percentages and a small overlay from a 1/factor decode, for checks during acquisition.
+
+    Runs the Step 2 normalization, sample detection (kernels scaled to the decode) and classification.
+    factor=1 runs the same steps at full resolution, which is the reference for the preview.
+    """
+    start = time.perf_counter()
+    normalized = normalize_image(load_image(image_path, factor))
+    sample_mask = detect_sample_region_scaled(normalized, factor)
+    high_intensity_mask, low_intensity_mask, unstained_mask = detect_stained_regions_global(
+        normalized, sample_mask, intensity_range)
+    stats = calculate_statistics(sample_mask, high_intensity_mask, low_intensity_mask, unstained_mask)
+    percentages = {'High_Intensity_Percentage': stats['high_intensity_percentage'],
+                   'Low_Intensity_Percentage': stats['low_intensity_percentage'],
+                   'Unstained_Percentage': stats['unstained_percentage'],
+                   'Total_Stained_Percentage': stats['total_stained_percentage']}
+    seconds = time.perf_counter() - start
+
+    # High intensity tinted red and low intensity yellow, sample outline in cyan, long side scaled to overlay_side
+    overlay = cv2.cvtColor(normalized, cv2.COLOR_GRAY2RGB).astype(np.float32)
+    for class_mask, tint in ((high_intensity_mask, (255, 0, 0)), (low_intensity_mask, (255, 255, 0))):
+        selected = class_mask > 0
+        overlay[selected] = 0.5 * overlay[selected] + 0.5 * np.array(tint, dtype=np.float32)
+    overlay = overlay.astype(np.uint8)
+    contours, _ = cv2.findContours(sample_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cv2.drawContours(overlay, contours, -1, (0, 255, 255), max(1, overlay.shape[1] // 400))
+    scale = min(1.0, overlay_side / max(overlay.shape[:2]))
+    overlay = cv2.resize(overlay, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return {'percentages': percentages, 'sample_pixels': int(stats['total_sample_area']), 'seconds': seconds,
+            'factor': factor, 'overlay': overlay}
+
+def stain_preview(metadata_df, stain_type):
+    """Preview function of one stain for preview_analysis, with its global range looked up once.
+
+    The full-resolution reference of the deviation report uses the same range, so the differences
+    come from the reduced decode alone.
+    """
+    intensity_range = preview_intensity_range(metadata_df, stain_type)
+    return lambda image_path, factor: preview_image(image_path, stain_type, intensity_range, factor)
+
+def process_stain_group(metadata_df, stain_type, intensity_range, timer=None, profiles=None):
     """Process all images for a specific stain type using global intensity range"""
     print(f"\nProcessing {stain_type} stained images:")
     stain_indices = metadata_df.index[metadata_df['Staining'] == stain_type]
 
     for index in tqdm(stain_indices, desc=f"Processing {stain_type} images"):
-        process_image(metadata_df, index, stain_type, intensity_range)
+        process_image(metadata_df, index, stain_type, intensity_range, timer, profiles)
 
 def main():
     metadata_df = load_metadata('metadata.csv')
     stain_types = detect_stain_types(metadata_df)
     print(f"Detected stain types: {stain_types}")
+    if preview_mode:
+        output_dir = os.path.join('Fluorescence-Analysis', 'Preview')
+        results = run_previews(metadata_df, stain_preview, preview_factor, output_dir)
+        if report_preview_deviation:
+            deviation_report(metadata_df, stain_preview, (4, 8), output_dir)
+        return results
+
+    timer = StageTimer(profile=profile_stages)
+    profiles = DepthProfiles()
+    if run_quality_gate:
+        passed = quality_gate(metadata_df, qc_rules, background='dark', timer=timer)
+    else:
+        passed = pd.Series(True, index=metadata_df.index)
+    analysis_df = metadata_df[passed].copy()
 
-    # First pass: calculate global intensity ranges for each stain type
+    # First pass: calculate global intensity ranges for each stain type (skipped images excluded)
     intensity_ranges = {}
     for stain_type in stain_types:
-        intensity_ranges[stain_type] = get_global_intensity_range(metadata_df, stain_type)
+        if not (analysis_df['Staining'] == stain_type).any():
+            print(f"All {stain_type} images were skipped by the quality gate. Skipping.")
+            continue
+        try:
+            intensity_ranges[stain_type] = get_global_intensity_range(analysis_df, stain_type)
+        except ValueError as e:
+            print(f"{e}. Skipping.")
 
     # Second pass: process images using global thresholds
-    for stain_type in stain_types:
-        process_stain_group(metadata_df, stain_type, intensity_ranges[stain_type])
+    for stain_type, intensity_range in intensity_ranges.items():
+        process_stain_group(analysis_df, stain_type, intensity_range, timer, profiles)
 
+    # Images skipped by the quality gate keep their QC columns and get no results
+    metadata_df = pd.concat([analysis_df, metadata_df[~passed]]).sort_index()
     metadata_df.to_csv('metadata.csv', index=False)
     print("Updated metadata saved to metadata.csv")
+    timer.write_reports('Fluorescence-Analysis')
+    if measure_depth_profiles:
+        profiles.write('Fluorescence-Analysis')
 
 if __name__ == "__main__":
     main()
@@ -435,10 +744,25 @@ import os
 import re
 import seaborn as sns
 from scipy import stats
+from functools import lru_cache
+from types import SimpleNamespace
+from scipy.interpolate import CubicSpline
+from scipy.stats import studentized_range
 from statsmodels.stats.multicomp import pairwise_tukeyhsd
+from figure_export import FigureExporter, figure_data_hash
+from statistics_table import StatisticsTable
 import warnings
 warnings.filterwarnings('ignore')
 
+# All ANOVA/Tukey/descriptive results go to Statistical_Results.csv; these add the optional outputs
+write_statistics_json = False  # Also write Statistical_Results.json
+write_text_reports = False  # Also render the per-stain *_statistical_results.txt reports
+# Threshold sensitivity: rerun ANOVA/Tukey for a grid of (unstained/low, low/high) cut points, given as
+# fractions of the global intensity span, from the histograms saved by Step 2 (no pixels are read)
+run_threshold_sweep = False
+sweep_lower_fractions = [0.05, 0.10, 0.15, 0.20, 0.25, 0.30, 0.35, 0.40]
+sweep_upper_fractions = [0.30, 0.35, 0.40, 0.45, 0.50, 0.55, 0.60, 0.65, 0.70, 0.75, 0.80]
+
 def sanitize_filename(name):
     return re.sub(r'[^\w\-_]', '_', name)
 
@@ -455,7 +779,7 @@ def load_metadata(file_path):
 def detect_stain_types(metadata_df):
     return metadata_df['Staining'].unique()
 
-def create_analysis_plots(metadata_df, stain_type, output_dir):
+def create_analysis_plots(metadata_df, stain_type, output_dir, exporter=None):
     """Creates statistical plots for a specific stain type with total/low/high intensity boxes"""
 
     # Style parameters - adjust these values to modify the plot appearance
@@ -511,6 +835,18 @@ def create_analysis_plots(metadata_df, stain_type, output_dir):
     # Concatenate in the desired order: Total, Low, High
     plot_data = pd.concat([total_data, low_data, high_data])
 
+    # Skip building the plot when its data and style are unchanged since the last export
+    figure_name = f'{sanitize_filename(stain_type)}_boxplot'
+    data_hash = figure_data_hash(plot_data, stain_type, FONT_SIZE, GRID_PARAMS, SEPARATOR_PARAMS, COLOR_PALETTE,
+                                 create_analysis_plots)
+    own_exporter = exporter is None
+    exporter = FigureExporter(output_dir) if own_exporter else exporter
+    if exporter.is_current(figure_name, data_hash):
+        print(f"{figure_name} is up to date")
+        if own_exporter:
+            exporter.close()
+        return
+
     # Create figure
     plt.figure(figsize=(12, 6))
 
@@ -566,19 +902,21 @@ def create_analysis_plots(metadata_df, stain_type, output_dir):
 
     plt.tight_layout()
 
-    # Save plots
-    plt.savefig(os.path.join(output_dir, f'{sanitize_filename(stain_type)}_boxplot.svg'),
-                format='svg', bbox_inches='tight')
-    plt.savefig(os.path.join(output_dir, f'{sanitize_filename(stain_type)}_boxplot.png'),
-                format='png', dpi=300, bbox_inches='tight')
-    plt.show()
+    # Save plots as SVG and 300-dpi PNG from one layout
+    exporter.export(plt.gcf(), figure_name, data_hash)
+    if own_exporter:
+        exporter.close()
 
-def perform_statistical_analysis(metadata_df, stain_type, output_dir):
+def perform_statistical_analysis(metadata_df, stain_type, output_dir, exporter=None, table=None):
     """Performs statistical analysis for both high and low intensity measurements"""
     stain_data = metadata_df[metadata_df['Staining'] == stain_type]
 
     if 'Condition' not in stain_data.columns:
         return None
+    own_exporter = exporter is None
+    exporter = FigureExporter(output_dir) if own_exporter else exporter
+    own_table = table is None
+    table = StatisticsTable('fluorescence') if own_table else table
 
     # Perform analysis for both intensity levels and total
     intensity_levels = ['High_Intensity_Percentage', 'Low_Intensity_Percentage', 'Total_Stained_Percentage']
@@ -602,6 +940,7 @@ def perform_statistical_analysis(metadata_df, stain_type, output_dir):
             'tukey_results': tukey,
             'descriptive_stats': desc_stats
         }
+        table.add(stain_type, intensity, f_val, p_val, tukey, desc_stats)
 
         # Create p-value heatmap for each intensity level
         conditions = sorted(stain_data['Condition'].unique())
@@ -612,6 +951,13 @@ def perform_statistical_analysis(metadata_df, stain_type, output_dir):
             p_value_matrix.loc[group1, group2] = p_value
             p_value_matrix.loc[group2, group1] = p_value
 
+        # Skip the heatmap when the same p-values were already exported
+        intensity_label = intensity.split('_')[0].lower()
+        figure_name = f'{sanitize_filename(stain_type)}_{intensity_label}_pvalue_heatmap'
+        data_hash = figure_data_hash(p_value_matrix, stain_type, intensity, perform_statistical_analysis)
+        if exporter.is_current(figure_name, data_hash):
+            continue
+
         plt.figure(figsize=(10, 8))
         mask = np.triu(np.ones_like(p_value_matrix, dtype=bool), k=1)
         sns.heatmap(p_value_matrix, mask=mask, annot=True, cmap='coolwarm_r',
@@ -620,33 +966,175 @@ def perform_statistical_analysis(metadata_df, stain_type, output_dir):
         plt.xticks(rotation=45, ha='right')
         plt.tight_layout()
 
-        # Save heatmap
-        intensity_label = intensity.split('_')[0].lower()
-        plt.savefig(os.path.join(output_dir,
-                   f'{sanitize_filename(stain_type)}_{intensity_label}_pvalue_heatmap.svg'),
-                   format='svg')
-        plt.savefig(os.path.join(output_dir,
-                   f'{sanitize_filename(stain_type)}_{intensity_label}_pvalue_heatmap.png'),
-                   format='png', dpi=300)
-        plt.show()
-
-    # Save statistical results to file
-    results_path = os.path.join(output_dir, f'{sanitize_filename(stain_type)}_statistical_results.txt')
-    with open(results_path, 'w') as f:
-        f.write(f"Statistical Analysis Results for {stain_type}\n\n")
-
-        for intensity in intensity_levels:
-            intensity_label = intensity.split('_')[0]
-            f.write(f"\n{intensity_label} Intensity Results:\n")
-            f.write(f"One-way ANOVA p-value: {results[intensity]['anova_pvalue']:.5f}\n\n")
-            f.write(f"Tukey's HSD Test Results:\n")
-            f.write(str(results[intensity]['tukey_results'].summary()))
-            f.write("\n\nDescriptive Statistics:\n")
-            f.write(str(results[intensity]['descriptive_stats']))
-            f.write("\n" + "="*50 + "\n")
+        # Save heatmap as SVG and 300-dpi PNG from one layout
+        exporter.export(plt.gcf(), figure_name, data_hash, tight=False)
+
+    if own_exporter:
+        exporter.close()
+
+    if own_table:
+        save_statistics(table, output_dir)
+    return results
 
+def threshold_class_percentages(cumulative, intensity_min, intensity_max, lower_fraction, upper_fraction):
+    """High/low/total stained percentages of every image for one threshold pair, as Step 2 computes them.
+
+    `cumulative` holds the cumulative 256-bin histograms (images x 256), so the number of pixels at or
+    below a threshold is one lookup per image.
+    """
+    span = intensity_max - intensity_min
+    lower_threshold = intensity_min + span * lower_fraction
+    middle_threshold = intensity_min + span * upper_fraction
+    total = cumulative[:, -1].astype(np.float64)
+
+    def at_or_below(threshold):
+        value = int(np.floor(threshold))
+        return np.zeros(len(cumulative)) if value < 0 else cumulative[:, min(value, 255)]
+
+    unstained = at_or_below(lower_threshold)
+    high = total - at_or_below(middle_threshold)
+    low = total - unstained - high
+    percentage = lambda pixels: np.divide(pixels * 100, total, out=np.zeros(len(total)), where=total > 0)
+    return {'High_Intensity_Percentage': percentage(high), 'Low_Intensity_Percentage': percentage(low),
+            'Total_Stained_Percentage': percentage(high + low)}
+
+@lru_cache(maxsize=None)
+def tukey_critical_value(n_groups, df, alpha=0.05):
+    return studentized_range.ppf(1 - alpha, n_groups, df)
+
+@lru_cache(maxsize=None)
+def studentized_range_sf(n_groups, df, points=64, tail=1e-6):
+    """Fast survival function of the studentized range for a fixed number of groups and df.
+
+    scipy integrates the distribution numerically on every call (tens of ms per value). A cubic
+    spline through log sf at `points` values spaced evenly in log(1 + q), up to the q where sf falls
+    below `tail`, reproduces it to within 3e-5 for 2-8 groups and df 2-60; beyond that q the power-law
+    tail is extrapolated, so larger q still gives smaller p-values.
+    """
+    q_max = 4 * tukey_critical_value(n_groups, df)
+    while studentized_range.sf(q_max, n_groups, df) > tail:  # Heavy tails at small df
+        q_max *= 2
+    q = np.expm1(np.linspace(0, np.log1p(q_max), points))
+    log_sf = np.log(np.maximum(studentized_range.sf(q, n_groups, df), np.finfo(float).tiny))
+    spline = CubicSpline(q, log_sf)
+    tail_slope = (log_sf[-1] - log_sf[-2]) / (np.log(q[-1]) - np.log(q[-2]))
+
+    def sf(values):
+        values = np.asarray(values, dtype=np.float64)
+        inside = spline(np.minimum(values, q_max))
+        beyond = log_sf[-1] + tail_slope * np.log(np.maximum(values, q_max) / q_max)
+        return np.clip(np.exp(np.where(values > q_max, beyond, inside)), 0, 1)
+    return sf
+
+def anova_tukey_grid(values, conditions, alpha=0.05):
+    """One-way ANOVA and Tukey HSD for many variants of one measure over the same images.
+
+    `values` is (variants x images). Returns one (F, p, tukey, descriptive stats) tuple per variant,
+    where `tukey` carries the attributes of a pairwise_tukeyhsd result that StatisticsTable reads.
+    Group sizes and df are shared by all variants, so the Tukey critical value and p-value
+    function are computed once.
+    """
+    groups, codes = np.unique(conditions, return_inverse=True)
+    n_groups, df_within = len(groups), len(conditions) - len(groups)
+    counts = np.bincount(codes, minlength=n_groups)
+    one_hot = np.eye(n_groups)[codes]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = values @ one_hot / counts
+        group_ss = (values - means[:, codes]) ** 2 @ one_hot
+        mse = group_ss.sum(axis=1) / df_within
+        ss_between = ((means - values.mean(axis=1, keepdims=True)) ** 2 * counts).sum(axis=1)
+        f_values = ss_between / (n_groups - 1) / mse
+        p_values = stats.f.sf(f_values, n_groups - 1, df_within)
+
+        first, second = np.triu_indices(n_groups, 1)
+        mean_diffs = means[:, second] - means[:, first]
+        std_pairs = np.sqrt(mse[:, np.newaxis] / 2 * (1 / counts[first] + 1 / counts[second]))
+        q_crit = tukey_critical_value(n_groups, df_within, alpha)
+        tukey_p = studentized_range_sf(n_groups, df_within)(np.abs(mean_diffs) / std_pairs)
+        stds = np.sqrt(group_ss / (counts - 1))
+
+    results = []
+    for v in range(len(values)):
+        tukey = SimpleNamespace(groupsunique=groups, meandiffs=mean_diffs[v], pvalues=tukey_p[v],
+                                confint=np.column_stack([mean_diffs[v] - q_crit * std_pairs[v],
+                                                         mean_diffs[v] + q_crit * std_pairs[v]]),
+                                reject=np.abs(mean_diffs[v]) > q_crit * std_pairs[v])
+        desc_stats = pd.DataFrame({'count': counts, 'mean': means[v], 'std': stds[v],
+                                   'sem': stds[v] / np.sqrt(counts)}, index=pd.Index(groups, name='Condition'))
+        results.append((f_values[v], p_values[v], tukey, desc_stats))
     return results
 
+def threshold_sensitivity_sweep(metadata_df, stain_type, output_dir, exporter=None, table=None):
+    """ANOVA/Tukey of the intensity classes over the threshold grid; returns the ANOVA p-values."""
+    if 'Intensity_Histogram_Path' not in metadata_df.columns:
+        print("No intensity histograms in the metadata; run Step 2 with save_intensity_histograms = True")
+        return None
+    stain_data = metadata_df[metadata_df['Staining'] == stain_type].dropna(subset=['Intensity_Histogram_Path'])
+    if stain_data.empty:
+        return None
+    own_exporter = exporter is None
+    exporter = FigureExporter(output_dir) if own_exporter else exporter
+    own_table = table is None
+    table = StatisticsTable('fluorescence') if own_table else table
+
+    cumulative = np.cumsum(np.stack([np.load(path) for path in stain_data['Intensity_Histogram_Path']]), axis=1)
+    intensity_min, intensity_max = stain_data['Global_Intensity_Min'].iloc[0], stain_data['Global_Intensity_Max'].iloc[0]
+    grid = [(lower_fraction, upper_fraction) for lower_fraction in sweep_lower_fractions
+            for upper_fraction in sweep_upper_fractions if lower_fraction < upper_fraction]
+
+    # Class percentages of every image at every grid point, then all grid points of a class at once
+    percentages = [threshold_class_percentages(cumulative, intensity_min, intensity_max, *thresholds)
+                   for thresholds in grid]
+    anova_rows = []
+    for intensity in percentages[0]:
+        values = np.stack([point[intensity] for point in percentages])
+        for (lower_fraction, upper_fraction), (f_val, p_val, tukey, desc_stats) in zip(
+                grid, anova_tukey_grid(values, stain_data['Condition'].to_numpy())):
+            table.add(stain_type, intensity, f_val, p_val, tukey, desc_stats,
+                      Lower_Fraction=lower_fraction, Upper_Fraction=upper_fraction)
+            anova_rows.append({'Measure': intensity, 'Lower_Fraction': lower_fraction,
+                               'Upper_Fraction': upper_fraction, 'P_Value': p_val})
+    anova = pd.DataFrame(anova_rows)
+
+    # One ANOVA p-value map per intensity class; the Step 2 defaults (0.2, 0.5) are outlined
+    figure_name = f'{sanitize_filename(stain_type)}_threshold_sweep_heatmap'
+    data_hash = figure_data_hash(anova, stain_type, threshold_sensitivity_sweep)
+    if not exporter.is_current(figure_name, data_hash):
+        measures = list(dict.fromkeys(anova['Measure']))
+        fig, axes = plt.subplots(1, len(measures), figsize=(7 * len(measures), 6))
+        for ax, intensity in zip(np.atleast_1d(axes), measures):
+            grid = anova[anova['Measure'] == intensity].pivot(index='Lower_Fraction', columns='Upper_Fraction',
+                                                               values='P_Value')
+            sns.heatmap(grid, ax=ax, cmap='coolwarm_r', vmin=0, vmax=1, annot=grid.size <= 150, fmt='.3f',
+                        annot_kws={'size': 7}, linewidths=0.5, cbar_kws={'label': 'ANOVA p-value'})
+            if 0.2 in grid.index and 0.5 in grid.columns:
+                ax.add_patch(plt.Rectangle((list(grid.columns).index(0.5), list(grid.index).index(0.2)), 1, 1,
+                                           fill=False, edgecolor='black', linewidth=2))
+            ax.set_title(intensity.replace('_', ' '))
+            ax.set_xlabel('Low/high cut point (fraction of intensity span)')
+            ax.set_ylabel('Unstained/low cut point (fraction of intensity span)')
+        fig.suptitle(f'Threshold Sensitivity of Condition Differences for {stain_type}')
+        fig.tight_layout()
+        exporter.export(fig, figure_name, data_hash)
+
+    if own_exporter:
+        exporter.close()
+    if own_table:
+        table.write(output_dir, name='Threshold_Sweep_Results')
+    return anova
+
+def save_statistics(table, output_dir):
+    """Write the consolidated statistics table and, if enabled, the JSON copy and text reports."""
+    paths = table.write(output_dir, write_json=write_statistics_json)
+    if write_text_reports:
+        for stain_type in table.to_dataframe()['Staining'].unique():
+            report_path = os.path.join(output_dir, f'{sanitize_filename(stain_type)}_statistical_results.txt')
+            with open(report_path, 'w') as f:
+                f.write(table.text_report(stain_type))
+            paths.append(report_path)
+    print(f"Statistical results saved to {paths[0]}")
+    return paths
+
 def main():
     # Create output directory for analysis results
     output_dir = 'Statistical-Analysis'
@@ -654,16 +1142,30 @@ def main():
 
     # Load the processed metadata from the first script
     metadata_df = load_metadata('metadata.csv')
+    # Images skipped by the Step 2 quality gate have no intensity results
+    if 'QC_Status' in metadata_df:
+        metadata_df = metadata_df[metadata_df['QC_Status'] != 'skip'].reset_index(drop=True)
     stain_types = detect_stain_types(metadata_df)
     print(f"Detected stain types: {stain_types}")
 
-    # Process each stain type
+    # Process each stain type; one exporter lets PNG encoding overlap with building the next figure
     all_results = {}
+    exporter = FigureExporter(output_dir, formats=('svg', 'png'), dpi=300)
+    table = StatisticsTable('fluorescence')
     for stain_type in stain_types:
         print(f"\nAnalyzing {stain_type}...")
         # Create plots and perform statistical analysis
-        create_analysis_plots(metadata_df, stain_type, output_dir)
-        all_results[stain_type] = perform_statistical_analysis(metadata_df, stain_type, output_dir)
+        create_analysis_plots(metadata_df, stain_type, output_dir, exporter)
+        all_results[stain_type] = perform_statistical_analysis(metadata_df, stain_type, output_dir, exporter, table)
+    if run_threshold_sweep:
+        sweep_table = StatisticsTable('fluorescence')
+        for stain_type in stain_types:
+            print(f"\nThreshold sensitivity sweep for {stain_type}...")
+            threshold_sensitivity_sweep(metadata_df, stain_type, output_dir, exporter, sweep_table)
+        sweep_path = sweep_table.write(output_dir, name='Threshold_Sweep_Results')[0]
+        print(f"Threshold sweep results saved to {sweep_path}")
+    exporter.close()
+    save_statistics(table, output_dir)
 
     # Print summary of statistical results
     print("\nStatistical Analysis Summary:")
@@ -0,0 +1,188 @@
+"""Render-once, export-many figure pipeline for the statistics plots in code6 and code7.
+
+`FigureExporter.export` lays a figure out once (a single tight-bbox computation shared by every
+format), draws each vector format once, and rasterizes once for all raster formats. The raw RGBA
+buffer is handed to a thread pool that encodes the PNG (and any other raster format) while the
+next figure is built, and the figure is always closed. A manifest of input-data hashes next to
+the outputs lets callers skip building a figure whose inputs have not changed since the last run.
+"""
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+try:
+    from IPython import get_ipython
+    from IPython.display import display
+except ImportError:
+    get_ipython = display = None
+
+RASTER_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG', 'tif': 'TIFF', 'tiff': 'TIFF'}
+MANIFEST_NAME = '.figure_manifest.json'
+
+def update_hash(digest, obj):
+    """Feed a stable byte representation of `obj` into `digest` (frames, arrays, callables, containers)."""
+    if isinstance(obj, pd.DataFrame):
+        digest.update(repr((list(obj.columns), list(obj.dtypes.astype(str)))).encode())
+        digest.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+    elif isinstance(obj, pd.Series):
+        digest.update(repr((obj.name, str(obj.dtype))).encode())
+        digest.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+    elif isinstance(obj, np.ndarray):
+        digest.update(repr((obj.shape, str(obj.dtype))).encode())
+        digest.update(np.ascontiguousarray(obj).tobytes())
+    elif callable(obj) and hasattr(obj, '__code__'):
+        # The plotting code itself, so editing a plot function invalidates its cached figures
+        digest.update(obj.__code__.co_code)
+        digest.update(repr(obj.__code__.co_consts).encode())
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=repr):
+            update_hash(digest, key)
+            update_hash(digest, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        digest.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for item in obj:
+            update_hash(digest, item)
+    else:
+        digest.update(repr(obj).encode())
+
+def figure_data_hash(*inputs):
+    """Hash of everything a figure is drawn from: data, labels, style settings and plotting function."""
+    digest = hashlib.sha256()
+    for obj in inputs:
+        update_hash(digest, obj)
+    return digest.hexdigest()
+
+def in_notebook():
+    """True inside a Jupyter/Colab kernel, where figures are shown inline."""
+    return get_ipython is not None and getattr(get_ipython(), 'kernel', None) is not None
+
+def encode_raster(rgba, path, image_format, dpi):
+    """Encode an RGBA buffer to `path` (runs in a worker thread; zlib/libjpeg release the GIL)."""
+    image = Image.fromarray(rgba, 'RGBA')
+    if image_format == 'JPEG':
+        image = image.convert('RGB')
+    image.save(path, format=image_format, dpi=(dpi, dpi))
+    return path
+
+class FigureExporter:
+    """Export figures to every configured format; use as a context manager or call close() at the end."""
+
+    def __init__(self, output_dir, formats=('svg', 'png'), dpi=300, max_workers=None, show=True,
+                 preview_dpi=100):
+        self.output_dir = output_dir
+        self.formats = tuple(formats)
+        self.dpi = dpi
+        self.show = show
+        self.preview_dpi = preview_dpi
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = []
+        os.makedirs(output_dir, exist_ok=True)
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def paths(self, name):
+        return [os.path.join(self.output_dir, f'{name}.{extension}') for extension in self.formats]
+
+    def is_current(self, name, data_hash):
+        """True if `name` was exported from the same inputs and formats and all its files still exist."""
+        entry = self.manifest.get(name)
+        if (entry is None or entry['hash'] != data_hash or entry['formats'] != list(self.formats)
+                or entry['dpi'] != self.dpi):
+            return False
+        if not all(os.path.exists(path) for path in self.paths(name)):
+            return False
+        if self.show:
+            self.display_file(name)
+        return True
+
+    def display_file(self, name):
+        """Show an up-to-date figure from its exported raster instead of re-rendering it."""
+        raster = [path for path in self.paths(name) if path.rsplit('.', 1)[1] in RASTER_FORMATS]
+        if in_notebook() and raster:
+            with Image.open(raster[0]) as image:
+                scale = self.preview_dpi / self.dpi
+                display(image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale)))))
+
+    def export(self, fig, name, data_hash=None, tight=True, pad_inches=0.1):
+        """Write `fig` as <output_dir>/<name>.<format> for every format and close it.
+
+        With `tight`, the tight bounding box is computed once and passed to every format as an explicit
+        box, which is what bbox_inches='tight' would otherwise recompute (with a full draw) per format.
+        """
+        try:
+            bbox = None
+            if tight:
+                # Measure text at the export resolution, as savefig does for the raster output
+                figure_dpi = fig.dpi
+                fig.set_dpi(self.dpi)
+                try:
+                    bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(pad_inches)
+                finally:
+                    fig.set_dpi(figure_dpi)
+
+            rgba = None
+            futures = []
+            for extension, path in zip(self.formats, self.paths(name)):
+                if extension in RASTER_FORMATS:
+                    if rgba is None:
+                        # One Agg draw at the export resolution shared by all raster formats
+                        buffer = io.BytesIO()
+                        fig.savefig(buffer, format='rgba', dpi=self.dpi, bbox_inches=bbox)
+                        rgba = self.rgba_array(buffer.getbuffer(), fig, bbox)
+                    futures.append(self.pool.submit(encode_raster, rgba, path, RASTER_FORMATS[extension],
+                                                    self.dpi))
+                else:
+                    fig.savefig(path, format=extension, bbox_inches=bbox)
+
+            if self.show and in_notebook():
+                if rgba is not None:
+                    step = max(1, int(round(self.dpi / self.preview_dpi)))
+                    display(Image.fromarray(np.ascontiguousarray(rgba[::step, ::step]), 'RGBA'))
+                else:
+                    plt.show()
+            self.pending.append((name, data_hash, futures))
+        finally:
+            plt.close(fig)
+
+    def rgba_array(self, raw, fig, bbox):
+        """View the raw Agg buffer as (height, width, 4); Agg truncates the float size, so check both ways."""
+        width, height = (bbox.width, bbox.height) if bbox is not None else fig.get_size_inches()
+        for pixels in (int(width * self.dpi), int(round(width * self.dpi))):
+            rows, remainder = divmod(len(raw), 4 * pixels)
+            if remainder == 0 and abs(rows - height * self.dpi) <= 1:
+                return np.frombuffer(raw, dtype=np.uint8).reshape(rows, pixels, 4)
+        raise ValueError(f"Unexpected RGBA buffer size {len(raw)} for a {width:.3f} x {height:.3f} in figure")
+
+    def wait(self):
+        """Block until all queued encodes are written, then record them in the manifest."""
+        for name, data_hash, futures in self.pending:
+            for future in futures:
+                future.result()
+            if data_hash is not None:
+                self.manifest[name] = {'hash': data_hash, 'formats': list(self.formats), 'dpi': self.dpi}
+        self.pending = []
+        tmp = f'{self.manifest_path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, self.manifest_path)
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown(wait=True)
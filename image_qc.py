@@ -0,0 +1,143 @@
+"""Pre-analysis quality gate for the snapshots of code6 and code7.
+
+Four cheap metrics are computed on a reduced-resolution decode (long side near 512 pixels):
+
+- QC_Focus: variance of the Laplacian over the tissue pixels (low for out-of-focus snapshots).
+- QC_Saturated_Fraction: fraction of tissue pixels with a channel clipped at 0 or 255.
+- QC_Tissue_Coverage: fraction of the frame covered by tissue (low for nearly empty snapshots).
+- QC_Illumination_Gradient: relative change of a plane fitted to the background (brightfield) or
+  tissue (fluorescence) brightness across the frame, i.e. uneven illumination or vignetting.
+
+Rules such as `('QC_Focus', '<', 20.0, 'flag')` turn the metrics into a QC_Status of 'pass', 'flag'
+(analysed, but marked in the metadata) or 'skip' (left out of the analysis).
+
+The reduced decodes are kept in .reduced_cache/ as .npy files keyed by the file's path, size and
+modification time, so later passes over the same images (the palette learning of code6 Step 2, or a
+rerun) read a few hundred kB per image instead of decoding it again.
+"""
+import hashlib
+import os
+from contextlib import nullcontext
+import cv2
+import numpy as np
+import pandas as pd
+from mosaic_stitching import image_size, read_image
+
+METRICS = ['QC_Focus', 'QC_Saturated_Fraction', 'QC_Tissue_Coverage', 'QC_Illumination_Gradient']
+COMPARISONS = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal}
+REDUCED_FLAGS = {True: {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                        8: cv2.IMREAD_REDUCED_COLOR_8},
+                 False: {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                         4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}}
+
+CACHE_DIR = '.reduced_cache'
+
+def reduced_factor(image_path, max_side=512):
+    """Decode scale (1, 2, 4 or 8) that brings the long side near `max_side`, from the header alone."""
+    factor = 1
+    long_side = max(image_size(image_path))
+    while factor < 8 and long_side / factor > max_side:
+        factor *= 2
+    return factor
+
+def reduced_read(image_path, color, max_side=512, cache_dir=CACHE_DIR):
+    """Decode at 1/2, 1/4 or 1/8 scale so that the long side stays near `max_side` (BGR or grayscale).
+
+    The decode is cached in `cache_dir` (None disables the cache); a changed file gets a new entry.
+    """
+    factor = reduced_factor(image_path, max_side)
+    if cache_dir is None:
+        return read_image(image_path, REDUCED_FLAGS[color][factor])
+    stat = os.stat(image_path)
+    key = f'{os.path.abspath(image_path)}|{stat.st_size}|{stat.st_mtime_ns}|{color}|{factor}'
+    entry = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest()[:32] + '.npy')
+    if os.path.exists(entry):
+        return np.load(entry)
+    image = read_image(image_path, REDUCED_FLAGS[color][factor])
+    if image is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{entry}.tmp{os.getpid()}.npy'
+        np.save(tmp, image)
+        os.replace(tmp, entry)
+    return image
+
+def illumination_gradient(gray, tissue, use_tissue, grid=16, min_cells=8):
+    """Relative range across the frame of a least-squares plane through the cell means of a coarse grid.
+
+    Brightfield uses the background cells (tissue in under 5% of the cell). Fluorescence uses the mean
+    of the tissue pixels in cells that are at least half tissue, because its background is dark.
+    """
+    mask = tissue if use_tissue else ~tissue
+    mask_cells = cv2.resize(mask.astype(np.float32), (grid, grid), interpolation=cv2.INTER_AREA)
+    sum_cells = cv2.resize(np.where(mask, gray, 0).astype(np.float32), (grid, grid), interpolation=cv2.INTER_AREA)
+    selected = mask_cells >= (0.5 if use_tissue else 0.95)
+    if selected.sum() < min_cells:
+        return np.nan
+    cells = np.divide(sum_cells, mask_cells, out=np.zeros_like(sum_cells), where=mask_cells > 0)
+    y, x = np.nonzero(selected)
+    design = np.column_stack([np.ones(len(x)), (x + 0.5) / grid, (y + 0.5) / grid])
+    (offset, slope_x, slope_y), *_ = np.linalg.lstsq(design, cells[selected], rcond=None)
+    center = offset + (slope_x + slope_y) / 2
+    return float((abs(slope_x) + abs(slope_y)) / center) if center > 0 else np.nan
+
+def qc_metrics(image_path, background='white', white_threshold=220, min_contrast=15, max_side=512):
+    """QC metrics of one image; `background` is 'white' (brightfield, code6) or 'dark' (fluorescence, code7).
+
+    On a dark background the Otsu split counts as tissue only if its mean is at least `min_contrast`
+    gray levels above the background, so frames of pure noise get no coverage.
+    """
+    image = reduced_read(image_path, color=background == 'white', max_side=max_side)
+    if image is None:
+        raise ValueError(f"Failed to load image: {image_path}")
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    if background == 'white':
+        tissue = blurred < white_threshold
+    else:
+        _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        tissue = binary > 0
+        if tissue.all() or not tissue.any() or blurred[tissue].mean() - blurred[~tissue].mean() < min_contrast:
+            tissue = np.zeros_like(tissue)
+    n_tissue = int(tissue.sum())
+    laplacian = cv2.Laplacian(gray, cv2.CV_32F)
+    channels = image.reshape(image.shape[0], image.shape[1], -1)
+    clipped = np.any((channels == 0) | (channels == 255), axis=2)
+    return {
+        'QC_Focus': float(laplacian[tissue].var()) if n_tissue else 0.0,
+        'QC_Saturated_Fraction': float(clipped[tissue].mean()) if n_tissue else 0.0,
+        'QC_Tissue_Coverage': n_tissue / tissue.size,
+        'QC_Illumination_Gradient': illumination_gradient(gray, tissue, use_tissue=background != 'white'),
+    }
+
+def apply_rules(metrics, rules):
+    """QC status and the list of failed rules; 'skip' outranks 'flag', and NaN metrics never fail."""
+    failed = [rule for rule in rules if COMPARISONS[rule[1]](metrics[rule[0]], rule[2])]
+    actions = {action for *_, action in failed}
+    status = 'skip' if 'skip' in actions else 'flag' if actions else 'pass'
+    return status, [f'{metric}{comparison}{threshold:g}' for metric, comparison, threshold, _ in failed]
+
+def quality_gate(metadata_df, rules, background='white', timer=None, max_side=512):
+    """Write the QC metrics, QC_Status and QC_Failures of every image to `metadata_df`.
+
+    Returns a boolean Series that is False for the images the rules skip (and for missing files).
+    """
+    keep = np.ones(len(metadata_df), dtype=bool)
+    for position, index in enumerate(metadata_df.index):
+        image_path = metadata_df.at[index, 'FilePath']
+        if not os.path.exists(image_path):
+            metadata_df.at[index, 'QC_Status'] = 'skip'
+            metadata_df.at[index, 'QC_Failures'] = 'missing file'
+            keep[position] = False
+            continue
+        image_name = os.path.basename(image_path)
+        with timer.span(image_name, 'QC') if timer is not None else nullcontext():
+            metrics = qc_metrics(image_path, background, max_side=max_side)
+        status, failures = apply_rules(metrics, rules)
+        for metric, value in metrics.items():
+            metadata_df.at[index, metric] = value
+        metadata_df.at[index, 'QC_Status'] = status
+        metadata_df.at[index, 'QC_Failures'] = ';'.join(failures)
+        keep[position] = status != 'skip'
+        if status != 'pass':
+            print(f"QC {status}: {image_name} ({', '.join(failures)})")
+    return pd.Series(keep, index=metadata_df.index)
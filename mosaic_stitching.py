@@ -0,0 +1,315 @@
+"""Stitching of overlapping snapshots of one sample into a lazily composed mosaic.
+
+Snapshots of the same condition and staining (`DD-HE-1`, `DD-HE-2`, ...) are registered pairwise by
+FFT phase correlation on reduced decodes. Registration and scoring only use the high-passed texture
+inside the tissue of both snapshots, because separate samples of one condition have similar outlines
+on the same background and would otherwise correlate well. The shift of the correlation peak is only
+known modulo the image size, so every wrap-around candidate is scored by the texture correlation of
+the overlap it implies; overlaps of more than 90% of a snapshot are rejected. Accepted pairs are
+refined by phase correlation of the full-resolution overlap crops, and snapshots connected through
+well-correlated pairs are placed along a maximum spanning tree of the correlation scores.
+
+A mosaic is a small JSON manifest that references its tiles and their offsets; no pixels are copied.
+`read_image` composes a mosaic on demand (optionally at 1/2, 1/4 or 1/8 scale from reduced tile
+decodes) and reads plain files with cv2, so the loaders of code6 and code7 accept both. In overlaps
+the first tile of the manifest wins, so every mosaic pixel comes from exactly one snapshot and
+overlapping fields are not counted twice.
+"""
+import json
+import os
+import cv2
+import numpy as np
+import pandas as pd
+from scipy import fft
+from PIL import Image
+
+MOSAIC_SUFFIX = '.mosaic.json'
+REDUCED_FLAGS = {
+    cv2.IMREAD_REDUCED_COLOR_2: (cv2.IMREAD_COLOR, 2), cv2.IMREAD_REDUCED_COLOR_4: (cv2.IMREAD_COLOR, 4),
+    cv2.IMREAD_REDUCED_COLOR_8: (cv2.IMREAD_COLOR, 8), cv2.IMREAD_REDUCED_GRAYSCALE_2: (cv2.IMREAD_GRAYSCALE, 2),
+    cv2.IMREAD_REDUCED_GRAYSCALE_4: (cv2.IMREAD_GRAYSCALE, 4),
+    cv2.IMREAD_REDUCED_GRAYSCALE_8: (cv2.IMREAD_GRAYSCALE, 8),
+}
+GRAYSCALE_REDUCED = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                     4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+def is_mosaic(path):
+    return str(path).endswith(MOSAIC_SUFFIX)
+
+def image_size(path):
+    """(width, height) from the image header or the mosaic manifest, without decoding pixels."""
+    if is_mosaic(path):
+        return LazyMosaic.load(path).size
+    with Image.open(path) as image:
+        return image.size
+
+def read_image(path, flags=cv2.IMREAD_COLOR):
+    """cv2.imread that also composes mosaic manifests (BGR or grayscale, reduced flags supported)."""
+    if is_mosaic(path):
+        return LazyMosaic.load(path).read(flags)
+    return cv2.imread(path, flags)
+
+def read_rgb(path):
+    image = read_image(path)
+    return None if image is None else cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+class LazyMosaic:
+    """Tiles placed at integer offsets on a canvas; pixels are only decoded when a region is read."""
+
+    def __init__(self, tiles, size, fill=255, name=None, pairs=None):
+        self.tiles = tiles  # [{'path', 'x', 'y', 'width', 'height'}], first tile wins in overlaps
+        self.size = tuple(size)  # (width, height)
+        self.fill = fill
+        self.name = name
+        self.pairs = pairs or []
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            manifest = json.load(f)
+        # Tile paths are stored relative to the manifest so a mosaic can be moved with its tiles
+        directory = os.path.dirname(os.path.abspath(path))
+        tiles = [dict(tile, path=os.path.normpath(os.path.join(directory, tile['path'])))
+                 for tile in manifest['tiles']]
+        return cls(tiles, manifest['size'], manifest.get('fill', 255), manifest.get('name'),
+                   manifest.get('pairs'))
+
+    def save(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        manifest = {'name': self.name, 'size': list(self.size), 'fill': self.fill,
+                    'tiles': [dict(tile, path=os.path.relpath(os.path.abspath(tile['path']), directory))
+                              for tile in self.tiles],
+                    'pairs': self.pairs}
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, path)
+        return path
+
+    def read(self, flags=cv2.IMREAD_COLOR, region=None):
+        """Compose the mosaic, or only `region` = (x, y, width, height) in full-resolution pixels.
+
+        Reduced flags decode every tile at 1/2, 1/4 or 1/8 scale and place it at the scaled offset.
+        Only tiles that intersect the region are decoded.
+        """
+        base_flags, factor = REDUCED_FLAGS.get(flags, (flags, 1))
+        x0, y0, width, height = region if region is not None else (0, 0) + self.size
+        canvas_width, canvas_height = -(-width // factor), -(-height // factor)
+        channels = () if base_flags == cv2.IMREAD_GRAYSCALE else (3,)
+        canvas = np.full((canvas_height, canvas_width) + channels, self.fill, dtype=np.uint8)
+        covered = np.zeros((canvas_height, canvas_width), dtype=bool)
+        for tile in self.tiles:
+            if (tile['x'] >= x0 + width or tile['y'] >= y0 + height
+                    or tile['x'] + tile['width'] <= x0 or tile['y'] + tile['height'] <= y0):
+                continue
+            image = cv2.imread(tile['path'], flags)
+            if image is None:
+                raise ValueError(f"Failed to load mosaic tile: {tile['path']}")
+            # Tile and canvas windows of the overlap, in the decoded (possibly reduced) scale
+            left, top = (tile['x'] - x0) // factor, (tile['y'] - y0) // factor
+            cx0, cy0 = max(left, 0), max(top, 0)
+            cx1, cy1 = min(left + image.shape[1], canvas_width), min(top + image.shape[0], canvas_height)
+            if cx1 <= cx0 or cy1 <= cy0:
+                continue
+            window = (slice(cy0, cy1), slice(cx0, cx1))
+            free = ~covered[window]
+            np.copyto(canvas[window], image[cy0 - top:cy1 - top, cx0 - left:cx1 - left],
+                      where=free[..., np.newaxis] if channels else free)
+            covered[window] = True
+        return canvas
+
+def phase_correlation(a, b):
+    """Integer shift (dx, dy) at which `b` best matches `a` (modulo the array size) and the peak height."""
+    spectrum = fft.rfft2(a - a.mean(), workers=-1) * np.conj(fft.rfft2(b - b.mean(), workers=-1))
+    spectrum /= np.abs(spectrum) + 1e-12
+    surface = fft.irfft2(spectrum, s=a.shape, workers=-1)
+    dy, dx = np.unravel_index(np.argmax(surface), surface.shape)
+    return int(dx), int(dy), float(surface[dy, dx])
+
+def overlap_windows(shape_a, shape_b, dx, dy):
+    """Slices of `a` and `b` that cover the same pixels when `b` is placed at (dx, dy) in `a`."""
+    ax0, ay0 = max(dx, 0), max(dy, 0)
+    ax1, ay1 = min(shape_a[1], dx + shape_b[1]), min(shape_a[0], dy + shape_b[0])
+    if ax1 <= ax0 or ay1 <= ay0:
+        return None
+    return ((slice(ay0, ay1), slice(ax0, ax1)), (slice(ay0 - dy, ay1 - dy), slice(ax0 - dx, ax1 - dx)))
+
+def normalized_cross_correlation(a, b):
+    a, b = a.astype(np.float32).ravel(), b.astype(np.float32).ravel()
+    a, b = a - a.mean(), b - b.mean()
+    denominator = np.sqrt((a @ a) * (b @ b))
+    return float(a @ b / denominator) if denominator > 0 else 0.0
+
+def tissue_texture(gray, background='white', white_threshold=220, min_contrast=15, sigma=2.0, erode=5):
+    """High-passed gray levels inside the eroded tissue mask (zero elsewhere) and that mask.
+
+    Separate samples of one condition share their outline, size and colors, so only the texture
+    inside the tissue can tell an overlap from a look-alike: the high pass removes the
+    tissue/background step and the eroded mask drops the outline band and the background.
+    """
+    gray = gray.astype(np.float32)
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    if background == 'white':
+        tissue = blurred < white_threshold
+    else:
+        tissue = blurred > np.percentile(blurred, 1) + min_contrast
+    tissue = cv2.erode(tissue.astype(np.uint8), np.ones((erode, erode), np.uint8)) > 0
+    texture = gray - cv2.GaussianBlur(gray, (0, 0), sigma)
+    return np.where(tissue, texture, 0).astype(np.float32), tissue
+
+def texture_correlation(texture_a, tissue_a, texture_b, tissue_b, windows, min_tissue=0.1, min_pixels=256):
+    """NCC of the textures over the pixels that are tissue in both overlap windows.
+
+    Returns 0 when fewer than `min_tissue` of the overlap (or fewer than `min_pixels`) is shared
+    tissue, since a background-only overlap cannot be verified.
+    """
+    shared = tissue_a[windows[0]] & tissue_b[windows[1]]
+    if shared.sum() < max(min_pixels, min_tissue * shared.size):
+        return 0.0
+    return normalized_cross_correlation(texture_a[windows[0]][shared], texture_b[windows[1]][shared])
+
+def coarse_offset(a, b, background='white', min_overlap=0.1, max_overlap=0.9):
+    """Best (dx, dy, correlation) of `b` relative to `a` among the wrap-around candidates of the peak.
+
+    Both the phase correlation and the scores use the tissue textures (see tissue_texture). Offsets
+    whose overlap covers less than `min_overlap` or more than `max_overlap` of the smaller snapshot are
+    not considered: a near-complete overlap is a re-shot field, which the duplicate check flags.
+    """
+    (texture_a, tissue_a), (texture_b, tissue_b) = tissue_texture(a, background), tissue_texture(b, background)
+    height, width = max(a.shape[0], b.shape[0]), max(a.shape[1], b.shape[1])
+    padded = [cv2.copyMakeBorder(texture, 0, height - texture.shape[0], 0, width - texture.shape[1],
+                                 cv2.BORDER_CONSTANT, value=0) for texture in (texture_a, texture_b)]
+    dx, dy, _ = phase_correlation(*padded)
+    smaller = min(a.size, b.size)
+    best = None
+    for x in (dx, dx - width):
+        for y in (dy, dy - height):
+            windows = overlap_windows(a.shape, b.shape, x, y)
+            if windows is None or not min_overlap <= a[windows[0]].size / smaller <= max_overlap:
+                continue
+            score = texture_correlation(texture_a, tissue_a, texture_b, tissue_b, windows)
+            if best is None or score > best[2]:
+                best = (x, y, score)
+    return best
+
+def refine_offset(a, b, dx, dy, reduction=8, background='white', max_side=2048):
+    """Correct a coarse offset by phase correlation of the full-resolution overlap crops.
+
+    The refined overlap is scored like the coarse one, on its crops reduced by `reduction`, so the
+    score measures the same tissue texture and not the exposure noise of the two snapshots.
+    """
+    windows = overlap_windows(a.shape, b.shape, dx, dy)
+    crop_a, crop_b = a[windows[0]], b[windows[1]]
+    # A central window of the overlap is plenty to measure a residual of a few pixels
+    rows, columns = [slice((n - min(n, max_side)) // 2, (n + min(n, max_side)) // 2) for n in crop_a.shape]
+    crop_a, crop_b = crop_a[rows, columns].astype(np.float32), crop_b[rows, columns].astype(np.float32)
+    rx, ry, _ = phase_correlation(crop_a, crop_b)
+    # Residuals are small, so fold the peak into (-size/2, size/2]
+    rx = rx - crop_a.shape[1] if rx > crop_a.shape[1] // 2 else rx
+    ry = ry - crop_a.shape[0] if ry > crop_a.shape[0] // 2 else ry
+    if max(abs(rx), abs(ry)) <= 2 * reduction:  # Larger jumps lock onto the outline, not a residual
+        dx, dy = dx + rx, dy + ry
+    windows = overlap_windows(a.shape, b.shape, dx, dy)
+    rows, columns = [slice((n - min(n, max_side)) // 2, (n + min(n, max_side)) // 2)
+                     for n in a[windows[0]].shape]
+    size = (max(1, (columns.stop - columns.start) // reduction), max(1, (rows.stop - rows.start) // reduction))
+    crops = [cv2.resize(image[window][rows, columns], size, interpolation=cv2.INTER_AREA)
+             for image, window in ((a, windows[0]), (b, windows[1]))]
+    (texture_a, tissue_a), (texture_b, tissue_b) = [tissue_texture(crop, background) for crop in crops]
+    whole = (slice(None), slice(None))
+    return dx, dy, texture_correlation(texture_a, tissue_a, texture_b, tissue_b, (whole, whole))
+
+def register_snapshots(paths, reduction=8, min_overlap=0.1, max_overlap=0.9, min_correlation=0.5,
+                       background='white'):
+    """Pairwise registration of snapshots; returns the accepted pairs with full-resolution offsets.
+
+    Each pair is {'a', 'b', 'dx', 'dy', 'correlation'}: snapshot b sits at (dx, dy) in snapshot a, and
+    correlation is the tissue-texture NCC of the overlap. `background` is 'white' (brightfield) or
+    'dark' (fluorescence). On synthetic snapshots with their own noise and JPEG compression, true
+    overlaps score above 0.99 and independent samples with the same outline at most about 0.1.
+    """
+    reduced = [cv2.imread(path, GRAYSCALE_REDUCED[reduction]) for path in paths]
+    full = {}
+    pairs = []
+    for i in range(len(paths)):
+        for j in range(i + 1, len(paths)):
+            coarse = coarse_offset(reduced[i], reduced[j], background, min_overlap, max_overlap)
+            if coarse is None or coarse[2] < min_correlation:
+                continue
+            for k in (i, j):
+                if k not in full:
+                    full[k] = cv2.imread(paths[k], cv2.IMREAD_GRAYSCALE)
+            dx, dy, correlation = refine_offset(full[i], full[j], coarse[0] * reduction, coarse[1] * reduction,
+                                                reduction, background)
+            if correlation >= min_correlation:
+                pairs.append({'a': i, 'b': j, 'dx': int(dx), 'dy': int(dy), 'correlation': correlation})
+    return pairs
+
+def place_snapshots(n_snapshots, pairs):
+    """Group snapshots into connected mosaics and place each group along a maximum spanning tree.
+
+    Returns a list of {snapshot index: (x, y)} with the top-left corner of every group at (0, 0).
+    """
+    edges = {}
+    for pair in pairs:
+        edges.setdefault(pair['a'], []).append((pair['correlation'], pair['b'], pair['dx'], pair['dy']))
+        edges.setdefault(pair['b'], []).append((pair['correlation'], pair['a'], -pair['dx'], -pair['dy']))
+    placed = {}
+    groups = []
+    for root in range(n_snapshots):
+        if root in placed:
+            continue
+        # Prim's algorithm: always attach the unplaced snapshot with the strongest link to the group
+        group = {root: (0, 0)}
+        placed[root] = True
+        while True:
+            candidates = [(correlation, neighbour, group[node][0] + dx, group[node][1] + dy)
+                          for node in group for correlation, neighbour, dx, dy in edges.get(node, [])
+                          if neighbour not in placed]
+            if not candidates:
+                break
+            _, neighbour, x, y = max(candidates)
+            group[neighbour] = (x, y)
+            placed[neighbour] = True
+        min_x, min_y = min(x for x, _ in group.values()), min(y for _, y in group.values())
+        groups.append({index: (x - min_x, y - min_y) for index, (x, y) in sorted(group.items())})
+    return groups
+
+def stitch_metadata(metadata_df, output_dir, fill=255, reduction=8, min_overlap=0.1, max_overlap=0.9,
+                    min_correlation=0.5):
+    """Replace overlapping snapshots of each condition and staining by one mosaic row per sample.
+
+    `fill` is the slide background: 255 (white, brightfield) or 0 (dark, fluorescence).
+    Snapshots that overlap no other snapshot keep their row. A mosaic row points to its manifest in
+    `output_dir`, takes the lowest replicate number of its tiles and lists all of them in
+    Stitched_Replicates; Mosaic_Tiles counts the snapshots behind every row.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rows = []
+    for (condition, staining), group in metadata_df.groupby(['Condition', 'Staining'], sort=False):
+        group = group.sort_values('Replicate', key=lambda replicates: replicates.astype(int))
+        paths = group['FilePath'].tolist()
+        pairs = register_snapshots(paths, reduction, min_overlap, max_overlap, min_correlation,
+                                   'white' if fill >= 128 else 'dark') if len(paths) > 1 else []
+        for placement in place_snapshots(len(paths), pairs):
+            members = group.iloc[list(placement)]
+            if len(placement) == 1:
+                rows.append(dict(members.iloc[0], Mosaic_Tiles=1, Stitched_Replicates=str(members.iloc[0]['Replicate'])))
+                continue
+            tiles = []
+            for index, (x, y) in placement.items():
+                width, height = image_size(paths[index])
+                tiles.append({'path': paths[index], 'x': x, 'y': y, 'width': width, 'height': height})
+            size = (max(tile['x'] + tile['width'] for tile in tiles), max(tile['y'] + tile['height'] for tile in tiles))
+            replicate = str(members.iloc[0]['Replicate'])
+            filename = f'{condition}-{staining}-{replicate}{MOSAIC_SUFFIX}'
+            path = os.path.join(output_dir, filename)
+            index_map = {index: position for position, index in enumerate(placement)}
+            mosaic_pairs = [dict(pair, a=index_map[pair['a']], b=index_map[pair['b']]) for pair in pairs
+                            if pair['a'] in index_map and pair['b'] in index_map]
+            LazyMosaic(tiles, size, fill, name=filename, pairs=mosaic_pairs).save(path)
+            replicates = ';'.join(str(replicate) for replicate in members['Replicate'])
+            print(f"Stitched {condition}, {staining} replicates {replicates} into {path} ({size[0]} x {size[1]})")
+            rows.append(dict(members.iloc[0], Filename=filename, FilePath=path, Format='MOSAIC', OriginalSize=size,
+                             Mosaic_Tiles=len(placement), Stitched_Replicates=replicates))
+    return pd.DataFrame(rows, columns=list(metadata_df.columns) + ['Mosaic_Tiles', 'Stitched_Replicates'])
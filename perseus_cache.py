@@ -0,0 +1,172 @@
+"""Typed columnar cache for Perseus CSV exports shared by code1 to code5.
+
+Each export is parsed once, projected to the columns a script needs, and written to
+.perseus_cache/ as .npy files keyed by the SHA-256 of the CSV. Numeric columns are stored
+together as one column-major float64 matrix and identifier columns as fixed-width unicode
+arrays, so later loads are memory-mapped instead of re-parsed. The first parse uses the
+multi-threaded pyarrow CSV engine when pyarrow is installed.
+"""
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  (only needed for the multi-threaded CSV engine)
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+CACHE_DIR = '.perseus_cache'
+CACHE_VERSION = 1
+
+def file_hash(filename, block_size=1 << 20):
+    """SHA-256 of the file contents, read in blocks."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def select_columns(filename, usecols=None, drop=None):
+    """Header names to keep, in file order: all columns, or `usecols`, minus any in `drop`."""
+    header = list(pd.read_csv(filename, nrows=0).columns)
+    if usecols is not None:
+        missing = [col for col in usecols if col not in header]
+        if missing:
+            raise ValueError(f"File {filename} does not contain column(s): {', '.join(missing)}")
+    keep = set(header if usecols is None else usecols) - set(drop or [])
+    return [col for col in header if col in keep]
+
+def split_numeric(df):
+    """Split a parsed frame into numeric column names and identifier (string) column names."""
+    numeric = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])]
+    strings = [col for col in df.columns if col not in numeric]
+    return numeric, strings
+
+def write_cache_entry(filename, entry, columns, chunk_rows=None):
+    """Parse the projected columns and write the matrix, string arrays and manifest into `entry`."""
+    tmp = f'{entry}.tmp{os.getpid()}'
+    os.makedirs(tmp, exist_ok=True)
+
+    if chunk_rows is None:
+        # One multi-threaded parse of the projected columns
+        df = pd.read_csv(filename, usecols=columns, engine=CSV_ENGINE)[columns]
+        numeric, strings = split_numeric(df)
+        matrix = np.lib.format.open_memmap(os.path.join(tmp, 'numeric.npy'), mode='w+', dtype=np.float64,
+                                           shape=(len(df), len(numeric)), fortran_order=True)
+        for j, col in enumerate(numeric):
+            matrix[:, j] = df[col].to_numpy(dtype=np.float64)
+        string_values = {col: df[col].fillna('').astype(str).to_numpy(dtype=str) for col in strings}
+    else:
+        # Stream row chunks for exports that do not fit in memory. A first pass counts the rows and
+        # fixes the column types: a column is numeric only if it parses as numeric in every chunk
+        n_rows, numeric_in_all = 0, dict.fromkeys(columns, True)
+        for chunk in pd.read_csv(filename, usecols=columns, chunksize=chunk_rows):
+            n_rows += len(chunk)
+            for col in columns:
+                numeric_in_all[col] &= pd.api.types.is_numeric_dtype(chunk[col])
+        numeric = [col for col in columns if numeric_in_all[col]]
+        strings = [col for col in columns if not numeric_in_all[col]]
+        matrix = np.lib.format.open_memmap(os.path.join(tmp, 'numeric.npy'), mode='w+', dtype=np.float64,
+                                           shape=(n_rows, len(numeric)), fortran_order=True)
+        string_values = {col: [] for col in strings}
+        row = 0
+        for chunk in pd.read_csv(filename, usecols=columns, chunksize=chunk_rows,
+                                 dtype={col: str for col in strings}):
+            matrix[row:row + len(chunk)] = chunk[numeric].to_numpy(dtype=np.float64)
+            for col in strings:
+                string_values[col].append(chunk[col].fillna('').astype(str).to_numpy(dtype=str))
+            row += len(chunk)
+        string_values = {col: np.concatenate(parts) for col, parts in string_values.items()}
+
+    matrix.flush()
+    for k, col in enumerate(strings):
+        np.save(os.path.join(tmp, f'strings_{k}.npy'), string_values[col])
+    manifest = {
+        'version': CACHE_VERSION,
+        'source': os.path.basename(filename),
+        'columns': columns,
+        'numeric': numeric,
+        'strings': strings,
+        'rows': int(matrix.shape[0]),
+    }
+    with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    del matrix
+
+    # Publish the entry atomically so an interrupted parse never leaves a partial cache behind
+    try:
+        os.replace(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)  # Another process published the same entry first
+    return manifest
+
+def open_cache_entry(filename, usecols=None, drop=None, chunk_rows=None, cache_dir=CACHE_DIR):
+    """Return (entry directory, manifest) for the projected columns, building the entry on a miss."""
+    columns = select_columns(filename, usecols, drop)
+    projection = hashlib.sha256(json.dumps(columns).encode()).hexdigest()[:12]
+    entry = os.path.join(cache_dir, f'{file_hash(filename)}_{projection}')
+    manifest_path = os.path.join(entry, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == CACHE_VERSION:
+            return entry, manifest
+        shutil.rmtree(entry, ignore_errors=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    return entry, write_cache_entry(filename, entry, columns, chunk_rows)
+
+def load_strings(entry, k):
+    """Identifier column `k` as an object array, with empty strings restored to missing values."""
+    values = np.load(os.path.join(entry, f'strings_{k}.npy')).astype(object)
+    values[values == ''] = np.nan
+    return values
+
+def open_perseus_matrix(filename, usecols=None, drop=None, index_col=None, chunk_rows=None, cache_dir=CACHE_DIR):
+    """Memory-mapped numeric matrix of an export with its index and numeric column names.
+
+    The matrix is column-major float64 opened copy-on-write, so column blocks can be streamed
+    without loading the whole export. `index_col` is the identifier column (name or position)
+    used as the index.
+    """
+    entry, manifest = open_cache_entry(filename, usecols, drop, chunk_rows, cache_dir)
+    if isinstance(index_col, int):
+        index_col = manifest['columns'][index_col]
+    matrix = np.load(os.path.join(entry, 'numeric.npy'), mmap_mode='c')
+    if index_col is None:
+        index = pd.RangeIndex(manifest['rows'])
+    else:
+        index = pd.Index(load_strings(entry, manifest['strings'].index(index_col)), name=index_col)
+    return matrix, index, pd.Index(manifest['numeric'])
+
+def load_perseus_csv(filename, usecols=None, drop=None, index_col=None, chunk_rows=None, cache_dir=CACHE_DIR):
+    """Drop-in replacement for pd.read_csv on Perseus exports, served from the columnar cache.
+
+    `usecols` projects the columns to keep (all by default) and `drop` removes columns from that
+    projection. `index_col` is a column name or position, as in pd.read_csv. Numeric columns are
+    returned as float64 backed by the memory-mapped matrix; the original column order is kept.
+    """
+    entry, manifest = open_cache_entry(filename, usecols, drop, chunk_rows, cache_dir)
+    columns = manifest['columns']
+    if isinstance(index_col, int):
+        index_col = columns[index_col]
+
+    matrix = np.load(os.path.join(entry, 'numeric.npy'), mmap_mode='c')
+    df = pd.DataFrame(matrix, columns=manifest['numeric'], copy=False)
+    index = None
+    for k, col in enumerate(manifest['strings']):
+        values = load_strings(entry, k)
+        if col == index_col:
+            index = pd.Index(values, name=col)
+        else:
+            kept = [c for c in columns if c != index_col]
+            df.insert(kept.index(col), col, values)
+
+    if index is not None:
+        df.index = index
+    elif index_col is not None:
+        df = df.set_index(index_col)
+    return df
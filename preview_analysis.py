@@ -0,0 +1,82 @@
+"""Preview runs and their deviation from full resolution, shared by code6 and code7 Step 2.
+
+Each script provides `stain_preview(metadata_df, stain)`, which loads what the stain needs once (the
+saved palette in code6, the global intensity range in code7) and returns a function
+`preview(image_path, factor)`, or None when the stain cannot be previewed. That function returns a
+dict with the segment 'percentages', the 'seconds' it took and a small RGB 'overlay'; factor=1 runs
+the same steps at full resolution, which is the reference of the deviation report.
+"""
+import os
+import re
+import cv2
+import pandas as pd
+
+def stain_images(metadata_df, stain):
+    """(index, path) of the existing images of one stain."""
+    for index in metadata_df.index[metadata_df['Staining'] == stain]:
+        image_path = metadata_df.at[index, 'FilePath']
+        if os.path.exists(image_path):
+            yield index, image_path
+
+def run_previews(metadata_df, stain_preview, factor, output_dir):
+    """Preview every image in the metadata; saves the overlays and Preview_Results.csv."""
+    os.makedirs(output_dir, exist_ok=True)
+    rows = []
+    for stain in metadata_df['Staining'].unique():
+        preview = stain_preview(metadata_df, stain)
+        if preview is None:
+            print(f"Nothing to preview {stain} with. Skipping.")
+            continue
+        for index, image_path in stain_images(metadata_df, stain):
+            result = preview(image_path, factor)
+            image_name = os.path.basename(image_path)
+            base_filename = os.path.splitext(image_name)[0]
+            sanitized_stain = re.sub(r'[^\w\-_]', '_', stain)
+            overlay_path = os.path.join(output_dir, f"{base_filename}-{sanitized_stain}-preview.png")
+            cv2.imwrite(overlay_path, cv2.cvtColor(result['overlay'], cv2.COLOR_RGB2BGR))
+            rows.append({'Filename': image_name, 'Condition': metadata_df.at[index, 'Condition'], 'Staining': stain,
+                         'Factor': factor, 'Seconds': result['seconds'], **result['percentages'],
+                         'Overlay_Path': overlay_path})
+            print(f"{image_name}: "
+                  + ', '.join(f"{measure[:-len('_Percentage')]} {value:.1f}%"
+                              for measure, value in result['percentages'].items())
+                  + f" ({result['seconds']:.2f}s)")
+    results = pd.DataFrame(rows)
+    results.to_csv(os.path.join(output_dir, 'Preview_Results.csv'), index=False)
+    return results
+
+def deviation_report(metadata_df, stain_preview, factors, output_dir):
+    """Preview vs full-resolution percentages and timings for every image of the metadata.
+
+    Writes the per-image differences (Preview_Deviation.csv) and their mean, mean absolute and maximum
+    absolute value per stain, factor and measure (Preview_Deviation_Summary.csv); returns both.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rows = []
+    for stain in metadata_df['Staining'].unique():
+        preview = stain_preview(metadata_df, stain)
+        if preview is None:
+            continue
+        for _, image_path in stain_images(metadata_df, stain):
+            reference = preview(image_path, 1)
+            for factor in factors:
+                result = preview(image_path, factor)
+                for measure, full_value in reference['percentages'].items():
+                    rows.append({'Filename': os.path.basename(image_path), 'Staining': stain, 'Factor': factor,
+                                 'Measure': measure, 'Full_Resolution': full_value,
+                                 'Preview': result['percentages'][measure],
+                                 'Difference': result['percentages'][measure] - full_value,
+                                 'Full_Seconds': reference['seconds'], 'Preview_Seconds': result['seconds']})
+    deviations = pd.DataFrame(rows)
+    if deviations.empty:
+        return deviations, deviations
+    deviations['Abs_Difference'] = deviations['Difference'].abs()
+    summary = deviations.groupby(['Staining', 'Factor', 'Measure'], sort=False).agg(
+        Images=('Difference', 'size'), Mean_Difference=('Difference', 'mean'),
+        Mean_Abs_Difference=('Abs_Difference', 'mean'), Max_Abs_Difference=('Abs_Difference', 'max'),
+        Full_Seconds_p50=('Full_Seconds', 'median'), Preview_Seconds_p50=('Preview_Seconds', 'median')).reset_index()
+    deviations.to_csv(os.path.join(output_dir, 'Preview_Deviation.csv'), index=False)
+    summary.to_csv(os.path.join(output_dir, 'Preview_Deviation_Summary.csv'), index=False)
+    print("\nPreview deviation from full resolution (percentage points):")
+    print(summary.to_string(index=False, float_format='%.3f'))
+    return deviations, summary
@@ -0,0 +1,118 @@
+"""Perceptual hashing of snapshots to flag duplicate and near-duplicate fields at ingest.
+
+Each image gets a 64-bit DCT hash (pHash) of its central crop: the middle half of the frame is
+reduced to 32 x 32 gray levels, and every bit records whether one of the 8 x 8 lowest-frequency DCT
+coefficients lies above their median. The central crop is mostly tissue, so the hash follows the
+tissue texture rather than the sample outline and the illumination, which independent samples of one
+condition share. Re-saved, re-compressed or rescaled copies of a field hash (almost) identically, and
+slightly re-cropped copies differ in a few bits. JPEGs are decoded at reduced scale (PIL draft mode),
+so hashing costs far less than a full decode.
+
+Default radius (8 bits), measured on 360 synthetic 1 MP JPEG fields (brightfield, look-alike
+samples that share one elliptical outline, and fluorescence; 21,420 independent same-kind pairs):
+- independent fields: none within 8 bits (false-positive rate 0 of 21,420; closest pair 14 bits,
+  0.4% of pairs within 18 bits). A 9 x 8 dHash of the whole frame put look-alikes 2 bits apart;
+- copies: JPEG re-saves at quality 60 within 2 bits, half-size rescales within 4 bits, 1% re-crops
+  within 8 bits (all detected), 2% re-crops 96% detected, 5% re-crops 19% detected.
+
+Near-duplicates are found with a multi-index hash table instead of pairwise comparisons. The 64 bits
+are split into four 16-bit chunks, each indexed in its own table. Two hashes within `max_distance`
+bits differ in at most `max_distance // 4` bits of at least one chunk (pigeonhole), so a query only
+looks up the chunk values within that radius (137 keys per chunk for the default radius of 8) and
+compares the few images found there, which keeps ingest fast for tens of thousands of images.
+"""
+from itertools import combinations
+import numpy as np
+import pandas as pd
+from PIL import Image
+from scipy import fft
+
+HASH_SIZE = 8  # 8 x 8 DCT coefficients -> 64-bit hash
+DCT_SIZE = 32  # Side of the reduced crop the DCT is taken of
+CROP = 0.5  # Central fraction of the width and height that is hashed
+
+def phash(image, hash_size=HASH_SIZE, dct_size=DCT_SIZE, crop=CROP):
+    """DCT hash of the central crop of a PIL image as an int with hash_size * hash_size bits."""
+    gray = image.convert('L')
+    width, height = gray.size
+    box = (int(width * (1 - crop) / 2), int(height * (1 - crop) / 2),
+           int(width * (1 + crop) / 2), int(height * (1 + crop) / 2))
+    pixels = np.asarray(gray.crop(box).resize((dct_size, dct_size), Image.BOX), dtype=np.float64)
+    coefficients = fft.dctn(pixels, norm='ortho')[:hash_size, :hash_size].ravel()
+    bits = coefficients > np.median(coefficients[1:])  # The DC term only sets the overall brightness
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def file_phash(source, hash_size=HASH_SIZE, dct_size=DCT_SIZE, crop=CROP):
+    """pHash of an image file (path or file object), decoded at reduced resolution where possible."""
+    with Image.open(source) as image:
+        # JPEG decodes straight to a scale where the crop still has at least 4 x dct_size pixels
+        side = int(4 * dct_size / crop)
+        image.draft('L', (side, side))
+        return phash(image, hash_size, dct_size, crop)
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+class HashIndex:
+    """Multi-index hash table answering 'all hashes within max_distance bits' without a full scan."""
+
+    def __init__(self, max_distance=8, bits=HASH_SIZE * HASH_SIZE, chunk_bits=16):
+        self.max_distance = max_distance
+        self.chunk_bits = chunk_bits
+        self.shifts = list(range(0, bits, chunk_bits))
+        # Flip masks of every chunk value within the per-chunk search radius
+        radius = max_distance // len(self.shifts)
+        self.flips = [sum(1 << bit for bit in flipped) for distance in range(radius + 1)
+                      for flipped in combinations(range(chunk_bits), distance)]
+        self.tables = [{} for _ in self.shifts]
+        self.hashes = []
+
+    def keys(self, value):
+        return [(value >> shift) & ((1 << self.chunk_bits) - 1) for shift in self.shifts]
+
+    def add(self, value):
+        """Index a hash and return its id (ids are assigned in insertion order)."""
+        item = len(self.hashes)
+        self.hashes.append(value)
+        for table, key in zip(self.tables, self.keys(value)):
+            table.setdefault(key, []).append(item)
+        return item
+
+    def query(self, value):
+        """[(id, distance)] of every indexed hash within max_distance bits, nearest first."""
+        candidates = set()
+        for table, key in zip(self.tables, self.keys(value)):
+            for flip in self.flips:
+                candidates.update(table.get(key ^ flip, ()))
+        matches = [(item, hamming_distance(value, self.hashes[item])) for item in candidates]
+        return sorted((match for match in matches if match[1] <= self.max_distance), key=lambda m: (m[1], m[0]))
+
+def flag_near_duplicates(metadata_df, max_distance=8, hash_column='PHash'):
+    """Mark every image whose hash is within `max_distance` bits of an earlier image.
+
+    Duplicate_Of names the first image of the duplicate group (empty for originals) and
+    Hash_Distance is the distance to the nearest earlier image of the group. `hash_column` holds
+    hashes as hex strings, as written by Step 1.
+    """
+    index = HashIndex(max_distance)
+    original = []  # Group representative of every indexed image
+    duplicate_of, distances = [], []
+    for position, value in enumerate(metadata_df[hash_column]):
+        value = int(value, 16)
+        matches = index.query(value)
+        if matches:
+            item, distance = matches[0]
+            original.append(original[item])
+            duplicate_of.append(metadata_df['Filename'].iloc[original[item]])
+            distances.append(distance)
+        else:
+            original.append(position)
+            duplicate_of.append('')
+            distances.append(np.nan)
+        index.add(value)
+    flagged = metadata_df.assign(Duplicate_Of=duplicate_of, Hash_Distance=distances)
+    duplicates = flagged[flagged['Duplicate_Of'] != '']
+    for row in duplicates.itertuples():
+        print(f"Warning: {row.Filename} looks like a copy of {row.Duplicate_Of} "
+              f"(hash distance {int(row.Hash_Distance)})")
+    return flagged
@@ -0,0 +1,144 @@
+"""Spatial readouts of the segmentations in code6 and code7.
+
+Depth profiles: the distance transform of the sample mask is computed once per image, and the
+fraction of every class (code7 intensity class or code6 color segment) is binned by depth from the
+tissue boundary with a single `np.bincount` over (depth bin, class) codes. Profiles are exported per
+image and averaged per staining and condition, so edge-to-core gradients can be compared.
+
+Heterogeneity: one summed-area table (integral image) per class mask gives the class pixels of any
+axis-aligned tile from four corner lookups, so per-tile percentage maps for many grid sizes are
+derived from the same integral images without rescanning pixels. Each map is summarized by its
+coefficient of variation across tiles and its Moran's I (rook adjacency).
+"""
+import os
+import cv2
+import numpy as np
+import pandas as pd
+
+def depth_map(sample_mask):
+    """Euclidean distance in pixels from every sample pixel to the nearest pixel outside the sample."""
+    return cv2.distanceTransform((sample_mask > 0).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+
+def labels_from_masks(masks):
+    """Class map from disjoint binary masks: pixel value i for masks[i], -1 where no mask is set."""
+    labels = np.full(masks[0].shape, -1, dtype=np.int8)
+    for i, mask in enumerate(masks):
+        labels[mask > 0] = i
+    return labels
+
+def depth_profile(labels, class_names, distance, bin_width=25):
+    """Percentage of each class per depth bin of `bin_width` pixels, in long format.
+
+    `labels` index `class_names`; negative labels (background, white) and pixels outside the sample
+    (depth 0) are ignored. Bins run from the boundary inwards and stop at the deepest sample pixel.
+    """
+    valid = (distance > 0) & (labels >= 0)
+    depth_bins = (distance[valid] // bin_width).astype(np.int64)
+    n_classes = len(class_names)
+    n_bins = int(depth_bins.max()) + 1 if depth_bins.size else 0
+    counts = np.bincount(depth_bins * n_classes + labels[valid], minlength=n_bins * n_classes)
+    counts = counts.reshape(n_bins, n_classes)
+    bin_pixels = counts.sum(axis=1, keepdims=True)
+    percentages = np.divide(counts * 100.0, bin_pixels, out=np.zeros(counts.shape), where=bin_pixels > 0)
+
+    depth_bin = np.repeat(np.arange(n_bins), n_classes)
+    return pd.DataFrame({
+        'Depth_Bin': depth_bin,
+        'Depth_Start_px': depth_bin * bin_width,
+        'Depth_End_px': (depth_bin + 1) * bin_width,
+        'Class': np.tile(np.asarray(class_names, dtype=object), n_bins),
+        'Pixels': counts.ravel(),
+        'Bin_Pixels': np.repeat(bin_pixels.ravel(), n_classes),
+        'Percentage': percentages.ravel(),
+    })
+
+class DepthProfiles:
+    """Collects per-image depth profiles and averages them per staining and condition."""
+
+    def __init__(self):
+        self.frames = []
+
+    def add(self, profile, image, staining, condition):
+        self.frames.append(profile.assign(Image=image, Staining=staining, Condition=condition))
+
+    def to_dataframe(self):
+        if not self.frames:
+            return pd.DataFrame()
+        df = pd.concat(self.frames, ignore_index=True)
+        leading = ['Image', 'Staining', 'Condition']
+        return df[leading + [column for column in df.columns if column not in leading]]
+
+    def condition_average(self):
+        """Mean, SD and SEM of each class percentage per depth bin over the images of a condition."""
+        df = self.to_dataframe()
+        if df.empty:
+            return df
+        keys = ['Staining', 'Condition', 'Class', 'Depth_Bin', 'Depth_Start_px', 'Depth_End_px']
+        grouped = df.groupby(keys, sort=False)['Percentage']
+        average = grouped.agg(['mean', 'std', 'sem', 'count']).reset_index()
+        average = average.rename(columns={'mean': 'Mean_Percentage', 'std': 'Std', 'sem': 'SEM', 'count': 'Images'})
+        return average.sort_values(['Staining', 'Condition', 'Class', 'Depth_Bin'], kind='stable').reset_index(drop=True)
+
+    def write(self, output_dir, prefix='Depth_Profile'):
+        """Write all per-image profiles and the per-condition averages; return the written paths."""
+        os.makedirs(output_dir, exist_ok=True)
+        images_path = os.path.join(output_dir, f'{prefix}_Images.csv')
+        conditions_path = os.path.join(output_dir, f'{prefix}_By_Condition.csv')
+        self.to_dataframe().to_csv(images_path, index=False)
+        self.condition_average().to_csv(conditions_path, index=False)
+        print(f"Depth profiles saved to {images_path} and {conditions_path}")
+        return [images_path, conditions_path]
+
+def integral_image(mask):
+    """Summed-area table of a binary mask: S[y, x] is the number of set pixels in mask[:y, :x]."""
+    return cv2.integral((mask > 0).astype(np.uint8))
+
+def tile_sums(integral, tile_size):
+    """Sum of every tile of a `tile_size` grid (the last row/column of tiles may be smaller)."""
+    height, width = integral.shape[0] - 1, integral.shape[1] - 1
+    ys = np.append(np.arange(0, height, tile_size), height)
+    xs = np.append(np.arange(0, width, tile_size), width)
+    corners = integral[np.ix_(ys, xs)].astype(np.int64)
+    return np.diff(np.diff(corners, axis=0), axis=1), np.outer(np.diff(ys), np.diff(xs))
+
+def morans_i(values):
+    """Moran's I of a tile map with rook (edge-sharing) neighbours; NaN tiles are left out."""
+    valid = ~np.isnan(values)
+    if valid.sum() < 2:
+        return np.nan
+    z = np.where(valid, values - values[valid].mean(), 0)
+    horizontal = valid[:, 1:] & valid[:, :-1]
+    vertical = valid[1:] & valid[:-1]
+    n_pairs = horizontal.sum() + vertical.sum()
+    cross = (z[:, 1:] * z[:, :-1])[horizontal].sum() + (z[1:] * z[:-1])[vertical].sum()
+    variance = (z[valid] ** 2).sum()
+    if n_pairs == 0 or variance == 0:
+        return np.nan
+    # N / W * sum_ij w_ij z_i z_j / sum_i z_i^2, with each neighbour pair counted in both directions
+    return valid.sum() / n_pairs * cross / variance
+
+def heterogeneity(class_integrals, region_integral, tile_sizes, min_coverage=0.5):
+    """Tile percentage maps and their dispersion for every class and tile size.
+
+    `class_integrals` maps class names to integral images; `region_integral` is the integral image
+    of the pixels the percentages refer to (the sample region). Tiles whose region covers less than
+    `min_coverage` of the tile are left out. Returns (summary, tiles) DataFrames.
+    """
+    summary, tiles = [], []
+    for tile_size in tile_sizes:
+        region, tile_area = tile_sums(region_integral, tile_size)
+        valid = (region > 0) & (region >= min_coverage * tile_area)
+        rows, columns = np.nonzero(valid)
+        for name, integral in class_integrals.items():
+            counts, _ = tile_sums(integral, tile_size)
+            percentages = np.full(region.shape, np.nan)
+            percentages[valid] = counts[valid] * 100.0 / region[valid]
+            values = percentages[valid]
+            mean = values.mean() if values.size else np.nan
+            sd = values.std(ddof=1) if values.size > 1 else np.nan
+            summary.append({'Tile_px': tile_size, 'Class': name, 'Tiles': int(values.size),
+                            'Mean_Percentage': mean, 'SD': sd, 'CV': sd / mean if mean > 0 else np.nan,
+                            'Morans_I': morans_i(percentages)})
+            tiles.append(pd.DataFrame({'Tile_px': tile_size, 'Class': name, 'Row': rows, 'Col': columns,
+                                       'Region_Pixels': region[valid], 'Percentage': values}))
+    return pd.DataFrame(summary), pd.concat(tiles, ignore_index=True)
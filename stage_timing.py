@@ -0,0 +1,113 @@
+"""Per-stage timing and peak-memory instrumentation for the image pipelines (code6 and code7).
+
+Wrap each stage of the per-image processing in `timer.span(image, stage)`; every span records wall
+time, CPU time and the peak resident set size reached while it ran. The timer can write the raw
+records, a p50/p95 summary per stage, and optionally a cProfile dump of everything inside the spans.
+"""
+import cProfile
+import os
+import pstats
+import resource
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS counter (Linux); returns False where that is not supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """Peak RSS in MB since the last reset (VmHWM), or the lifetime peak where /proc is unavailable."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 ** 2 if os.uname().sysname == 'Darwin' else maxrss / 1024  # bytes on macOS, KB elsewhere
+
+class StageTimer:
+    """Collects one record per (image, stage) span; set `profile=True` to also run cProfile inside spans."""
+
+    def __init__(self, profile=False):
+        self.records = []
+        self.records_by_image = {}  # Image -> its records, so per-image lookups do not scan the whole batch
+        self.profiler = cProfile.Profile() if profile else None
+
+    @contextmanager
+    def span(self, image, stage):
+        resettable = reset_peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        if self.profiler is not None:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+            record = {
+                'Image': image,
+                'Stage': stage,
+                'Wall_s': time.perf_counter() - wall,
+                'CPU_s': time.process_time() - cpu,
+                'Peak_RSS_MB': peak_rss_mb(),
+                'Peak_Is_Per_Stage': resettable,
+            }
+            self.records.append(record)
+            self.records_by_image.setdefault(image, []).append(record)
+
+    def image_records(self, image):
+        return self.records_by_image.get(image, [])
+
+    def update_metadata(self, metadata_df, index, image):
+        """Store the image's per-stage wall times and its peak RSS as metadata columns."""
+        records = self.image_records(image)
+        for record in records:
+            metadata_df.at[index, f"Time_{record['Stage']}_s"] = record['Wall_s']
+        if records:
+            metadata_df.at[index, 'Time_Total_s'] = sum(record['Wall_s'] for record in records)
+            metadata_df.at[index, 'Peak_RSS_MB'] = max(record['Peak_RSS_MB'] for record in records)
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.records, columns=['Image', 'Stage', 'Wall_s', 'CPU_s', 'Peak_RSS_MB',
+                                                   'Peak_Is_Per_Stage'])
+
+    def summary(self):
+        """p50/p95 of wall time, CPU time and peak RSS per stage, in the order stages first ran."""
+        df = self.to_dataframe()
+        rows = []
+        for stage in df['Stage'].unique():
+            stage_df = df[df['Stage'] == stage]
+            row = {'Stage': stage, 'Images': len(stage_df), 'Total_Wall_s': stage_df['Wall_s'].sum()}
+            for column in ('Wall_s', 'CPU_s', 'Peak_RSS_MB'):
+                p50, p95 = np.percentile(stage_df[column], [50, 95])
+                row[f'{column}_p50'] = p50
+                row[f'{column}_p95'] = p95
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def write_reports(self, output_dir, prefix='Stage_Timing'):
+        """Write the raw span records, the p50/p95 summary and (if profiling) a .prof dump; return paths."""
+        os.makedirs(output_dir, exist_ok=True)
+        records_path = os.path.join(output_dir, f'{prefix}_Records.csv')
+        summary_path = os.path.join(output_dir, f'{prefix}_Summary.csv')
+        self.to_dataframe().to_csv(records_path, index=False)
+        summary = self.summary()
+        summary.to_csv(summary_path, index=False)
+        print(f"\nStage timing summary (p50/p95 per image):\n{summary.to_string(index=False, float_format='%.3f')}")
+        paths = [records_path, summary_path]
+
+        if self.profiler is not None:
+            profile_path = os.path.join(output_dir, f'{prefix}_Profile.prof')
+            self.profiler.dump_stats(profile_path)
+            pstats.Stats(profile_path).sort_stats('cumulative').print_stats(20)
+            paths.append(profile_path)
+        return paths
@@ -0,0 +1,88 @@
+"""Consolidated, machine-readable ANOVA / Tukey HSD / descriptive statistics for code6 and code7.
+
+All results of a run go into one long table with stable column names, keyed by
+(Source, Staining, Measure, Record, Group_1, Group_2). Record is 'anova', 'tukey' or 'descriptive';
+columns that do not apply to a record are left empty. The per-group text reports are rendered
+from the table on demand instead of being the primary output.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['Source', 'Staining', 'Measure', 'Record', 'Group_1', 'Group_2',
+           'F_Statistic', 'P_Value', 'Mean_Diff', 'P_Adj', 'CI_Lower', 'CI_Upper', 'Reject',
+           'N', 'Mean', 'Std', 'SEM']
+
+class StatisticsTable:
+    """Accumulates statistics rows for one run and writes them as one CSV (plus optional JSON)."""
+
+    def __init__(self, source):
+        self.source = source
+        self.rows = []
+
+    def add(self, staining, measure, f_value, p_value, tukey, desc_stats, **keys):
+        """Add the ANOVA result, every Tukey pair and the per-condition descriptive statistics.
+
+        Extra keyword arguments become additional key columns (e.g. the thresholds of a sweep).
+        """
+        key = {'Source': self.source, 'Staining': staining, 'Measure': measure, **keys}
+        self.rows.append({**key, 'Record': 'anova', 'F_Statistic': float(f_value), 'P_Value': float(p_value)})
+        # Full-precision pair results, in the same pair order as tukey.summary() (which rounds to 4 digits)
+        first, second = np.triu_indices(len(tukey.groupsunique), 1)
+        for group1, group2, mean_diff, p_adj, (lower, upper), reject in zip(
+                tukey.groupsunique[first], tukey.groupsunique[second], tukey.meandiffs, tukey.pvalues,
+                tukey.confint, tukey.reject):
+            self.rows.append({**key, 'Record': 'tukey', 'Group_1': str(group1), 'Group_2': str(group2),
+                              'Mean_Diff': float(mean_diff), 'P_Adj': float(p_adj), 'CI_Lower': float(lower),
+                              'CI_Upper': float(upper), 'Reject': bool(reject)})
+        for condition, row in desc_stats.iterrows():
+            self.rows.append({**key, 'Record': 'descriptive', 'Group_1': str(condition), 'N': int(row['count']),
+                              'Mean': row['mean'], 'Std': row['std'], 'SEM': row['sem']})
+
+    def to_dataframe(self):
+        # Extra key columns go right after the standard keys
+        extra = list(dict.fromkeys(column for row in self.rows for column in row if column not in COLUMNS))
+        return pd.DataFrame(self.rows, columns=COLUMNS[:3] + extra + COLUMNS[3:])
+
+    def write(self, output_dir, name='Statistical_Results', write_json=False):
+        """Write <name>.csv (and <name>.json as a list of records); return the written paths."""
+        df = self.to_dataframe()
+        paths = [os.path.join(output_dir, f'{name}.csv')]
+        df.to_csv(paths[0], index=False)
+        if write_json:
+            # One object per row with every column present (null where a column does not apply)
+            paths.append(os.path.join(output_dir, f'{name}.json'))
+            df.to_json(paths[1], orient='records', indent=2)
+        return paths
+
+    def text_report(self, staining, measures=None):
+        """Plain-text report for one staining (optionally restricted to some measures) from the table."""
+        return text_report(self.to_dataframe(), staining, measures)
+
+def text_report(df, staining, measures=None):
+    """Render ANOVA, Tukey and descriptive results of one staining from a consolidated table."""
+    stain_df = df[df['Staining'] == staining]
+    measures = list(dict.fromkeys(stain_df['Measure'])) if measures is None else measures
+    lines = [f"Statistical Analysis Results for {staining}"
+             + (f" ({measures[0]})" if len(measures) == 1 else ''), '']
+    for measure in measures:
+        measure_df = stain_df[stain_df['Measure'] == measure]
+        anova = measure_df[measure_df['Record'] == 'anova']
+        tukey = measure_df[measure_df['Record'] == 'tukey']
+        descriptive = measure_df[measure_df['Record'] == 'descriptive']
+        if len(measures) > 1:
+            lines += ['', f"{measure} Results:"]
+        if not anova.empty:
+            lines += [f"One-way ANOVA p-value: {anova['P_Value'].iloc[0]:.5f}", '']
+        lines.append("Tukey's HSD Test Results:")
+        lines.append(tukey[['Group_1', 'Group_2', 'Mean_Diff', 'P_Adj', 'CI_Lower', 'CI_Upper', 'Reject']]
+                     .rename(columns={'Group_1': 'group1', 'Group_2': 'group2', 'Mean_Diff': 'meandiff',
+                                      'P_Adj': 'p-adj', 'CI_Lower': 'lower', 'CI_Upper': 'upper',
+                                      'Reject': 'reject'})
+                     .to_string(index=False, float_format='%.4f'))
+        lines += ['', 'Descriptive Statistics:']
+        lines.append(descriptive[['Group_1', 'N', 'Mean', 'Std', 'SEM']].astype({'N': int})
+                     .rename(columns={'Group_1': 'Condition', 'N': 'count', 'Mean': 'mean', 'Std': 'std',
+                                      'SEM': 'sem'})
+                     .to_string(index=False))
+    return '\n'.join(lines) + '\n'